@@ -0,0 +1,119 @@
+'''A bootstrap and storage nodes on localhost ports, all in this process,
+   for benchmarks that drive FuseApi directly instead of a FUSE mount.
+
+   cluster = Cluster(nodes=3, replicas=2)
+   api = cluster.apis[0]
+   api.create('/f', 0o644)
+   ...
+   cluster.stop()
+'''
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from time import monotonic, sleep
+
+import bootstrap
+import client
+from utils.aio import AsyncServer
+from utils.node import Node
+
+
+class CountingPool():
+    '''Wraps the connection pool of a FuseApi, counting the requests it
+       sends by command'''
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def request(self, node, obj):
+        with self.lock:
+            self.counts[obj.get('command')] += 1
+        return self.pool.request(node, obj)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+
+def serve(server, address, handler):
+    if server == 'asyncio':
+        return AsyncServer(address, handler)
+    return client.ThreadedTCPServer(address, handler)
+
+
+def start_node(bootstrap_node, server='threaded', **options):
+    '''Starts a storage node serving a new temporary directory, returns
+       its server, FuseApi and directory'''
+    directory = tempfile.mkdtemp()
+    # bound before joining, so the bootstrap learns our port. Requests
+    # wait in the backlog until serve_forever
+    node = serve(server, ('localhost', 0), client.ServerHandler)
+    api = client.FuseApi(bootstrap_node, Node('localhost', node.server_address[1]),
+                         directory, **options)
+    api.pool = CountingPool(api.pool)
+
+    node.api = api
+    node.stats = api.stats
+    threading.Thread(target=node.serve_forever, daemon=True).start()
+    return node, api, directory
+
+
+class Cluster():
+    '''Starts a bootstrap and nodes storage nodes, each serving a temporary
+       directory. options are passed on to every FuseApi'''
+    def __init__(self, nodes=3, replicas=1, placement='ring', server='threaded', **options):
+        self.server = server
+        self.options = options
+
+        # the bootstrap keeps its state in module globals, so there is one
+        # per process
+        bootstrap.base_mgr = bootstrap.BaseProtocolManager(placement, replicas=replicas)
+        bootstrap.leases = bootstrap.LeaseTable(30.0)
+        self.bootstrap = serve(server, ('localhost', 0), bootstrap.BootstrapHandler)
+        self.bootstrap.stats = bootstrap.stats
+        bootstrap.PORT = self.bootstrap.server_address[1]
+        self.bootstrap_node = Node(*self.bootstrap.server_address)
+        threading.Thread(target=self.bootstrap.serve_forever, daemon=True).start()
+
+        self.dirs = []
+        self.servers = []
+        self.apis = []
+        for _ in range(nodes):
+            self.add_node()
+        self.settle()
+
+    def add_node(self):
+        '''Starts one more storage node, returns its FuseApi'''
+        server, api, directory = start_node(self.bootstrap_node, self.server, **self.options)
+        self.dirs.append(directory)
+        self.servers.append(server)
+        self.apis.append(api)
+        return api
+
+    def settle(self, timeout=10.0):
+        '''Waits for the member list pushes to reach every node, until then
+           they skip the nodes they don't know of yet'''
+        deadline = monotonic() + timeout
+        while any(api.epoch != bootstrap.base_mgr.epoch for api in self.apis):
+            if monotonic() > deadline:
+                raise TimeoutError('membership did not settle')
+            sleep(0.01)
+
+    def rpcs(self):
+        '''Requests sent by every node so far, by command'''
+        counts = Counter()
+        for api in self.apis:
+            with api.pool.lock:
+                counts.update(api.pool.counts)
+        return counts
+
+    def stop(self):
+        for api, server in zip(self.apis, self.servers):
+            api.shutdown()
+            server.shutdown()
+        self.bootstrap.shutdown()
+        bootstrap.pool.close()
+
+        for directory in self.dirs:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,247 @@
+'''fio-style workloads against an in-process cluster (benchmarks.cluster),
+   driving FuseApi the way the FUSE callbacks would. Every phase reports
+   its throughput, p50/p99 latency and the RPCs an operation took, as JSON
+   for tracking regressions between commits.
+
+   Jobs run in threads of their own, each on the node after the previous
+   one's, and read through a different node than they wrote through.
+
+   run from the project root: python -m benchmarks.dfs_benchmark -o results.json
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+from itertools import chain
+from time import perf_counter
+
+from benchmarks.cluster import Cluster
+
+WORKLOADS = ['seq', 'rand', 'metadata', 'mixed']
+
+
+def percentile(values, p):
+    '''p-th percentile of sorted values'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def phase(cluster, name, jobs, job):
+    '''Runs job(j, timed) in jobs threads at once. job measures each of its
+       operations with timed(fn, *args) and returns the bytes it moved'''
+    latencies = [[] for _ in range(jobs)]
+    moved = [0] * jobs
+    barrier = threading.Barrier(jobs + 1)
+
+    def worker(j):
+        def timed(fn, *args):
+            start = perf_counter()
+            result = fn(*args)
+            latencies[j].append(perf_counter() - start)
+            return result
+
+        barrier.wait()
+        moved[j] = job(j, timed) or 0
+
+    threads = [threading.Thread(target=worker, args=(j,)) for j in range(jobs)]
+    for thread in threads:
+        thread.start()
+
+    before = cluster.rpcs()
+    barrier.wait()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    rpcs = cluster.rpcs() - before
+
+    ops = sorted(chain.from_iterable(latencies))
+    result = {
+        'phase': name,
+        'ops': len(ops),
+        'seconds': elapsed,
+        'ops_per_s': len(ops) / elapsed,
+        'p50_ms': percentile(ops, 50) * 1e3,
+        'p99_ms': percentile(ops, 99) * 1e3,
+        'rpcs_per_op': sum(rpcs.values()) / max(1, len(ops)),
+        'rpcs': dict(rpcs),
+    }
+    if sum(moved):
+        result['mib_per_s'] = sum(moved) / elapsed / 2 ** 20
+    return result
+
+
+class Bench():
+    def __init__(self, cluster, jobs, block_size, file_size, files, readers):
+        self.cluster = cluster
+        self.apis = cluster.apis
+        self.jobs = jobs
+        self.block_size = block_size
+        self.file_size = file_size
+        self.files = files
+        self.readers = readers
+        self.block = os.urandom(block_size)
+
+    def api(self, j, shift=0):
+        return self.apis[(j + shift) % len(self.apis)]
+
+    def offsets(self):
+        return range(0, self.file_size, self.block_size)
+
+    def create(self, paths):
+        for j, path in enumerate(paths):
+            self.api(j).create(path, 0o644)
+
+    def fill(self, paths):
+        '''Writes every path in full, untimed'''
+        for j, path in enumerate(paths):
+            api = self.api(j)
+            for offset in self.offsets():
+                api.write(path, self.block, offset, None)
+            api.flush(path)
+
+    def remove(self, paths):
+        for j, path in enumerate(paths):
+            self.api(j).unlink(path)
+
+    def seq(self):
+        paths = [f'/seq{j}' for j in range(self.jobs)]
+        self.create(paths)
+
+        def write(j, timed):
+            api = self.api(j)
+            for offset in self.offsets():
+                timed(api.write, paths[j], self.block, offset, None)
+            # like close() would
+            api.flush(paths[j])
+            return self.file_size
+
+        def read(j, timed):
+            api = self.api(j, 1)
+            return sum(len(timed(api.read, paths[j], self.block_size, offset, None))
+                       for offset in self.offsets())
+
+        results = [phase(self.cluster, 'seq_write', self.jobs, write),
+                   phase(self.cluster, 'seq_read', self.jobs, read)]
+        self.remove(paths)
+        return results
+
+    def rand(self):
+        paths = [f'/rand{j}' for j in range(self.jobs)]
+        self.create(paths)
+        self.fill(paths)
+
+        def shuffled(j):
+            offsets = list(self.offsets())
+            random.Random(j).shuffle(offsets)
+            return offsets
+
+        def write(j, timed):
+            api = self.api(j)
+            for offset in shuffled(j):
+                timed(api.write, paths[j], self.block, offset, None)
+            api.flush(paths[j])
+            return self.file_size
+
+        def read(j, timed):
+            api = self.api(j, 1)
+            return sum(len(timed(api.read, paths[j], self.block_size, offset, None))
+                       for offset in shuffled(j))
+
+        results = [phase(self.cluster, 'rand_write', self.jobs, write),
+                   phase(self.cluster, 'rand_read', self.jobs, read)]
+        self.remove(paths)
+        return results
+
+    def metadata(self):
+        def paths(j):
+            return [f'/meta{j}-{i}' for i in range(self.files)]
+
+        def create(j, timed):
+            api = self.api(j)
+            for path in paths(j):
+                timed(api.create, path, 0o644)
+
+        def stat(j, timed):
+            api = self.api(j, 1)
+            for path in paths(j):
+                timed(api.getattr, path)
+
+        def unlink(j, timed):
+            api = self.api(j)
+            for path in paths(j):
+                timed(api.unlink, path)
+
+        return [phase(self.cluster, 'create', self.jobs, create),
+                phase(self.cluster, 'getattr', self.jobs, stat),
+                phase(self.cluster, 'unlink', self.jobs, unlink)]
+
+    def mixed(self):
+        '''readers threads per file, each on another node, reading random
+           blocks of it at once'''
+        paths = [f'/mixed{j}' for j in range(self.jobs)]
+        self.create(paths)
+        self.fill(paths)
+
+        def read(r, timed):
+            j = r // self.readers
+            api = self.api(j, r)
+            offsets = list(self.offsets())
+            rand = random.Random(r)
+            return sum(len(timed(api.read, paths[j], self.block_size, rand.choice(offsets), None))
+                       for _ in offsets)
+
+        results = [phase(self.cluster, 'shared_read', self.jobs * self.readers, read)]
+        self.remove(paths)
+        return results
+
+
+def run(args):
+    cluster = Cluster(args.nodes, args.replicas, args.placement, args.server,
+                      stripe_size=args.stripe_size * 1024,
+                      # heartbeats would show up in every phase's RPCs
+                      heartbeat_interval=0)
+    try:
+        bench = Bench(cluster, args.jobs, args.block_size * 1024,
+                      args.file_size * 1024 * 1024, args.files, args.readers)
+        results = []
+        for workload in args.workloads:
+            for result in getattr(bench, workload)():
+                result['workload'] = workload
+                results.append(result)
+        return results
+    finally:
+        cluster.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workloads", nargs='+', choices=WORKLOADS, default=WORKLOADS, help="Workloads to run (default all)")
+    parser.add_argument("-n", "--nodes", type=int, default=3, help="Storage nodes (default 3)")
+    parser.add_argument("-r", "--replicas", type=int, default=1, help="Copies of every file (default 1)")
+    parser.add_argument("--placement", choices=['local', 'ring'], default='ring', help="Bootstrap placement (default ring)")
+    parser.add_argument("--server", choices=['threaded', 'asyncio'], default='threaded', help="Node and bootstrap server (default threaded)")
+    parser.add_argument("--stripe-size", type=int, default=0, help="Stripe files in chunks of this many KiB, 0 disables (default 0)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Concurrent jobs, one file each (default 4)")
+    parser.add_argument("-b", "--block-size", type=int, default=64, help="KiB per read or write (default 64)")
+    parser.add_argument("-s", "--file-size", type=int, default=16, help="MiB per file (default 16)")
+    parser.add_argument("-f", "--files", type=int, default=500, help="Files per job in the metadata workload (default 500)")
+    parser.add_argument("--readers", type=int, default=4, help="Readers per file in the mixed workload (default 4)")
+    parser.add_argument("-o", "--output", type=str, help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    report = {
+        'config': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
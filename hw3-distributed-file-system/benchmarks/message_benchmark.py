@@ -0,0 +1,74 @@
+'''Compares the JSON+base64 (v1) and binary (v2) wire protocols for
+   READ/WRITE sized payloads.
+
+   run from the project root: python -m benchmarks.message_benchmark
+'''
+import argparse
+import os
+import socket
+import threading
+from time import perf_counter
+
+from utils.connection import Connection
+
+SIZES = [4 * 1024, 128 * 1024, 1024 * 1024]
+
+
+def write_request(size):
+    return {
+        'command': 'WRITE',
+        'path': '/bench',
+        'offset': 0,
+        'data': os.urandom(size),
+        'port': 8080,
+    }
+
+
+def echo(sock, version):
+    conn = Connection(sock, version)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        conn.send(msg)
+
+
+def bench(version, size, iterations):
+    '''Round trips a WRITE sized message over a socketpair, the reply
+       carries the same payload like a READ would'''
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=echo, args=(server, version), daemon=True)
+    thread.start()
+
+    conn = Connection(client, version)
+    msg = write_request(size)
+
+    start = perf_counter()
+    for _ in range(iterations):
+        conn.send(msg)
+        conn.recv()
+    elapsed = perf_counter() - start
+
+    client.close()
+    thread.join()
+    server.close()
+
+    return {
+        'version': version,
+        'size': size,
+        'us_per_round_trip': elapsed / iterations * 1e6,
+        'mb_per_s': 2 * size * iterations / elapsed / 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", type=int, default=200, help="Round trips per size (default 200)")
+    args = parser.parse_args()
+
+    print(f"{'version':>7} {'size':>9} {'us/rtt':>10} {'MB/s':>9}")
+    for size in SIZES:
+        for version in (1, 2):
+            result = bench(version, size, args.iterations)
+            print(f"{result['version']:>7} {result['size']:>9} "
+                  f"{result['us_per_round_trip']:>10.1f} {result['mb_per_s']:>9.1f}")
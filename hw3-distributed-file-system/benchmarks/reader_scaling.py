@@ -0,0 +1,158 @@
+'''How the read throughput of one mount grows with the readers using it at
+   once. Multithreaded FUSE serves every reader process with a thread of
+   its own, so the mount here is a FuseApi driven by 1, 2, 4... threads,
+   each reading random blocks of a file of its own held by other nodes.
+
+   The bootstrap and every storage node run in processes of their own:
+   in benchmarks.cluster they would share the mount's interpreter lock,
+   and it would cap the throughput however well the mount scales. Give
+   the machine a core per process for meaningful numbers.
+
+   run from the project root: python -m benchmarks.reader_scaling -o scaling.json
+'''
+import argparse
+import json
+import multiprocessing
+import random
+import shutil
+import sys
+from collections import Counter
+
+from benchmarks.cluster import Cluster, start_node
+from benchmarks.dfs_benchmark import phase
+from utils.node import Node
+
+
+def run_bootstrap(ready, done, replicas, server):
+    cluster = Cluster(0, replicas, server=server)
+    ready.put(tuple(cluster.bootstrap_node))
+    done.wait()
+    cluster.stop()
+
+
+def run_node(bootstrap_node, ready, done, server, options):
+    node, api, directory = start_node(Node(*bootstrap_node), server, **options)
+    ready.put(None)
+    done.wait()
+    api.shutdown()
+    node.shutdown()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+class Mount():
+    '''The mount under test, the only node in this process. Started after
+       the others, so it joins knowing all of them'''
+    def __init__(self, bootstrap_node, server, options):
+        self.server, self.api, self.directory = start_node(bootstrap_node, server, **options)
+
+    def rpcs(self):
+        with self.api.pool.lock:
+            return Counter(self.api.pool.counts)
+
+    def remote_files(self, count, multiple_nodes):
+        '''Creates count files held by other nodes'''
+        paths = []
+        i = 0
+        while len(paths) < count:
+            path = f'/scale{i}'
+            i += 1
+            self.api.create(path, 0o644)
+            if multiple_nodes and self.api.local_node in self.api.get_replicas(path):
+                self.api.unlink(path)
+            else:
+                paths.append(path)
+        return paths
+
+    def stop(self):
+        self.api.shutdown()
+        self.server.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def run(args):
+    # the children inherit the imported modules, and the fuse stubs of
+    # whoever runs this
+    context = multiprocessing.get_context('fork')
+    ready = context.Queue()
+    done = context.Event()
+    options = {
+        'block_cache_size': args.block_cache * 1024 * 1024,
+        'lock_stripes': args.lock_stripes,
+        'multiplex': True,
+        # heartbeats would show up in every phase's RPCs
+        'heartbeat_interval': 0,
+    }
+
+    processes = [context.Process(target=run_bootstrap, args=(ready, done, args.replicas, args.server), daemon=True)]
+    processes[0].start()
+    bootstrap_node = ready.get()
+    for _ in range(args.nodes):
+        processes.append(context.Process(target=run_node, args=(bootstrap_node, ready, done, args.server, options), daemon=True))
+        processes[-1].start()
+        ready.get()
+
+    mount = Mount(Node(*bootstrap_node), args.server, options)
+    try:
+        api = mount.api
+        block_size = args.block_size * 1024
+        file_size = args.file_size * 1024 * 1024
+        offsets = range(0, file_size, block_size)
+        block = bytes(block_size)
+
+        counts = [1]
+        while counts[-1] * 2 <= args.readers:
+            counts.append(counts[-1] * 2)
+        paths = mount.remote_files(counts[-1], args.nodes > 0)
+        for path in paths:
+            for offset in offsets:
+                api.write(path, block, offset, None)
+            api.flush(path)
+
+        def read(r, timed):
+            shuffled = list(offsets)
+            random.Random(r).shuffle(shuffled)
+            return sum(len(timed(api.read, paths[r], block_size, offset, None))
+                       for offset in shuffled)
+
+        results = []
+        for count in counts:
+            # every phase starts cold
+            api.invalidate_blocks()
+            result = phase(mount, f'read_x{count}', count, read)
+            result['readers'] = count
+            result['speedup'] = result['mib_per_s'] / results[0]['mib_per_s'] if results else 1.0
+            results.append(result)
+        return results
+
+    finally:
+        mount.stop()
+        done.set()
+        for process in processes:
+            process.join(5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--nodes", type=int, default=3, help="Storage nodes besides the mount, a process each (default 3)")
+    parser.add_argument("-r", "--replicas", type=int, default=1, help="Copies of every file (default 1)")
+    parser.add_argument("--server", choices=['threaded', 'asyncio'], default='threaded', help="Node and bootstrap server (default threaded)")
+    parser.add_argument("-j", "--readers", type=int, default=16, help="Most readers at once, phases double from 1 up to it (default 16)")
+    parser.add_argument("-b", "--block-size", type=int, default=64, help="KiB per read (default 64)")
+    parser.add_argument("-s", "--file-size", type=int, default=8, help="MiB per reader's file (default 8)")
+    parser.add_argument("--block-cache", type=int, default=64, help="Mount's remote read cache in MiB, 0 disables (default 64)")
+    parser.add_argument("--lock-stripes", type=int, default=16, help="Lock stripes of the mount's shared caches, 1 is a lock each (default 16)")
+    parser.add_argument("-o", "--output", type=str, help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    report = {
+        'config': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
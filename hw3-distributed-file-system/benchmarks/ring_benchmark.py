@@ -0,0 +1,71 @@
+'''Lookup cost and key distribution skew of ConsistentHashManager at 10,
+   100 and 1000 nodes, with and without virtual nodes. The linear scan the
+   ring used before is timed alongside for comparison.
+
+   run from the project root: python -m benchmarks.ring_benchmark
+'''
+import argparse
+import random
+from collections import Counter
+from time import perf_counter
+
+from bootstrap import ConsistentHashManager
+from utils.node import Node
+
+NODE_COUNTS = [10, 100, 1000]
+
+
+def linear_get_client(client_list, hash):
+    for id, addr in client_list:
+        if hash < id:
+            return addr
+    return client_list[0][1]
+
+
+def bench(nodes, vnodes, keys, lookups):
+    ring = ConsistentHashManager(2 ** 32, vnodes)
+    for i in range(nodes):
+        ring.add_client(Node(f'10.{i // 256}.{i % 256}.1', 8080))
+
+    hashes = [random.randrange(2 ** 32) for _ in range(lookups)]
+
+    start = perf_counter()
+    for hash in hashes:
+        ring.get_client(hash)
+    bisect_us = (perf_counter() - start) / lookups * 1e6
+
+    # the old scan is slow, time fewer lookups
+    linear_hashes = hashes[:max(1, lookups // 100)]
+    client_list = ring.client_list
+    start = perf_counter()
+    for hash in linear_hashes:
+        linear_get_client(client_list, hash)
+    linear_us = (perf_counter() - start) / len(linear_hashes) * 1e6
+
+    counts = Counter(ring.get_node(f'/file{i}') for i in range(keys))
+    mean = keys / nodes
+    return {
+        'nodes': nodes,
+        'vnodes': vnodes,
+        'points': len(ring),
+        'bisect_us': bisect_us,
+        'linear_us': linear_us,
+        # max load over mean load, 1.0 is perfectly even
+        'skew': max(counts.values()) / mean,
+        'empty_nodes': nodes - len(counts),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", "--keys", type=int, default=200000, help="Keys placed to measure skew (default 200000)")
+    parser.add_argument("-l", "--lookups", type=int, default=100000, help="Timed lookups (default 100000)")
+    parser.add_argument("-v", "--vnodes", type=int, nargs='+', default=[1, 100], help="Virtual node counts to compare (default 1 100)")
+    args = parser.parse_args()
+
+    print(f"{'nodes':>6} {'vnodes':>6} {'points':>7} {'bisect us':>10} {'linear us':>10} {'skew':>6} {'empty':>6}")
+    for nodes in NODE_COUNTS:
+        for vnodes in args.vnodes:
+            r = bench(nodes, vnodes, args.keys, args.lookups)
+            print(f"{r['nodes']:>6} {r['vnodes']:>6} {r['points']:>7} {r['bisect_us']:>10.2f} "
+                  f"{r['linear_us']:>10.2f} {r['skew']:>6.2f} {r['empty_nodes']:>6}")
@@ -0,0 +1,86 @@
+'''Server CPU spent per GB of READ replies for the JSON+base64 codec, the
+   binary codec with a pread copy, and the binary codec with os.sendfile.
+
+   run from the project root: python -m benchmarks.sendfile_benchmark
+'''
+import argparse
+import os
+import socket
+import tempfile
+import threading
+from time import perf_counter, thread_time
+
+from utils.connection import Connection, FileRange
+
+MODES = ['v1-base64', 'v2-pread', 'v2-sendfile']
+
+
+def serve(sock, mode, fd, result):
+    '''Answers READs like ServerHandler.read, timing only this thread'''
+    conn = Connection(sock, 1 if mode == 'v1-base64' else 2)
+    cpu = 0.0
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+
+        start = thread_time()
+        if mode == 'v2-sendfile':
+            data = FileRange(fd, msg['offset'], msg['size'])
+        else:
+            data = os.pread(fd, msg['size'], msg['offset'])
+        conn.send({
+            'reply': 'ACK_READ',
+            'data': data,
+        })
+        cpu += thread_time() - start
+
+    result['cpu'] = cpu
+
+
+def bench(mode, path, file_size, read_size):
+    fd = os.open(path, os.O_RDONLY)
+    client, server = socket.socketpair()
+    result = {}
+    thread = threading.Thread(target=serve, args=(server, mode, fd, result))
+    thread.start()
+
+    conn = Connection(client, 1 if mode == 'v1-base64' else 2)
+    start = perf_counter()
+    for offset in range(0, file_size, read_size):
+        conn.send({'command': 'READ', 'offset': offset, 'size': read_size})
+        conn.recv()
+    elapsed = perf_counter() - start
+
+    client.close()
+    thread.join()
+    server.close()
+    os.close(fd)
+
+    gb = file_size / 1e9
+    return {
+        'mode': mode,
+        'read_size': read_size,
+        'server_cpu_s_per_gb': result['cpu'] / gb,
+        'gb_per_s': gb / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--file-size", type=int, default=256, help="File served, in MiB (default 256)")
+    parser.add_argument("-r", "--read-size", type=int, default=1024, help="READ size in KiB (default 1024)")
+    args = parser.parse_args()
+
+    file_size = args.file_size * 1024 * 1024
+    read_size = args.read_size * 1024
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(file_size))
+        f.flush()
+
+        print(f"{'mode':>12} {'cpu s/GB':>9} {'GB/s':>7}")
+        for mode in MODES:
+            result = bench(mode, f.name, file_size, read_size)
+            print(f"{result['mode']:>12} {result['server_cpu_s_per_gb']:>9.3f} "
+                  f"{result['gb_per_s']:>7.2f}")
@@ -0,0 +1,77 @@
+'''Threaded vs asyncio server: request throughput with many concurrent
+   pooled clients, and a connection storm of short lived connections.
+   Both serve the bootstrap's command dispatch.
+
+   run from the project root: python -m benchmarks.server_benchmark
+'''
+import argparse
+import threading
+from time import perf_counter
+
+import bootstrap
+from bootstrap import BootstrapHandler, ThreadedTCPServer
+from utils.aio import AsyncServer
+from utils.pool import ConnectionPool
+
+SERVERS = {
+    'threaded': lambda: ThreadedTCPServer(('localhost', 0), BootstrapHandler),
+    'asyncio': lambda: AsyncServer(('localhost', 0), BootstrapHandler),
+}
+
+
+def run_clients(node, clients, requests, pooled):
+    errors = []
+
+    def client(i):
+        pool = ConnectionPool(max_idle=1 if pooled else 0)
+        try:
+            for _ in range(requests):
+                pool.request(node, {'command': 'GET_FILE_LOC', 'file': '/f', 'port': i})
+        except Exception as e:
+            errors.append(e)
+        pool.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    return clients * requests / elapsed, len(errors)
+
+
+def bench(kind, clients, requests):
+    server = SERVERS[kind]()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    node = server.server_address
+
+    pooled = run_clients(node, clients, requests, pooled=True)
+    # one connection per request
+    storm = run_clients(node, clients, max(1, requests // 10), pooled=False)
+
+    server.shutdown()
+    return {
+        'server': kind,
+        'pooled_req_per_s': pooled[0],
+        'pooled_errors': pooled[1],
+        'storm_req_per_s': storm[0],
+        'storm_errors': storm[1],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--clients", type=int, default=200, help="Concurrent client threads (default 200)")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Requests per client (default 200)")
+    args = parser.parse_args()
+
+    bootstrap.PORT = 0
+    bootstrap.base_mgr.add_file('f', bootstrap.Node('localhost', 1))
+
+    print(f"{'server':>9} {'pooled req/s':>13} {'errors':>7} {'storm req/s':>12} {'errors':>7}")
+    for kind in SERVERS:
+        r = bench(kind, args.clients, args.requests)
+        print(f"{r['server']:>9} {r['pooled_req_per_s']:>13.0f} {r['pooled_errors']:>7} "
+              f"{r['storm_req_per_s']:>12.0f} {r['storm_errors']:>7}")
@@ -0,0 +1,103 @@
+'''Cost of logging bootstrap metadata: FILE_ADD/FILE_REMOVE throughput
+   from concurrent threads with the metadata in memory only, with the
+   write-ahead log fsynced before every reply (group commit) and fsynced
+   every 10ms, then restart time from a snapshot of
+   --files entries plus a log of --tail records.
+
+   run from the project root: python -m benchmarks.wal_benchmark
+'''
+import argparse
+import gc
+import shutil
+import tempfile
+import threading
+from time import perf_counter
+
+from bootstrap import BaseProtocolManager
+from utils.node import Node
+
+NODES = [Node(f'10.0.0.{i}', 8080) for i in range(10)]
+
+
+def new_manager(directory=None, sync_interval=0):
+    mgr = BaseProtocolManager(replicas=2)
+    if directory:
+        mgr.open_log(directory, sync_interval)
+    for node in NODES:
+        mgr.add_client(node)
+    return mgr
+
+
+def mutations(mgr, threads, per_thread):
+    def work(t):
+        for i in range(per_thread):
+            name = f't{t}-{i}'
+            mgr.add_file(name, NODES[i % len(NODES)], i, [NODES[(i + 1) % len(NODES)]])
+            if i % 4 == 0:
+                mgr.remove_file(name)
+
+    workers = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+    start = perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = perf_counter() - start
+
+    # each iteration is an add, every fourth also a remove
+    return threads * per_thread * 1.25 / elapsed
+
+
+def restart(directory, files, tail):
+    mgr = new_manager(directory)
+    mgr.batching = True
+    for i in range(files):
+        mgr.add_file(f'file{i}', NODES[i % len(NODES)], i, [NODES[(i + 1) % len(NODES)]])
+    mgr.batching = False
+
+    start = perf_counter()
+    mgr.checkpoint()
+    checkpoint = perf_counter() - start
+
+    for i in range(tail):
+        mgr.set_file_size(f'file{i}', i + 1)
+    mgr.wal.close()
+    # like a restarted bootstrap, without the old state still in memory
+    del mgr
+    gc.collect()
+
+    start = perf_counter()
+    restored = BaseProtocolManager(replicas=2)
+    restored.open_log(directory)
+    elapsed = perf_counter() - start
+
+    assert len(restored.file_dict) == files
+    return checkpoint, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--threads", type=int, nargs='+', default=[1, 4, 16], help="Writer thread counts (default 1 4 16)")
+    parser.add_argument("-n", "--per-thread", type=int, default=2000, help="Files added per thread (default 2000)")
+    parser.add_argument("-f", "--files", type=int, default=1000000, help="Files in the snapshot (default 1000000)")
+    parser.add_argument("--tail", type=int, default=10000, help="Log records after the snapshot (default 10000)")
+    args = parser.parse_args()
+
+    print(f"{'threads':>7} {'memory ops/s':>13} {'wal ops/s':>10} {'wal 10ms ops/s':>15}")
+    for threads in args.threads:
+        results = [mutations(new_manager(), threads, args.per_thread)]
+        for sync_interval in (0, 0.01):
+            directory = tempfile.mkdtemp()
+            try:
+                results.append(mutations(new_manager(directory, sync_interval), threads, args.per_thread))
+            finally:
+                shutil.rmtree(directory)
+        print(f"{threads:>7} {results[0]:>13.0f} {results[1]:>10.0f} {results[2]:>15.0f}")
+
+    directory = tempfile.mkdtemp()
+    try:
+        checkpoint, elapsed = restart(directory, args.files, args.tail)
+    finally:
+        shutil.rmtree(directory)
+    print(f"checkpoint of {args.files} files: {checkpoint:.3f}s")
+    print(f"restart from it plus {args.tail} log records: {elapsed:.3f}s")
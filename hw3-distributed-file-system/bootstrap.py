@@ -1,53 +1,69 @@
-import socket
+import gc
+import logging
 import socketserver
 import threading
 import argparse
 import hashlib
+import bisect
+from itertools import chain, repeat
+from time import sleep, time
 
-from utils.message import Message
 from utils.node import Node
 from utils.handler import RequestHandler
+from utils.pool import ConnectionPool
+from utils.aio import AsyncServer
+from utils.failure import PhiAccrualDetector
+from utils.lease import LeaseTable
+from utils.wal import WriteAheadLog, write_snapshot, read_snapshot
+from utils.stats import Stats
+
+log = logging.getLogger(__name__)
 
 class ConsistentHashManager():
-    def __init__(self, range):
+    def __init__(self, range, vnodes=1):
         # determines possible machine id's from [0-range)
         self.range = range
+        # points each client gets on the ring (times its weight)
+        self.vnodes = vnodes
 
-        # used to check if client already exists
-        # self.client_id_set = set()
-
-        # list elements will be in the form (id, addr)
-        self.client_list = []
+        # sorted ring positions and the addr owning each, kept in step
+        self.ids = []
+        self.addrs = []
 
     def __len__(self):
-        return len(self.client_list)
+        return len(self.ids)
 
     def __str__(self):
-        return str(self.client_list)
+        return str(list(zip(self.ids, self.addrs)))
+
+    @property
+    def client_list(self):
+        # list elements are in the form (id, addr)
+        return list(zip(self.ids, self.addrs))
 
-    def add_client(self, addr):
+    def add_client(self, addr, weight=1):
         '''
-            hash client addr and add to list, return id
+            hash client addr onto the ring (vnodes * weight times), return
+            the id of its first point
         '''
-        # hash and find insertion position
-        id = self.hash(addr)
-
-        # linear search
-        pos = 0
-        # flag to append at end of list
-        at_end = True
-        for idx, elem in enumerate(self.client_list):
-            if id < elem[0]:
-                pos = idx
-                at_end = False
-                break
+        key = self.key(addr)
+        points = max(1, round(self.vnodes * weight))
 
-        if at_end:
-            self.client_list.append((id, addr))
-        else:
-            self.client_list.insert(pos, (id, addr))
+        first = None
+        for i in range(points):
+            # the first point keeps the plain hash of addr
+            id = self.hash(key if i == 0 else f'{key}#{i}')
+            pos = bisect.bisect_left(self.ids, id)
+            if pos < len(self.ids) and self.ids[pos] == id:
+                # collision, the point already belongs to someone
+                continue
+
+            self.ids.insert(pos, id)
+            self.addrs.insert(pos, addr)
+            if first is None:
+                first = id
 
-        return id
+        return first
 
 
     def get_client(self, hash):
@@ -55,14 +71,32 @@ class ConsistentHashManager():
             find client that hash should go to
             returns addr
         '''
-        if not self.client_list:
+        if not self.ids:
             return None
 
-        for id, addr in self.client_list:
-            if hash < id:
-                return addr
+        pos = bisect.bisect_right(self.ids, hash)
+        if pos == len(self.ids):
+            pos = 0
+        return self.addrs[pos]
 
-        return self.client_list[0][1]
+    def get_node(self, key):
+        '''Returns the addr owning key'''
+        return self.get_client(self.hash(key))
+
+    def get_nodes(self, key, n):
+        '''Returns up to n distinct addrs, walking the ring from key'''
+        if not self.ids:
+            return []
+
+        pos = bisect.bisect_right(self.ids, self.hash(key))
+        nodes = []
+        for i in range(len(self.ids)):
+            addr = self.addrs[(pos + i) % len(self.ids)]
+            if addr not in nodes:
+                nodes.append(addr)
+                if len(nodes) == n:
+                    break
+        return nodes
 
 
     def remove_client(self, id):
@@ -70,15 +104,25 @@ class ConsistentHashManager():
             remove client
             return True if success False otherwise
         '''
-        pos = -1
-        for idx, elem in enumerate(self.client_list):
-            if elem[0] == id:
-                pos = idx
+        pos = bisect.bisect_left(self.ids, id)
+        if pos == len(self.ids) or self.ids[pos] != id:
+            return False
+
+        self.ids.pop(pos)
+        self.addrs.pop(pos)
+        return True
 
-        if pos == -1:
+    def remove_node(self, addr):
+        '''
+            remove every point of addr
+            return True if success False otherwise
+        '''
+        keep = [(id, a) for id, a in zip(self.ids, self.addrs) if a != addr]
+        if len(keep) == len(self.ids):
             return False
 
-        self.client_list.pop(pos)
+        self.ids = [id for id, _ in keep]
+        self.addrs = [a for _, a in keep]
         return True
 
 
@@ -87,70 +131,1007 @@ class ConsistentHashManager():
         hash = int.from_bytes(hashobj.digest(), 'big')
         return hash % self.range
 
+    @staticmethod
+    def key(addr):
+        # Nodes hash as "addr:port"
+        if isinstance(addr, str):
+            return addr
+        return ':'.join(str(part) for part in addr)
+
+
+def split(name):
+    '''Parent directory and base name of a file or directory name'''
+    parent, _, base = name.rpartition('/')
+    return parent, base
+
 
 # Ignore consistent hashing for now and implement base code
 class BaseProtocolManager():
-    def __init__(self):
+    def __init__(self, placement='local', vnodes=100, replicas=1):
+        # handler threads share the manager
+        self.lock = threading.RLock()
+
         # stores (addr, port) tuple
         self.nodes = set()
-        # stores file name to (addr, port) tuple
+        # node to its share of the ring
+        self.weights = {}
+        # stores file name to its replica set, a tuple of (addr, port)
+        # tuples with the primary first
         self.file_dict = {}
 
-    def add_file(self, file_name, node):
-        if file_name in self.file_dict:
-            return False
-        self.file_dict[file_name] = node
+        # reverse index, node to the set of file names it holds
+        self.node_files = {}
+        # file name to size in bytes, as last reported by its owner
+        self.file_sizes = {}
+        # striped file name to (chunk size, [nodes of every chunk]), every
+        # chunk is replicated like a file. The replica set of a striped
+        # file only holds its attributes
+        self.stripes = {}
+        # node to the total size of its files
+        self.node_bytes = {}
+
+        # directory name ('' is the root) to its entries, files and
+        # directories alike, as a dict of base name -> None so adding one
+        # is O(1). Directories are created as files appear in them, or by
+        # mkdir
+        self.dirs = {'': {}}
+        # directory name to its entries sorted, for paging through them.
+        # Dropped on change, rebuilt by the next listing
+        self.listings = {}
+
+        # 'local' keeps new files on the node creating them, 'ring' places
+        # them on the consistent hash ring
+        self.placement = placement
+        self.ring = ConsistentHashManager(2 ** 32, vnodes)
+        # copies kept of every new file
+        self.replicas = replicas
+        # bumped whenever a node joins or leaves
+        self.epoch = 0
+
+        # mutations are logged here once open_log has been called
+        self.wal = None
+        # set while a batch logs itself as a single record
+        self.batching = False
+
+    def log(self, *record):
+        '''Called with the lock held, buffers a mutation in the write-ahead
+           log. Pass the result to sync() once the lock is released'''
+        if self.wal is not None and not self.batching:
+            return self.wal.write(record)
+
+    def sync(self, seq):
+        '''Waits until a logged mutation is durable'''
+        if seq:
+            self.wal.sync(seq)
+
+    def index(self, file_name, node, size):
+        '''Called with the lock held'''
+        self.node_files.setdefault(node, set()).add(file_name)
+        self.node_bytes[node] = self.node_bytes.get(node, 0) + size
+
+    def unindex(self, file_name, node, size):
+        '''Called with the lock held'''
+        files = self.node_files.get(node)
+        if files is not None:
+            files.discard(file_name)
+            self.node_bytes[node] -= size
+
+    def link(self, name):
+        '''Called with the lock held. Enters name in its directory, creating
+           the missing directories above it. False if a file is in the way'''
+        parent, base = split(name)
+        entries = self.dirs.get(parent)
+        if entries is None:
+            if parent in self.file_dict or not self.link(parent):
+                return False
+            entries = self.dirs[parent] = {}
+
+        entries[base] = None
+        self.listings.pop(parent, None)
+        return True
+
+    def unlink(self, name):
+        '''Called with the lock held'''
+        parent, base = split(name)
+        entries = self.dirs.get(parent)
+        if entries is not None:
+            entries.pop(base, None)
+            self.listings.pop(parent, None)
+
+    def add_file(self, file_name, node, size=0, replicas=(), stripe=0):
+        '''Registers file_name on node, and on the other replicas given. A
+           stripe size makes it a striped file, whose data is split into
+           chunks of that many bytes'''
+        with self.lock:
+            if file_name in self.file_dict or file_name in self.dirs:
+                return False
+            if not self.link(file_name):
+                return False
+
+            nodes = (node,) + tuple(r for r in replicas if r != node)
+            self.file_dict[file_name] = nodes
+            self.file_sizes[file_name] = size
+            for n in nodes:
+                self.index(file_name, n, size)
+            if stripe:
+                self.stripes[file_name] = (stripe, [])
+            seq = self.log('add_file', file_name, node, size, nodes, stripe)
+
+        self.sync(seq)
+        return True
+
+    def add_files(self, node, files, sizes):
+        '''Registers the files node reports holding, adding it to the
+           replica set of the ones that already exist. Returns those, the
+           files node doesn't hold alone'''
+        shared = []
+        with self.lock:
+            self.batching = True
+            try:
+                for file_name, size in zip(files, sizes):
+                    if not self.add_file(file_name, node, size):
+                        # a (re)joining replica holder
+                        self.add_replica(file_name, node)
+                        shared.append(file_name)
+            finally:
+                self.batching = False
+            seq = self.log('add_files', node, files, sizes)
+
+        self.sync(seq)
+        return shared
+
+    def add_replica(self, file_name, node):
+        '''Registers node as holding a copy of an existing file, while its
+           replica set is short of the target'''
+        with self.lock:
+            nodes = self.file_dict.get(file_name)
+            if nodes is None or node in nodes or len(nodes) >= self.replicas:
+                return False
+
+            self.file_dict[file_name] = nodes + (node,)
+            self.index(file_name, node, self.file_sizes.get(file_name, 0))
+            seq = self.log('add_replica', file_name, node)
+
+        self.sync(seq)
         return True
 
     def remove_file(self, file_name):
-        if file_name in self.file_dict:
-            del self.file_dict[file_name]
+        with self.lock:
+            nodes = self.file_dict.pop(file_name, None)
+            if nodes is None:
+                return
+
+            size = self.file_sizes.pop(file_name, 0)
+            for node in nodes:
+                self.unindex(file_name, node, size)
+            self.stripes.pop(file_name, None)
+            self.unlink(file_name)
+            seq = self.log('remove_file', file_name)
+
+        self.sync(seq)
+
+    def set_file_size(self, file_name, size):
+        with self.lock:
+            nodes = self.file_dict.get(file_name)
+            if nodes is None:
+                return False
+
+            old = self.file_sizes.get(file_name, 0)
+            if size == old:
+                # every replica reports it
+                return True
+            self.file_sizes[file_name] = size
+            for node in nodes:
+                self.node_bytes[node] = self.node_bytes.get(node, 0) + size - old
+            seq = self.log('set_file_size', file_name, size)
+
+        self.sync(seq)
+        return True
 
-    def get_files_list(self):
-        return list(self.file_dict.keys()) + ['.', '..']
+    def mkdir(self, name):
+        '''Creates directory name. Returns None, or the reply saying why not'''
+        with self.lock:
+            if name in self.dirs or name in self.file_dict:
+                return 'FILE_ALREADY_EXISTS'
+            error = self.check_parent(name)
+            if error:
+                return error
+
+            self.link(name)
+            self.dirs[name] = {}
+            seq = self.log('mkdir', name)
+
+        self.sync(seq)
+
+    def rmdir(self, name):
+        '''Removes the empty directory name. Returns None, or the reply
+           saying why not'''
+        with self.lock:
+            entries = self.dirs.get(name)
+            if entries is None:
+                return 'NOT_DIR' if name in self.file_dict else 'FILE_NOT_FOUND'
+            if not name:
+                return 'INVALID'
+            if entries:
+                return 'NOT_EMPTY'
+
+            del self.dirs[name]
+            self.listings.pop(name, None)
+            self.unlink(name)
+            seq = self.log('rmdir', name)
+
+        self.sync(seq)
+
+    def check_parent(self, name):
+        '''Called with the lock held, the reply saying why name can't be
+           created in its directory, or None'''
+        parent = split(name)[0]
+        if parent not in self.dirs:
+            return 'NOT_DIR' if parent in self.file_dict else 'FILE_NOT_FOUND'
+
+    def tree(self, name):
+        '''Called with the lock held, the directories and the files in and
+           under directory name'''
+        dirs, files = [name], []
+        for directory in dirs:
+            prefix = directory + '/'
+            for base in self.dirs[directory]:
+                child = prefix + base
+                if child in self.dirs:
+                    dirs.append(child)
+                else:
+                    files.append(child)
+        return dirs, files
+
+    def rename(self, old, new):
+        '''Moves a file, or a directory and everything under it, to new.
+           Returns the reply saying why not (or None), the nodes holding
+           data of the moved files and their old names'''
+        with self.lock:
+            if not old or (old not in self.file_dict and old not in self.dirs):
+                return 'FILE_NOT_FOUND', [], []
+            if new in self.file_dict or new in self.dirs:
+                return 'FILE_ALREADY_EXISTS', [], []
+            if new.startswith(old + '/'):
+                # into itself
+                return 'INVALID', [], []
+            error = self.check_parent(new)
+            if error:
+                return error, [], []
+
+            if old in self.dirs:
+                dirs, files = self.tree(old)
+            else:
+                dirs, files = [], [old]
+
+            nodes = set()
+            self.unlink(old)
+            for file_name in files:
+                moved = new + file_name[len(old):]
+                holders = self.file_dict.pop(file_name)
+                self.file_dict[moved] = holders
+                self.file_sizes[moved] = self.file_sizes.pop(file_name, 0)
+                for node in holders:
+                    self.node_files[node].discard(file_name)
+                    self.node_files[node].add(moved)
+                nodes.update(holders)
+
+                stripe = self.stripes.pop(file_name, None)
+                if stripe is not None:
+                    self.stripes[moved] = stripe
+                    nodes.update(chain.from_iterable(stripe[1]))
+
+            for directory in dirs:
+                self.dirs[new + directory[len(old):]] = self.dirs.pop(directory)
+                self.listings.pop(directory, None)
+            self.link(new)
+            seq = self.log('rename', old, new)
+
+        self.sync(seq)
+        return None, list(nodes), files
+
+    def is_dir(self, file_name):
+        with self.lock:
+            return file_name[1:] in self.dirs
+
+    def list_dir(self, file_name, cursor=None, limit=1000):
+        '''Returns a page of up to limit entries of a directory, after the
+           one named cursor, and the cursor for the next page (None after
+           the last). Entries are [name, [[addr, port], ...]] for files,
+           with the chunk size as a third element for striped ones, and
+           [name, None] for directories. None if it isn't a directory'''
+        name = file_name[1:]
+        with self.lock:
+            entries = self.dirs.get(name)
+            if entries is None:
+                return None
+
+            listing = self.listings.get(name)
+            if listing is None:
+                listing = self.listings[name] = sorted(entries)
+
+            start = bisect.bisect_right(listing, cursor) if cursor else 0
+            page = listing[start:start + limit]
+
+            prefix = name + '/' if name else ''
+            result = []
+            for base in page:
+                nodes = self.file_dict.get(prefix + base)
+                if nodes is None:
+                    result.append([base, None])
+                    continue
+
+                entry = [base, [list(node) for node in nodes]]
+                stripe = self.stripes.get(prefix + base)
+                if stripe:
+                    entry.append(stripe[0])
+                result.append(entry)
+
+            more = start + limit < len(listing)
+            return result, page[-1] if more else None
 
     def get_file_location(self, file_name):
-        return self.file_dict.get(file_name[1:], None)
+        nodes = self.file_dict.get(file_name[1:], None)
+        return nodes[0] if nodes else None
+
+    def get_replicas(self, file_name):
+        return self.file_dict.get(file_name[1:], ())
+
+    def get_stripe(self, file_name):
+        '''Returns (chunk size, [nodes of every chunk]) of a striped file,
+           None for any other'''
+        with self.lock:
+            stripe = self.stripes.get(file_name[1:])
+            return stripe and (stripe[0], list(stripe[1]))
+
+    def place_chunks(self, file_name, count):
+        '''Grows the chunk map of a striped file to count chunks, placing
+           the replicas of every chunk on the ring by itself. Returns
+           get_stripe()'''
+        with self.lock:
+            stripe = self.stripes.get(file_name)
+            if stripe is None:
+                return None
+
+            chunks = stripe[1]
+            if len(chunks) >= count:
+                return stripe[0], list(chunks)
+
+            for i in range(len(chunks), count):
+                if len(self.ring):
+                    chunks.append(tuple(self.ring.get_nodes(f'{file_name}#{i}', self.replicas)))
+                else:
+                    chunks.append(self.file_dict[file_name][:1])
+            seq = self.log('place_chunks', file_name, count)
+            stripe = stripe[0], list(chunks)
+
+        self.sync(seq)
+        return stripe
+
+    def truncate_chunks(self, file_name, count):
+        '''Shrinks the chunk map of a striped file to count chunks'''
+        with self.lock:
+            stripe = self.stripes.get(file_name)
+            if stripe is None or len(stripe[1]) <= count:
+                return
+            del stripe[1][count:]
+            seq = self.log('truncate_chunks', file_name, count)
+
+        self.sync(seq)
+
+    def get_nodes(self):
+        with self.lock:
+            return list(self.nodes)
+
+    def node_stats(self):
+        '''Per node file count and bytes'''
+        with self.lock:
+            return [{
+                'addr': node.addr,
+                'port': node.port,
+                'files': len(self.node_files.get(node, ())),
+                'bytes': self.node_bytes.get(node, 0),
+            } for node in self.nodes]
+
+    def summary(self):
+        '''Sizes of the metadata, for STATS'''
+        with self.lock:
+            return {
+                'epoch': self.epoch,
+                'nodes': len(self.nodes),
+                'files': len(self.file_dict),
+                'dirs': len(self.dirs) - 1,
+                'striped': len(self.stripes),
+                'wal_records': self.wal.records if self.wal else None,
+            }
+
+    def place_file(self, file_name, client_node):
+        '''Picks the replica set a new file is created on, primary first'''
+        with self.lock:
+            if self.placement == 'ring' and len(self.ring):
+                return self.ring.get_nodes(file_name, self.replicas)
+
+            others = [node for node in self.ring.get_nodes(file_name, self.replicas + 1)
+                      if node != client_node]
+            return [client_node] + others[:self.replicas - 1]
+
+    def membership(self):
+        '''Returns the epoch and the live nodes'''
+        with self.lock:
+            return self.epoch, list(self.nodes)
+
+    def is_member(self, node):
+        with self.lock:
+            return node in self.nodes
+
+    def add_client(self, node, weight=1):
+        with self.lock:
+            if node in self.nodes:
+                return False
 
-    def add_client(self, node):
-        if node in self.nodes:
-            return False
-        else:
             self.nodes.add(node)
-            return True
+            self.weights[node] = weight
+            self.ring.add_client(node, weight)
+            self.epoch += 1
+            seq = self.log('add_client', node, weight)
+
+        self.sync(seq)
+        return True
 
     def remove_client(self, node):
-        if node in self.nodes:
+        '''Removes node from the replica sets it was in, O(files on node)
+           and O(striped files). Files left without any replica, or with a
+           chunk without any, are removed'''
+        with self.lock:
+            if node not in self.nodes:
+                return
+
             self.nodes.remove(node)
+            self.weights.pop(node, None)
+            self.ring.remove_node(node)
+            self.epoch += 1
+
+            for file in self.node_files.pop(node, ()):
+                nodes = tuple(n for n in self.file_dict[file] if n != node)
+                if nodes:
+                    self.file_dict[file] = nodes
+                else:
+                    del self.file_dict[file]
+                    self.file_sizes.pop(file, None)
+                    self.stripes.pop(file, None)
+                    # or it would be listed as a directory
+                    self.unlink(file)
+            self.node_bytes.pop(node, None)
+
+            lost = []
+            for file, (_, chunks) in self.stripes.items():
+                if any(node in holders for holders in chunks):
+                    chunks[:] = [tuple(n for n in holders if n != node) for holders in chunks]
+                    if not all(chunks):
+                        lost.append(file)
+
+            self.batching = True
+            try:
+                for file in lost:
+                    self.remove_file(file)
+            finally:
+                self.batching = False
+            seq = self.log('remove_client', node)
+
+        self.sync(seq)
+
+    def plan_moves(self, limit=None):
+        '''Returns up to limit (file name, holders, dest) copies needed to
+           give every file the replica set the ring wants'''
+        with self.lock:
+            files = list(self.file_dict)
+
+        moves = []
+        for file in files:
+            # a file at a time, so handler threads aren't held up
+            with self.lock:
+                nodes = self.file_dict.get(file)
+                if not nodes or not len(self.ring):
+                    continue
+
+                for dest in self.ring.get_nodes(file, self.replicas):
+                    if dest not in nodes:
+                        moves.append((file, nodes, dest))
+                        break
+
+            if limit and len(moves) >= limit:
+                break
 
-            node_files = [file for file, fnode in self.file_dict.items() if fnode == node]
-            for file in node_files:
-                self.remove_file(file)
+        return moves
+
+    def commit_move(self, file_name, dest):
+        '''Adds dest, which now holds a copy, to the replica set of
+           file_name. Returns False if the file or dest went away'''
+        with self.lock:
+            nodes = self.file_dict.get(file_name)
+            if nodes is None or dest not in self.nodes:
+                return False
+
+            if dest in nodes:
+                return True
+
+            self.file_dict[file_name] = nodes + (dest,)
+            self.index(file_name, dest, self.file_sizes.get(file_name, 0))
+            seq = self.log('commit_move', file_name, dest)
+
+        self.sync(seq)
+        return True
+
+    def trim_replicas(self, file_name):
+        '''Shrinks the replica set of file_name back to the target, keeping
+           the nodes the ring wants (in ring order). Returns the dropped
+           nodes, whose copies can be deleted'''
+        with self.lock:
+            nodes = self.file_dict.get(file_name)
+            if nodes is None or len(nodes) <= self.replicas:
+                return []
+
+            keep = [node for node in self.ring.get_nodes(file_name, self.replicas)
+                    if node in nodes]
+            for node in nodes:
+                if len(keep) >= self.replicas:
+                    break
+                if node not in keep:
+                    keep.append(node)
+
+            dropped = [node for node in nodes if node not in keep]
+            size = self.file_sizes.get(file_name, 0)
+            for node in dropped:
+                self.unindex(file_name, node, size)
+
+            self.file_dict[file_name] = tuple(keep)
+            seq = self.log('trim_replicas', file_name)
+
+        self.sync(seq)
+        return dropped
+
+    def drop_replica(self, file_name, node, chunk=None):
+        '''Takes node, whose copy of file_name (or of chunk of the striped
+           file_name) missed an update, out of its replica set. Returns
+           False if node wasn't in it or held the last copy'''
+        with self.lock:
+            if chunk is None:
+                nodes = self.file_dict.get(file_name)
+            else:
+                stripe = self.stripes.get(file_name)
+                nodes = stripe[1][chunk] if stripe and chunk < len(stripe[1]) else None
+            if nodes is None or node not in nodes or len(nodes) == 1:
+                return False
+
+            nodes = tuple(n for n in nodes if n != node)
+            if chunk is None:
+                self.unindex(file_name, node, self.file_sizes.get(file_name, 0))
+                self.file_dict[file_name] = nodes
+            else:
+                stripe[1][chunk] = nodes
+            seq = self.log('drop_replica', file_name, node, chunk)
+
+        self.sync(seq)
+        return True
+
+    def apply(self, record):
+        '''Replays a mutation from the log'''
+        op, args = record[0], record[1:]
+
+        if op == 'add_client':
+            self.add_client(Node(*args[0]), args[1])
+
+        elif op == 'remove_client':
+            self.remove_client(Node(*args[0]))
+
+        elif op == 'add_file':
+            name, node, size, nodes, stripe = args
+            self.add_file(name, Node(*node), size, [Node(*n) for n in nodes], stripe)
+
+        elif op == 'place_chunks':
+            self.place_chunks(*args)
+
+        elif op == 'truncate_chunks':
+            self.truncate_chunks(*args)
+
+        elif op == 'add_files':
+            node, files, sizes = args
+            self.add_files(Node(*node), files, sizes)
+
+        elif op == 'add_replica':
+            self.add_replica(args[0], Node(*args[1]))
+
+        elif op == 'remove_file':
+            self.remove_file(args[0])
+
+        elif op == 'set_file_size':
+            self.set_file_size(*args)
+
+        elif op == 'commit_move':
+            self.commit_move(args[0], Node(*args[1]))
+
+        elif op == 'trim_replicas':
+            self.trim_replicas(args[0])
+
+        elif op == 'drop_replica':
+            self.drop_replica(args[0], Node(*args[1]), *args[2:])
+
+        elif op == 'mkdir':
+            self.mkdir(args[0])
+
+        elif op == 'rmdir':
+            self.rmdir(args[0])
+
+        elif op == 'rename':
+            self.rename(*args)
+
+        else:
+            raise ValueError(f'unknown log record {op}')
+
+    def copy_state(self):
+        '''Called with the lock held, shallow copies for dump()'''
+        stripes = dict((name, (size, list(chunks))) for name, (size, chunks) in self.stripes.items())
+        return (self.epoch, dict(self.weights), dict(self.file_dict),
+                dict(self.file_sizes), stripes, list(self.dirs))
+
+    def dump(self, state=None):
+        '''Returns the state (or copy_state() taken earlier) in snapshot
+           form. Only the copies are made under the lock.
+
+           Files are grouped by replica set and their names joined into one
+           string, so load() can rebuild the maps with bulk dict and set
+           operations rather than a Python loop per file'''
+        if state is None:
+            with self.lock:
+                state = self.copy_state()
+        epoch, weights, file_dict, file_sizes, stripes, dirs = state
+
+        # replica set -> names of the files it holds
+        groups = {}
+        for name, nodes in file_dict.items():
+            group = groups.get(nodes)
+            if group is None:
+                group = groups[nodes] = []
+            group.append(name)
+
+        # every node gets a number, groups refer to their holders by it
+        holders = dict((node, i) for i, node in enumerate(weights))
+        for nodes in groups:
+            for node in nodes:
+                holders.setdefault(node, len(holders))
+        for _, chunks in stripes.values():
+            for node in chain.from_iterable(chunks):
+                holders.setdefault(node, len(holders))
+
+        names = []
+        for group in groups.values():
+            names.extend(group)
+
+        return {
+            'epoch': epoch,
+            'holders': list(holders),
+            'members': [[holders[node], weight] for node, weight in weights.items()],
+            # [file count, holder, ...] in the order of names
+            'groups': [[len(group)] + [holders[node] for node in nodes]
+                       for nodes, group in groups.items()],
+            # NUL can't appear in a file name
+            'names': '\0'.join(names),
+            'sizes': [file_sizes.get(name, 0) for name in names],
+            'stripes': [[name, size, [[holders[node] for node in nodes] for nodes in chunks]]
+                        for name, (size, chunks) in stripes.items()],
+            # the entries of every directory are the names in it
+            'dirs': [name for name in dirs if name],
+        }
+
+    def load(self, state):
+        '''Replaces the state with a snapshot from dump()'''
+        holders = [Node(*node) for node in state['holders']]
+        names = state['names'].split('\0') if state['names'] else []
+        sizes = state['sizes']
+
+        with self.lock:
+            self.nodes = set()
+            self.weights = {}
+            self.ring = ConsistentHashManager(self.ring.range, self.ring.vnodes)
+            for i, weight in state['members']:
+                self.nodes.add(holders[i])
+                self.weights[holders[i]] = weight
+                self.ring.add_client(holders[i], weight)
+
+            self.file_dict = {}
+            self.file_sizes = dict(zip(names, sizes))
+            self.node_files = {}
+            self.node_bytes = {}
+
+            start = 0
+            for count, *group in state['groups']:
+                nodes = tuple(holders[i] for i in group)
+                files = names[start:start + count]
+                total = sum(sizes[start:start + count])
+                start += count
+
+                self.file_dict.update(zip(files, repeat(nodes)))
+                for node in nodes:
+                    self.node_files.setdefault(node, set()).update(files)
+                    self.node_bytes[node] = self.node_bytes.get(node, 0) + total
+
+            self.stripes = dict((name, (size, [tuple(holders[i] for i in nodes) for nodes in chunks]))
+                                for name, size, chunks in state['stripes'])
+
+            self.dirs = {'': {}}
+            self.listings = {}
+            for name in state['dirs']:
+                self.dirs[name] = {}
+            for name in chain(state['dirs'], names):
+                parent, _, base = name.rpartition('/')
+                self.dirs[parent][base] = None
+            self.epoch = state['epoch']
+
+    def open_log(self, directory, sync_interval=0):
+        '''Restores the state from the snapshot and log in directory, then
+           logs every mutation there'''
+        wal = WriteAheadLog(directory, sync_interval)
+
+        # millions of new objects, none of them in cycles. Collections
+        # triggered along the way would rescan all of them
+        gc.disable()
+        try:
+            state = read_snapshot(directory)
+            if state is not None:
+                self.load(state)
+
+            for record in wal.replay(state['segment'] if state else 0):
+                self.apply(record)
+        finally:
+            gc.enable()
+
+        self.wal = wal
+
+    def checkpoint(self):
+        '''Snapshots the state and deletes the log segments it covers'''
+        with self.lock:
+            # the snapshot holds exactly the mutations before the rotation
+            segment = self.wal.rotate()
+            state = self.copy_state()
+
+        state = self.dump(state)
+        state['segment'] = segment
+        write_snapshot(self.wal.directory, state)
+        self.wal.retire(segment)
 
 
 base_mgr = BaseProtocolManager()
+pool = ConnectionPool()
+# set when started with --rebalance
+rebalancer = None
+# most directory entries sent in one LIST_DIR(_PLUS) reply
+LIST_PAGE = 1000
+# fed by HEARTBEAT, nodes that never send one are never suspected
+detector = PhiAccrualDetector()
+# request latencies, answered to STATS
+stats = Stats()
+stats.register('metadata', lambda: base_mgr.summary())
+# who caches the location of which path, invalidations only go to them.
+# None (--lease-time 0) pushes every invalidation to every node
+leases = LeaseTable(30.0)
+stats.register('leases', lambda: {'paths': len(leases) if leases is not None else 0})
+
+
+def send_message(node, json):
+    json['port'] = PORT
+
+    return pool.request(node, json)
+
+
+def push(json, exclude=None, nodes=None):
+    '''Sends json to nodes (every live node by default) except exclude,
+       failures are ignored (the receiving cache entries expire anyway)'''
+    for node in base_mgr.get_nodes() if nodes is None else nodes:
+        if node == exclude:
+            continue
+        try:
+            send_message(node, dict(json))
+        except Exception:
+            pass
+
+
+def grant(resp, client_node, paths):
+    '''Grants client_node leases on paths, whose locations resp tells it,
+       and tells it for how long it may cache them'''
+    if leases is not None:
+        for path in paths:
+            leases.grant(path, client_node)
+        resp['lease'] = leases.duration
+    return resp
+
+
+def call_back(files, exclude=None, holders=()):
+    '''Has the nodes caching the locations of files (except exclude, who
+       changed them) forget them, by INVALIDATE_LOC. holders, the nodes
+       with data of the files, always hear of it: they keep track of the
+       files only they hold'''
+    nodes = None
+    if leases is not None:
+        nodes = set(holders)
+        for path in files:
+            nodes.update(leases.revoke(path, exclude))
+        if not nodes - {exclude}:
+            return
+
+    push({
+        'command': 'INVALIDATE_LOC',
+        'files': files,
+    }, exclude, nodes)
+
+
+def membership_changed():
+    '''Pushes the new member list to every node in the background, so
+       clients stop trying dead nodes without waiting for a timeout'''
+    epoch, nodes = base_mgr.membership()
+    threading.Thread(target=push, args=({
+        'command': 'MEMBERSHIP',
+        'epoch': epoch,
+        'nodes': nodes,
+    },), daemon=True).start()
+
+    if rebalancer:
+        rebalancer.kick()
+
+
+def node_died(node):
+    base_mgr.remove_client(node)
+    detector.remove(node)
+    pool.discard(node)
+    log.warning('%s died', node)
+    membership_changed()
+
+
+def checkpoint_log(period):
+    '''Snapshots the metadata every period seconds it has changed, keeping
+       the log (and so restarts) short'''
+    while True:
+        sleep(period)
+        if base_mgr.wal.records:
+            start = time()
+            try:
+                base_mgr.checkpoint()
+            except Exception:
+                # segments are only deleted once a snapshot covers them,
+                # the next checkpoint covers these too
+                log.exception('checkpoint failed')
+                continue
+            log.info('checkpoint took %.3fs', time() - start)
+
+
+def watch_nodes(period):
+    '''Declares nodes dead once the detector suspects them'''
+    while True:
+        sleep(period)
+        for node in detector.suspects():
+            node_died(node)
+
+
+class Rebalancer():
+    '''Background thread moving copies of files to the nodes the hash ring
+       wants after nodes join or leave. The new holder pulls one file at a
+       time at a throttled rate and checks it against the source. Ownership
+       then switches in two steps: the new holder joins the replica set, so
+       new writes reach it. Only once both copies match again are the extra
+       holders dropped'''
+    def __init__(self, mgr, rate=0, delay=1.0, retry=30.0, batch=64, attempts=3):
+        self.mgr = mgr
+        # bytes per second a copy is pulled at, 0 is unlimited
+        self.rate = rate
+        # seconds to let membership settle before planning
+        self.delay = delay
+        # seconds before moves that failed are tried again
+        self.retry = retry
+        # moves planned at a time
+        self.batch = batch
+        # checksum comparisons of a file before giving up on the copies
+        # matching, dest pulls a fresh copy after every one that differs
+        self.attempts = attempts
+
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def kick(self):
+        '''Membership changed'''
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.retry)
+            sleep(self.delay)
+            self.wakeup.clear()
+
+            while not self.wakeup.is_set():
+                moves = self.mgr.plan_moves(self.batch)
+                moved = 0
+                for move in moves:
+                    if self.wakeup.is_set():
+                        # replan for the new membership
+                        break
+                    try:
+                        moved += self.move(*move)
+                    except Exception as e:
+                        log.warning('moving %s to %s failed: %s', move[0], move[2], e)
+
+                if not moved:
+                    break
+
+    def fetch(self, file, holders, dest):
+        '''Has dest pull a verified copy of file from one of holders'''
+        for source in holders:
+            resp = send_message(dest, {
+                'command': 'FETCH',
+                'path': '/' + file,
+                'source': source,
+                'rate': self.rate,
+            })
+            if resp['reply'] == 'ACK_FETCH':
+                return source
+        return None
+
+    def checksum(self, node, file):
+        resp = send_message(node, {
+            'command': 'CHECKSUM',
+            'path': '/' + file,
+        })
+        return resp.get('digest')
+
+    def move(self, file, holders, dest):
+        source = self.fetch(file, holders, dest)
+        if source is None:
+            return False
 
+        if not self.mgr.commit_move(file, dest):
+            # removed (or dest left) while we were copying
+            return False
 
-class BootstrapHandler(RequestHandler):
-    def __send_message(self, node, json):
-        global PORT
+        # clients pick up the new replica set before we compare
+        call_back(['/' + file], holders=list(holders) + [dest])
 
-        json['port'] = PORT
+        # writes that only reached the old holders while dest was copying
+        for attempt in range(1, self.attempts + 1):
+            digest = self.checksum(source, file)
+            if digest is not None and digest == self.checksum(dest, file):
+                break
+            if attempt == self.attempts or self.fetch(file, [source], dest) is None:
+                # stay over replicated until the next pass
+                return False
+
+        dropped = self.mgr.trim_replicas(file)
+        if dropped:
+            call_back(['/' + file], holders=list(self.mgr.get_replicas('/' + file)) + dropped)
+
+        for node in dropped:
+            try:
+                send_message(node, {
+                    'command': 'UNLINK',
+                    'path': '/' + file,
+                })
+            except Exception:
+                pass
+
+        log.info('moved %s to %s', file, dest)
+        return True
 
-        with socket.socket() as s:
-            s.connect(node)
-            s.sendall(Message.build(json))
 
-            resp_len = s.recv(4)
-            resp_data = s.recv(Message.parse_length(resp_len))
+class BootstrapHandler(RequestHandler):
+    def __send_message(self, node, json):
+        return send_message(node, json)
 
-            return Message.parse(resp_len + resp_data)
+    def notify_nodes(self, files, exclude=None, holders=()):
+        '''call_back() in the background'''
+        threading.Thread(target=call_back, args=(files, exclude, holders), daemon=True).start()
 
     def process_msg(self, msg, client_node):
         cmd = msg.get('command')
 
         if cmd == 'JOIN':
-            return self.join(client_node)
+            return self.join(msg, client_node)
 
         elif cmd == 'FILES_ADD':
             return self.add_files(msg, client_node)
@@ -161,11 +1142,38 @@ class BootstrapHandler(RequestHandler):
         elif cmd == 'FILE_REMOVE':
             return self.remove_file(msg, client_node)
 
+        elif cmd == 'PLACE_FILE':
+            return self.place_file(msg, client_node)
+
         elif cmd == 'GET_FILE_LOC':
-            return self.get_file_loc(msg)
+            return self.get_file_loc(msg, client_node)
+
+        elif cmd == 'PLACE_CHUNKS':
+            return self.place_chunks(msg, client_node)
+
+        elif cmd == 'TRUNCATE_CHUNKS':
+            return self.truncate_chunks(msg, client_node)
 
         elif cmd == 'LIST_DIR':
-            return self.list_dir()
+            return self.list_dir(msg)
+
+        elif cmd == 'LIST_DIR_PLUS':
+            return self.list_dir_plus(msg, client_node)
+
+        elif cmd == 'MKDIR':
+            return self.mkdir(msg)
+
+        elif cmd == 'RMDIR':
+            return self.rmdir(msg)
+
+        elif cmd == 'RENAME':
+            return self.rename(msg, client_node)
+
+        elif cmd == 'FILE_SIZE':
+            return self.file_size(msg)
+
+        elif cmd == 'NODE_STATS':
+            return self.node_stats()
 
         elif cmd == 'LEAVE':
             return self.leave(client_node)
@@ -173,12 +1181,22 @@ class BootstrapHandler(RequestHandler):
         elif cmd == 'MISSING_NODE':
             return self.missing_node(msg)
 
+        elif cmd == 'STALE_REPLICA':
+            return self.stale_replica(msg)
+
+        elif cmd == 'HEARTBEAT':
+            return self.heartbeat(msg, client_node)
+
+        elif cmd == 'STATS':
+            return self.stats()
+
         else:
-            print(f'Unknown command: {cmd}')
+            log.warning('unknown command: %s', cmd)
 
-    def join(self, client_node):
-        if base_mgr.add_client(client_node):
-            print(f'{client_node} joined')
+    def join(self, msg, client_node):
+        if base_mgr.add_client(client_node, msg.get('weight', 1)):
+            log.info('%s joined', client_node)
+            membership_changed()
             return {
                 'reply': 'ACK_JOIN',
                 'local_addr': client_node.addr,
@@ -186,31 +1204,41 @@ class BootstrapHandler(RequestHandler):
             }
 
         else:
-            print(f'{client_node} failed to join')
+            log.warning('%s failed to join', client_node)
             return {
                 'reply': 'JOIN_FAILED',
             }
 
     def add_files(self, msg, client_node):
         files_list = msg.get('files')
+        sizes = msg.get('sizes') or [0] * len(files_list or [])
 
         # shouldn't expect any problems for now
+        shared = []
         if files_list:
-            for f in files_list:
-                base_mgr.add_file(f, client_node)
+            shared = base_mgr.add_files(client_node, files_list, sizes)
+
+        if shared:
+            # their replica sets grew
+            files = ['/' + f for f in shared]
+            self.notify_nodes(files, client_node,
+                              set(chain.from_iterable(map(base_mgr.get_replicas, files))))
 
-        print(f'{client_node} added {len(files_list)} files')
+        log.info('%s added %d files', client_node, len(files_list))
         return {
             'reply': 'ACK_ADD',
+            'shared': shared,
         }
 
     def add_file(self, msg, client_node):
         filename = msg['path'][1:]
-        if base_mgr.add_file(filename, client_node):
-            print(f'{client_node} added {filename}')
-            return {
+        replicas = [Node(*node) for node in msg.get('replicas', [])]
+        owner = replicas[0] if replicas else client_node
+        if base_mgr.add_file(filename, owner, msg.get('size', 0), replicas, msg.get('stripe', 0)):
+            log.debug('%s added %s', client_node, filename)
+            return grant({
                 'reply': 'ACK_ADD',
-            }
+            }, client_node, [msg['path']])
         else:
             return {
                 'reply': 'FILE_ALREADY_EXISTS'
@@ -218,42 +1246,225 @@ class BootstrapHandler(RequestHandler):
 
     def remove_file(self, msg, client_node):
         filename = msg['path'][1:]
+        holders = base_mgr.get_replicas(msg['path'])
         base_mgr.remove_file(filename)
-        print(f'{client_node} removed {filename}')
+        log.debug('%s removed %s', client_node, filename)
+
+        self.notify_nodes([msg['path']], client_node, holders)
 
         return {
             'reply': 'ACK_RM',
         }
 
-    def get_file_loc(self, msg):
-        node = base_mgr.get_file_location(msg['file'])
-        if node == None:
+    def place_file(self, msg, client_node):
+        nodes = base_mgr.place_file(msg['path'][1:], client_node)
+
+        return {
+            'reply': 'ACK_PLACE_FILE',
+            'addr': nodes[0].addr,
+            'port': nodes[0].port,
+            'replicas': nodes,
+        }
+
+    def get_file_loc(self, msg, client_node):
+        nodes = base_mgr.get_replicas(msg['file'])
+        if not nodes:
+            if base_mgr.is_dir(msg['file']):
+                return grant({
+                    'reply': 'IS_DIR',
+                }, client_node, [msg['file']])
             return {
                 'reply': 'FILE_NOT_FOUND'
             }
 
-        return {
+        resp = {
             'reply': 'ACK_GET_FILE_LOC',
-            'addr': node.addr,
-            'port': node.port,
+            'addr': nodes[0].addr,
+            'port': nodes[0].port,
+            'replicas': nodes,
         }
 
-    def list_dir(self):
+        stripe = base_mgr.get_stripe(msg['file'])
+        if stripe:
+            resp['stripe'] = {
+                'size': stripe[0],
+                'chunks': stripe[1],
+            }
+        return grant(resp, client_node, [msg['file']])
+
+    def place_chunks(self, msg, client_node):
+        stripe = base_mgr.place_chunks(msg['path'][1:], msg['count'])
+        if stripe is None:
+            return {
+                'reply': 'FILE_NOT_FOUND'
+            }
+
+        # the others' cached stripes are short now
+        self.notify_nodes([msg['path']], client_node)
+        return grant({
+            'reply': 'ACK_PLACE_CHUNKS',
+            'stripe': {
+                'size': stripe[0],
+                'chunks': stripe[1],
+            },
+        }, client_node, [msg['path']])
+
+    def truncate_chunks(self, msg, client_node):
+        base_mgr.truncate_chunks(msg['path'][1:], msg['count'])
+        self.notify_nodes([msg['path']], client_node)
+        return grant({
+            'reply': 'ACK_TRUNCATE_CHUNKS',
+        }, client_node, [msg['path']])
+
+    def file_size(self, msg):
+        base_mgr.set_file_size(msg['path'][1:], msg['size'])
+        return {
+            'reply': 'ACK_FILE_SIZE',
+        }
+
+    def node_stats(self):
+        return {
+            'reply': 'ACK_NODE_STATS',
+            'nodes': base_mgr.node_stats(),
+        }
+
+    @staticmethod
+    def list_page(msg):
+        '''A page of the directory msg['path'] (the root by default), None
+           if it isn't one'''
+        return base_mgr.list_dir(msg.get('path', '/'), msg.get('cursor'),
+                                 min(msg.get('limit', LIST_PAGE), LIST_PAGE))
+
+    def list_dir(self, msg):
+        page = self.list_page(msg)
+        if page is None:
+            return {
+                'reply': 'NOT_DIR',
+            }
+
+        entries, cursor = page
+        files = [entry[0] for entry in entries]
+        if not msg.get('cursor'):
+            files += ['.', '..']
         return {
             'reply': 'ACK_LS',
-            'files': base_mgr.get_files_list(),
+            'files': files,
+            'cursor': cursor,
+        }
+
+    def list_dir_plus(self, msg, client_node):
+        page = self.list_page(msg)
+        if page is None:
+            return {
+                'reply': 'NOT_DIR',
+            }
+
+        prefix = msg.get('path', '/').rstrip('/') + '/'
+        return grant({
+            'reply': 'ACK_LS_PLUS',
+            'entries': page[0],
+            'cursor': page[1],
+        }, client_node, [prefix + entry[0] for entry in page[0]])
+
+    def mkdir(self, msg):
+        error = base_mgr.mkdir(msg['path'][1:])
+        return {
+            'reply': error or 'ACK_MKDIR',
+        }
+
+    def rmdir(self, msg):
+        error = base_mgr.rmdir(msg['path'][1:])
+        if not error:
+            self.notify_nodes([msg['path']])
+
+        return {
+            'reply': error or 'ACK_RMDIR',
+        }
+
+    def rename(self, msg, client_node):
+        '''Renames in the metadata first, that decides between concurrent
+           renames. Then every node holding data of the moved files renames
+           its copies, and the others forget the old names'''
+        error, nodes, files = base_mgr.rename(msg['path'][1:], msg['new'][1:])
+        if error:
+            return {
+                'reply': error,
+            }
+
+        for node in nodes:
+            try:
+                resp = send_message(node, {
+                    'command': 'RENAME',
+                    'path': msg['path'],
+                    'new': msg['new'],
+                })
+                ok = resp['reply'] == 'ACK_RENAME'
+            except Exception:
+                ok = False
+            if not ok:
+                # its copies stay behind under the old names
+                log.warning('%s failed to rename %s', node, msg['path'])
+
+        files = [msg['path']] + ['/' + f for f in files]
+        self.notify_nodes(files, client_node, nodes)
+
+        log.debug('%s renamed %s to %s', client_node, msg['path'], msg['new'])
+        return {
+            'reply': 'ACK_RENAME',
+            # for the client to forget, like the others did
+            'files': files,
         }
 
     def leave(self, client_node):
         base_mgr.remove_client(client_node)
-        print(f'{client_node} left')
+        detector.remove(client_node)
+        log.info('%s left', client_node)
+        membership_changed()
+
         return {
             'reply': 'ACK_LEAVE',
         }
 
+    def stats(self):
+        return {
+            'reply': 'ACK_STATS',
+            'stats': stats.snapshot(),
+        }
+
+    def heartbeat(self, msg, client_node):
+        if not base_mgr.is_member(client_node):
+            # declared dead while it was unreachable
+            return {
+                'reply': 'REJOIN',
+            }
+
+        detector.heartbeat(client_node)
+
+        epoch, nodes = base_mgr.membership()
+        resp = {
+            'reply': 'ACK_HEARTBEAT',
+            'epoch': epoch,
+        }
+        if msg.get('epoch') != epoch:
+            resp['nodes'] = nodes
+        return resp
+
     def missing_node(self, msg):
         node = Node(msg['maddr'], msg['mport'])
 
+        if node in detector:
+            # one client failing to connect isn't enough against regular
+            # heartbeats, but it is once they are running late
+            if detector.phi(node) < detector.threshold / 2:
+                return {
+                    'reply': 'NODE_ALIVE'
+                }
+
+            node_died(node)
+            return {
+                'reply': 'NODE_DEAD'
+            }
+
         try:
             self.__send_message(node, {
                 'command': 'PING',
@@ -264,15 +1475,46 @@ class BootstrapHandler(RequestHandler):
             }
 
         except:
-            base_mgr.remove_client(node)
-            print(f'{node} died')
+            node_died(node)
             return {
                 'reply': 'NODE_DEAD'
             }
 
 
+    def stale_replica(self, msg):
+        '''A write went ahead without one of the replicas of msg['path'] (or
+           of its chunk msg['chunk']). Its copy can't be read any more, the
+           rebalancer copies a whole file back to it from one that is up to
+           date'''
+        node = Node(msg['maddr'], msg['mport'])
+        chunk = msg.get('chunk')
+        if base_mgr.drop_replica(msg['path'][1:], node, chunk):
+            log.info('%s missed a write to %s', node, msg['path'])
+            if chunk is None:
+                threading.Thread(target=self.drop_copy, args=(msg['path'], node), daemon=True).start()
+            else:
+                # the others' cached stripes still list it
+                self.notify_nodes([msg['path']], holders=[node])
+
+        return {
+            'reply': 'ACK_STALE_REPLICA',
+        }
+
+    @staticmethod
+    def drop_copy(path, node):
+        call_back([path], holders=list(base_mgr.get_replicas(path)) + [node])
+        push({
+            'command': 'UNLINK',
+            'path': path,
+        }, nodes=[node])
+
+        if rebalancer:
+            rebalancer.kick()
+
+
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+    # handler threads live as long as a peer's pooled connection
+    daemon_threads = True
 
 
 if __name__ == "__main__":
@@ -282,17 +1524,62 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--host', type=str, default='localhost', help='IP to serve from')
     parser.add_argument("-p", "--port", type=int, default=8000, help="Port number to listen on (default 8000)")
+    parser.add_argument('--placement', choices=['local', 'ring'], default='local', help='Where new files are created: on the creating node or on the hash ring (default local)')
+    parser.add_argument('--vnodes', type=int, default=100, help='Hash ring points per node of weight 1 (default 100)')
+    parser.add_argument('-r', '--replicas', type=int, default=1, help='Copies kept of every new file (default 1)')
+    parser.add_argument('--rebalance', action='store_true', help='Move copies of files to the nodes the hash ring picks after nodes join or leave')
+    parser.add_argument('--rebalance-rate', type=float, default=8, help='MiB/s each rebalancing copy may use, 0 is unlimited (default 8)')
+    parser.add_argument('--heartbeat-interval', type=float, default=1.0, help='Seconds between node heartbeats the failure detector expects (default 1)')
+    parser.add_argument('--phi-threshold', type=float, default=8.0, help='Suspicion level at which a silent node is declared dead (default 8)')
+    parser.add_argument('-d', '--data-dir', type=str, help='Directory for the metadata log and snapshots, metadata is only kept in memory without it')
+    parser.add_argument('--wal-sync-interval', type=float, default=0, help='Seconds between log fsyncs, mutations no longer wait for them but that many seconds of them can be lost. 0 fsyncs before every reply (default 0)')
+    parser.add_argument('--snapshot-interval', type=float, default=60.0, help='Seconds between metadata snapshots (default 60)')
+    parser.add_argument('--lease-time', type=float, default=30.0, help='Seconds nodes may cache a file location without hearing from us, invalidations only go to the nodes caching it. 0 pushes them to every node (default 30)')
+    parser.add_argument('--server', choices=['threaded', 'asyncio'], default='threaded', help='Thread per connection or asyncio server (default threaded)')
+    parser.add_argument('--workers', type=int, default=32, help='asyncio server request threads (default 32)')
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info', help='Least severe messages logged (default info)')
+    parser.add_argument('--stats-file', type=str, help='Periodically write the STATS reply here as JSON')
+    parser.add_argument('--stats-interval', type=float, default=10.0, help='Seconds between --stats-file writes (default 10)')
     args = parser.parse_args()
 
+    logging.basicConfig(level=args.log_level.upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
     HOST, PORT = args.host, args.port
+    base_mgr = BaseProtocolManager(args.placement, args.vnodes, args.replicas)
+    detector = PhiAccrualDetector(args.phi_threshold, args.heartbeat_interval)
+    leases = LeaseTable(args.lease_time) if args.lease_time else None
+
+    if args.data_dir:
+        start = time()
+        base_mgr.open_log(args.data_dir, args.wal_sync_interval)
+        log.info('restored %d files on %d nodes in %.3fs', len(base_mgr.file_dict), len(base_mgr.nodes), time() - start)
 
-    server = ThreadedTCPServer((HOST, PORT), BootstrapHandler)
+        # nodes that died while we were down never heartbeat again
+        for node in base_mgr.get_nodes():
+            detector.heartbeat(node)
+
+        threading.Thread(target=checkpoint_log, args=(args.snapshot_interval,), daemon=True).start()
+
+    if args.rebalance:
+        rebalancer = Rebalancer(base_mgr, int(args.rebalance_rate * 1024 * 1024))
+
+    threading.Thread(target=watch_nodes, args=(args.heartbeat_interval / 2,), daemon=True).start()
+
+    if args.server == 'asyncio':
+        server = AsyncServer((HOST, PORT), BootstrapHandler, args.workers)
+    else:
+        server = ThreadedTCPServer((HOST, PORT), BootstrapHandler)
     # ip, port = server.server_address
+    server.stats = stats
+
+    if args.stats_file:
+        threading.Thread(target=stats.dump_loop, args=(args.stats_file, args.stats_interval), daemon=True).start()
 
     server_thread = threading.Thread(target=server.serve_forever)
     # server_thread.daemon = True
     server_thread.start()
 
-    print("Bootstrap server started on port: {}".format(PORT))
+    log.info("Bootstrap server started on port: %d", PORT)
 
     # TODO: repl???
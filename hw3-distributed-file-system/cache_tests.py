@@ -0,0 +1,322 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils.cache import LRUCache, StripedLRUCache
+from utils.blockcache import BlockCache
+from utils.writeback import WriteBuffer
+from utils.fdcache import FdCache, StripedFdCache
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(capacity=3, ttl=10)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.put('c', 3)
+        self.cache.get('a')
+        self.cache.put('d', 4)
+
+        self.assertEqual(len(self.cache), 3, 'incorrect length')
+        self.assertNotIn('b', self.cache, 'b should have been evicted')
+        self.assertEqual(self.cache.get('a'), 1, 'recently used entry evicted')
+
+    def test_expiry(self):
+        with mock.patch('utils.cache.monotonic', return_value=100):
+            self.cache.put('a', 1)
+            self.cache.put('b', 2, ttl=60)
+
+        with mock.patch('utils.cache.monotonic', return_value=120):
+            self.assertIsNone(self.cache.get('a'), 'entry should have expired')
+            self.assertEqual(self.cache.get('b'), 2, 'per entry ttl ignored')
+
+    def test_remove_value(self):
+        self.cache.put('a', ('localhost', 8080))
+        self.cache.put('b', ('localhost', 8081))
+        self.cache.put('c', ('localhost', 8080))
+
+        self.assertEqual(self.cache.remove_value(('localhost', 8080)), 2)
+        self.assertEqual(len(self.cache), 1, 'incorrect length')
+
+    def test_hit_ratio(self):
+        self.cache.put('a', 1)
+        self.cache.get('a')
+        self.cache.get('a')
+        self.cache.get('b')
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['hit_ratio'], 2 / 3)
+
+
+class TestStripedLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = StripedLRUCache(capacity=64, stripes=4)
+
+    def test_routing(self):
+        # room for every key in any stripe, string hashes vary by run
+        self.cache = StripedLRUCache(capacity=256, stripes=4)
+        for i in range(50):
+            self.cache.put(f'/f{i}', i)
+        self.assertEqual([self.cache.get(f'/f{i}') for i in range(50)], list(range(50)))
+        self.assertEqual(self.cache.pop('/f7'), 7)
+        self.assertNotIn('/f7', self.cache)
+        self.assertEqual(len(self.cache), 49)
+
+    def test_capacity(self):
+        for i in range(1000):
+            self.cache.put(i, i)
+        self.assertLessEqual(len(self.cache), 64, 'capacity exceeded')
+
+    def test_across_stripes(self):
+        for i in range(20):
+            self.cache.put(i, 'a' if i % 2 else 'b')
+        self.assertEqual(self.cache.remove_value('a'), 10)
+        self.cache.get(0)
+        self.cache.get(1)
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses']), (10, 1, 1))
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_concurrent(self):
+        def work(t):
+            for i in range(2000):
+                self.cache.put((t, i % 16), i)
+                self.cache.get((t, (i + 1) % 16))
+
+        threads = [threading.Thread(target=work, args=(t,)) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.get((0, 15)), 1999)
+
+
+class TestBlockCache(unittest.TestCase):
+    def setUp(self):
+        self.data = bytes(range(256)) * 100
+        self.fetched = []
+        self.cache = BlockCache(self.fetch, block_size=1024, capacity=8192, readahead=2)
+
+    def tearDown(self):
+        self.cache.shutdown()
+
+    def fetch(self, path, offset, size):
+        self.fetched.append(offset)
+        return self.data[offset:offset + size]
+
+    def test_read_spanning_blocks(self):
+        self.assertEqual(self.cache.read('/f', 1500, 1000), self.data[1000:2500])
+        self.assertEqual(self.fetched, [0, 1024, 2048], 'wrong blocks fetched')
+
+        self.cache.read('/f', 10, 1100)
+        self.assertEqual(len(self.fetched), 3, 'cached block fetched again')
+
+    def test_read_past_end(self):
+        self.assertEqual(self.cache.read('/f', 4096, len(self.data) - 10), self.data[-10:])
+
+    def test_sequential_readahead(self):
+        self.cache.read('/f', 1024, 0)
+        self.cache.read('/f', 1024, 1024)
+        self.cache.read('/f', 1024, 2048)
+        self.cache.executor.shutdown(wait=True)
+
+        self.assertIn(3 * 1024, self.fetched, 'next block not read ahead')
+        self.assertEqual(len(self.fetched), len(set(self.fetched)), 'block fetched twice')
+
+    def test_queued_readahead_taken_over(self):
+        queued = []
+        self.cache.executor = mock.Mock(submit=lambda fn, *args: queued.append((fn, args)))
+        self.cache.read('/f', 1024, 0)
+        self.cache.read('/f', 1024, 1024)
+        self.assertEqual(len(queued), 2, 'read ahead not queued')
+
+        # the reader doesn't wait for the busy executor
+        self.assertEqual(self.cache.read('/f', 1024, 2048), self.data[2048:3072])
+        for fn, args in queued:
+            fn(*args)
+        self.assertEqual(sorted(self.fetched), [0, 1024, 2048, 3072, 4096],
+                         'block fetched twice')
+
+    def test_memory_budget(self):
+        self.cache.read('/f', len(self.data), 0)
+        self.assertLessEqual(self.cache.size, 8192, 'budget exceeded')
+
+    def test_invalidate(self):
+        self.cache.read('/f', 100, 0)
+        self.cache.invalidate('/f')
+        self.cache.read('/f', 100, 0)
+        self.assertEqual(self.fetched, [0, 0], 'invalidated block served')
+
+    def test_invalidated_while_fetching(self):
+        fetch = self.cache.fetch
+
+        def changed_meanwhile(path, offset, size):
+            block = fetch(path, offset, size)
+            self.cache.invalidate(path)
+            return block
+
+        self.cache.fetch = changed_meanwhile
+        self.cache.read('/f', 100, 0)
+        self.cache.fetch = fetch
+        self.cache.read('/f', 100, 0)
+        self.assertEqual(self.fetched, [0, 0], 'stale block cached')
+
+    def test_paths_forgotten(self):
+        self.cache.streams = 4
+        for i in range(100):
+            self.cache.read(f'/f{i}', 100, 0)
+        self.assertLessEqual(len(self.cache.next_offset), 4, 'readers of every file kept')
+        self.assertLessEqual(len(self.cache.paths), 8, 'paths of evicted blocks kept')
+
+
+class TestWriteBuffer(unittest.TestCase):
+    def setUp(self):
+        self.flushed = []
+        self.buffer = WriteBuffer(self.flush, threshold=1024, interval=60)
+
+    def tearDown(self):
+        self.buffer.shutdown()
+
+    def flush(self, path, offset, data):
+        self.flushed.append((path, offset, data))
+
+    def test_coalesce_adjacent(self):
+        for i in range(8):
+            self.buffer.write('/f', b'x' * 64, i * 64)
+        self.buffer.flush('/f')
+
+        self.assertEqual(self.flushed, [('/f', 0, b'x' * 512)], 'writes not merged')
+
+    def test_overlap_newest_wins(self):
+        self.buffer.write('/f', b'aaaa', 0)
+        self.buffer.write('/f', b'cc', 8)
+        self.buffer.write('/f', b'bbbbbb', 2)
+        self.buffer.flush('/f')
+
+        self.assertEqual(self.flushed, [('/f', 0, b'aabbbbbbcc')], 'wrong merge')
+
+    def test_gaps_flushed_separately(self):
+        self.buffer.write('/f', b'a', 0)
+        self.buffer.write('/f', b'b', 10)
+        self.assertEqual(self.buffer.end('/f'), 11, 'wrong buffered end')
+        self.buffer.flush('/f')
+
+        self.assertEqual(self.flushed, [('/f', 0, b'a'), ('/f', 10, b'b')])
+
+    def test_threshold(self):
+        self.buffer.write('/f', b'x' * 1000, 0)
+        self.assertEqual(self.flushed, [], 'flushed too early')
+
+        self.buffer.write('/f', b'x' * 100, 1000)
+        self.assertEqual(self.flushed, [('/f', 0, b'x' * 1100)], 'threshold ignored')
+        self.assertNotIn('/f', self.buffer)
+
+    def test_failed_flush_kept(self):
+        def fail(path, offset, data):
+            raise OSError('owner unreachable')
+
+        self.buffer.flush_extent = fail
+        self.buffer.write('/f', b'data', 0)
+        with self.assertRaises(OSError):
+            self.buffer.flush('/f')
+
+        self.buffer.flush_extent = self.flush
+        self.buffer.flush('/f')
+        self.assertEqual(self.flushed, [('/f', 0, b'data')], 'failed write lost')
+
+
+    def test_concurrent_flushes_in_order(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def slow(path, offset, data):
+            if data == b'AAAA':
+                sending.set()
+                release.wait(5)
+            self.flush(path, offset, data)
+
+        self.buffer.flush_extent = slow
+        self.buffer.write('/f', b'AAAA', 0)
+        first = threading.Thread(target=self.buffer.flush, args=('/f',))
+        first.start()
+        sending.wait(5)
+
+        self.buffer.write('/f', b'BBBB', 0)
+        second = threading.Thread(target=self.buffer.flush, args=('/f',))
+        second.start()
+        second.join(0.1)
+        self.assertTrue(second.is_alive(), 'flush returned before the earlier one was done')
+        self.assertIn('/f', self.buffer)
+
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(self.flushed, [('/f', 0, b'AAAA'), ('/f', 0, b'BBBB')], 'newer write overwritten')
+        self.assertNotIn('/f', self.buffer)
+
+
+class TestFdCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for name in 'abc':
+            path = os.path.join(self.dir.name, name)
+            with open(path, 'wb') as f:
+                f.write(b'0123456789')
+            self.paths.append(path)
+        self.fds = FdCache(capacity=2)
+
+    def tearDown(self):
+        self.fds.close()
+        self.dir.cleanup()
+
+    def test_shared_descriptor(self):
+        with self.fds.open(self.paths[0]) as fd:
+            self.assertEqual(os.pread(fd, 4, 2), b'2345')
+        with self.fds.open(self.paths[0]) as again:
+            self.assertEqual(fd, again, 'descriptor not reused')
+
+    def test_eviction_waits_for_users(self):
+        with self.fds.open(self.paths[0]) as fd:
+            with self.fds.open(self.paths[1]), self.fds.open(self.paths[2]):
+                pass
+            self.assertEqual(len(self.fds), 2, 'capacity exceeded')
+            # evicted but still in use, must not be closed yet
+            self.assertEqual(os.pread(fd, 1, 0), b'0')
+
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_invalidate(self):
+        with self.fds.open(self.paths[0]) as fd:
+            os.pwrite(fd, b'ab', 0)
+        self.fds.invalidate(self.paths[0])
+
+        self.assertIsNone(self.fds.cached(self.paths[0]))
+        with open(self.paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'ab23456789', 'pwrite truncated the file')
+
+    def test_striped(self):
+        # room for every path in any stripe, string hashes vary by run
+        fds = StripedFdCache(capacity=16, stripes=4)
+        entries = [fds.acquire(path) for path in self.paths]
+        for entry in entries:
+            fds.release(entry)
+        self.assertEqual(len(fds), 3)
+        self.assertEqual(fds.stats()['misses'], 3)
+
+        fds.invalidate_tree(self.dir.name)
+        self.assertEqual(len(fds), 0, 'files under the directory still cached')
+        with self.assertRaises(OSError):
+            os.fstat(entries[0].fd)
+        fds.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,52 +1,218 @@
 import os
-import socket
+import hashlib
+import logging
 import threading
 import socketserver
 import sys
 import argparse
-from time import time
+from collections import defaultdict, namedtuple
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from time import perf_counter, time
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from errno import *
-from base64 import b64decode, b64encode
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
-from utils.message import Message
 from utils.node import Node
 from utils.handler import RequestHandler
+from utils.connection import FileRange
+from utils.pool import ConnectionPool, ConnectError
+from utils.mux import MuxPool
+from utils.cache import StripedLRUCache
+from utils.blockcache import BlockCache
+from utils.writeback import WriteBuffer
+from utils.fdcache import StripedFdCache
+from utils.aio import AsyncServer
+from utils.rtt import RttTracker
+from utils.throttle import Throttle
+from utils.stats import Stats
+from utils.striped import StripedLock
+from utils.lease import LeaseTable
+
+log = logging.getLogger(__name__)
+
+
+# cached in FuseApi.attrs for paths that don't exist
+NOT_FOUND = object()
+# suffix of files being copied in by the rebalancer
+PART_SUFFIX = '.part~'
+# directory of local_files holding the chunks of striped files, chunk i
+# of /name is /.chunks/name.i
+CHUNK_DIR = '.chunks'
+
+# chunk size and the Nodes holding every chunk of a striped file, which
+# are replicated like files
+Stripe = namedtuple('Stripe', ['size', 'chunks'])
+# cached in FuseApi.stripes for files that aren't striped
+NOT_STRIPED = object()
+
+# seconds a change waits for the holders of leases on the file to drop
+# their copies (or flush their writes), the lease of a holder that doesn't
+# answer by then runs out instead
+CALLBACK_TIMEOUT = 2.0
+
+# errno of the bootstrap's replies refusing a namespace change
+REPLY_ERRNO = {
+    'FILE_NOT_FOUND':      ENOENT,
+    'FILE_ALREADY_EXISTS': EEXIST,
+    'NOT_DIR':             ENOTDIR,
+    'IS_DIR':              EISDIR,
+    'NOT_EMPTY':           ENOTEMPTY,
+    'INVALID':             EINVAL,
+}
 
 
 class FuseApi(object):
-    def __init__(self, bootstrap_node, local_node, local_files):
+    def __init__(self, bootstrap_node, local_node, local_files, protocol=2,
+                 loc_cache_size=4096, loc_cache_ttl=30.0,
+                 attr_cache_size=4096, attr_cache_ttl=1.0, negative_ttl=0.5,
+                 block_size=128 * 1024, block_cache_size=64 * 1024 * 1024,
+                 readahead=4, write_buffer=4 * 1024 * 1024, flush_interval=1.0,
+                 fd_cache_size=256, weight=1, multiplex=False,
+                 heartbeat_interval=1.0, stripe_size=0, lock_stripes=16,
+                 lease_time=10.0, request_timeout=30.0):
         self.bootstrap_node = bootstrap_node
         self.local_node     = local_node
         self.local_files    = local_files
+        # share of the hash ring this node asks for
+        self.weight         = weight
+
+        # latencies and counters, answered to STATS
+        self.stats = Stats()
+
+        # the caches below, the connection pool and the write buffer are
+        # used by every FUSE and server thread at once. Each is split into
+        # this many stripes with a lock of their own, by path (or peer)
+        self.lock_stripes = lock_stripes
+
+        # shared by bootstrap and peer requests. Multithreaded FUSE shares
+        # a few multiplexed connections per peer between its threads. A
+        # peer that doesn't reply within request_timeout fails over like a
+        # dead one
+        if multiplex:
+            self.pool = MuxPool(version=protocol, stripes=lock_stripes, timeout=request_timeout)
+        else:
+            self.pool = ConnectionPool(version=protocol, stripes=lock_stripes, timeout=request_timeout)
+
+        # open descriptors of local files, shared with ServerHandler
+        self.fds = StripedFdCache(fd_cache_size, lock_stripes)
+
+        # path -> tuple of the Nodes holding it (primary first), saves a
+        # bootstrap round trip per operation
+        self.locations = StripedLRUCache(loc_cache_size, loc_cache_ttl, lock_stripes)
+
+        # path -> Stripe (or NOT_STRIPED), cached alongside locations
+        self.stripes = StripedLRUCache(loc_cache_size, loc_cache_ttl, lock_stripes)
+        # files created here are split into chunks of this many bytes, each
+        # placed on the ring by itself, 0 keeps them whole
+        self.stripe_size = stripe_size
+        os.makedirs(os.path.join(local_files, CHUNK_DIR), exist_ok=True)
+
+        # paths only this node holds. Authoritative, unlike locations: it
+        # is kept up to date by create, unlink and the bootstrap's pushes,
+        # so operations on these never leave the process
+        self.owned = set()
+
+        # picks the replica reads go to
+        self.rtt = RttTracker()
+        # sends replicated updates to every replica (and striped reads and
+        # writes to every chunk) at once
+        self.executor = ThreadPoolExecutor(16)
+
+        # paths whose copy here changed size since we last told the
+        # bootstrap, for its per-node byte counts
+        self.resized = set()
+        self.resized_lock = threading.Lock()
+
+        # leases on the files we hold: a remote reader may cache what it
+        # read until we call it back, a remote writer may buffer writes
+        # until a reader recalls them. The node granting a lease tells the
+        # caches below when to drop entries, which they keep for the
+        # attribute cache TTL, at most as long as a lease lasts. 0
+        # disables them, entries are then only trusted for that TTL
+        self.leases = None
+        if lease_time:
+            self.leases = LeaseTable(lease_time, lock_stripes)
+            attr_cache_ttl = min(attr_cache_ttl, lease_time)
+        # path -> True while we hold the write lease on its remote replicas
+        self.write_leases = StripedLRUCache(loc_cache_size, None, lock_stripes)
+        # sends callbacks and recalls. Apart from executor, server threads
+        # send them while its tasks may be waiting for their replies
+        self.callbacks = ThreadPoolExecutor(8)
+
+        # path -> stat dict (or NOT_FOUND), answers repeated getattr calls
+        self.attrs = StripedLRUCache(attr_cache_size, attr_cache_ttl, lock_stripes)
+        # serialise concurrent updates of a cached stat, a write extending
+        # the file must not be undone by another's older size
+        self.attr_locks = StripedLock(lock_stripes)
+        self.negative_ttl = negative_ttl
+
+        # blocks of remote files, a budget of 0 disables it
+        self.blocks = None
+        if block_cache_size:
+            self.blocks = BlockCache(self.read_remote, block_size,
+                                     block_cache_size, readahead,
+                                     ttl=attr_cache_ttl)
+
+        # coalesces small writes to remote files, a size of 0 disables it
+        self.writes = None
+        if write_buffer:
+            self.writes = WriteBuffer(self.write_remote, write_buffer,
+                                      flush_interval, lock_stripes)
+
+        self.stats.register('caches', self.cache_stats)
+
+        # live nodes as last heard from the bootstrap, None until then
+        self.members = None
+        self.epoch = None
+        self.membership_lock = threading.Lock()
 
         self.join_cluster()
 
+        # heartbeats keep us in the cluster and the member list fresh,
+        # an interval of 0 disables them
+        self.heartbeat_interval = heartbeat_interval
+        self.stopped = threading.Event()
+        if heartbeat_interval:
+            threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
     def __send_message(self, node, json):
         '''Sends a dict encoded into a json string to the given node
            (can send to the bootstrap node or any other node)'''
         json['port'] = self.local_node.port
 
-        with socket.socket() as s:
-            try:
-                s.connect(node)
-            except Exception as e:
+        start = perf_counter()
+        try:
+            if node == self.bootstrap_node:
+                return self.pool.request(node, json)
+            with self.rtt.measure(node):
+                return self.pool.request(node, json)
+        except ConnectError as e:
+            if node != self.bootstrap_node:
                 self.report_missing_node(node)
-                raise e
-
-            s.sendall(Message.build(json))
-
-            resp_len = s.recv(4)
-            resp_data = s.recv(Message.parse_length(resp_len))
-
-            return Message.parse(resp_len + resp_data)
+            raise e
+        finally:
+            self.stats.record(f'call.{json["command"]}', perf_counter() - start)
+
+    def cache_stats(self):
+        caches = {
+            'locations': self.locations.stats(),
+            'stripes': self.stripes.stats(),
+            'attrs': self.attrs.stats(),
+            'fds': self.fds.stats(),
+        }
+        if self.blocks:
+            caches['blocks'] = self.blocks.stats()
+        if self.leases is not None:
+            caches['leases'] = {'entries': len(self.leases)}
+        return caches
 
     def join_cluster(self):
         '''Connects to the bootstrap node and attempts to JOIN the network'''
         resp = self.__send_message(self.bootstrap_node, {
             "command": "JOIN",
+            "weight":  self.weight,
         })
 
         if resp['reply'] != 'ACK_JOIN':
@@ -54,20 +220,89 @@ class FuseApi(object):
 
         self.local_node = Node(resp['local_addr'], resp['local_port'])
 
+        files = []
+        for root, dirs, names in os.walk(self.local_files):
+            if root == self.local_files and CHUNK_DIR in dirs:
+                dirs.remove(CHUNK_DIR)
+            relative = os.path.relpath(root, self.local_files)
+            files.extend(os.path.normpath(os.path.join(relative, name))
+                         for name in names if not name.endswith(PART_SUFFIX))
         resp = self.__send_message(self.bootstrap_node, {
             "command": "FILES_ADD",
-            "files":   os.listdir(self.local_files),
+            "files":   files,
+            "sizes":   [os.path.getsize(os.path.join(self.local_files, f)) for f in files],
         })
 
         if resp['reply'] != 'ACK_ADD':
             raise Exception('Could not add files to the network')
 
+        # older bootstraps don't say which files are shared, then nothing
+        # is assumed to be ours alone
+        if 'shared' in resp:
+            shared = set(resp['shared'])
+            self.owned = set('/' + f for f in files if f not in shared)
+
     def shutdown(self):
+        self.stopped.set()
+        if self.writes:
+            self.writes.shutdown()
+
         resp = self.__send_message(self.bootstrap_node, {
             'command': 'LEAVE',
         })
+        self.pool.close()
+        self.executor.shutdown(wait=False)
+        self.callbacks.shutdown(wait=False)
+        self.fds.close()
+        if self.blocks:
+            self.blocks.shutdown()
+
+    def heartbeat_loop(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                resp = self.__send_message(self.bootstrap_node, {
+                    'command': 'HEARTBEAT',
+                    'epoch': self.epoch,
+                })
+
+                if resp['reply'] == 'REJOIN':
+                    # we were declared dead while unreachable
+                    self.join_cluster()
+
+                elif 'nodes' in resp:
+                    self.update_membership(resp['epoch'], resp['nodes'])
+
+            except Exception as e:
+                log.warning('heartbeat failed: %s', e)
+
+    def update_membership(self, epoch, nodes):
+        '''Takes a member list pushed by the bootstrap (or sent with a
+           heartbeat reply) and forgets everything about removed nodes'''
+        nodes = frozenset(Node(*node) for node in nodes)
+        with self.membership_lock:
+            if self.epoch is not None and epoch <= self.epoch:
+                # an older list arriving late
+                return
+
+            removed = self.members - nodes if self.members else ()
+            self.members, self.epoch = nodes, epoch
+
+        for node in removed:
+            self.locations.remove_if(lambda held: node in held)
+            self.stripes.remove_if(lambda stripe: stripe is not NOT_STRIPED and
+                                   any(node in held for held in stripe.chunks))
+            self.pool.discard(node)
+
+        if removed:
+            self.attrs.clear()
+            self.invalidate_blocks()
+
+    def alive(self, node):
+        return self.members is None or node in self.members
 
     def report_missing_node(self, node):
+        self.locations.remove_if(lambda nodes: node in nodes)
+
         resp = self.__send_message(self.bootstrap_node, {
             'command': 'MISSING_NODE',
             'maddr': node.addr,
@@ -75,6 +310,33 @@ class FuseApi(object):
         })
 
     def get_file_location(self, path):
+        '''Returns the primary replica of path'''
+        return self.get_replicas(path)[0]
+
+    def get_replicas(self, path):
+        '''Returns the tuple of Nodes holding path, primary first'''
+        if path in self.owned:
+            return (self.local_node,)
+
+        nodes = self.locations.get(path)
+        if nodes is not None:
+            return nodes
+
+        return self.lookup(path)[0]
+
+    def get_stripe(self, path):
+        '''Returns the Stripe of path, None if it isn't striped'''
+        if path in self.owned:
+            return None
+
+        stripe = self.stripes.get(path)
+        if stripe is None:
+            stripe = self.lookup(path)[1]
+        return None if stripe is NOT_STRIPED else stripe
+
+    def lookup(self, path):
+        '''Asks the bootstrap for the replica set and stripe of path and
+           caches them'''
         resp = self.__send_message(self.bootstrap_node, {
             'command': 'GET_FILE_LOC',
             'file': path,
@@ -83,10 +345,120 @@ class FuseApi(object):
         if resp['reply'] == 'FILE_NOT_FOUND':
             raise FuseOSError(ENOENT)
 
+        if resp['reply'] == 'IS_DIR':
+            raise FuseOSError(EISDIR)
+
         if resp['reply'] != 'ACK_GET_FILE_LOC':
             raise FuseOSError(ENOENT)
 
-        return Node(resp['addr'], resp['port'])
+        # cached for as long as the bootstrap leases them to us
+        nodes = self.replica_set(resp)
+        stripe = self.stripe_of(resp)
+        self.locations.put(path, nodes, resp.get('lease'))
+        self.stripes.put(path, stripe, resp.get('lease'))
+        return nodes, stripe
+
+    @staticmethod
+    def stripe_of(resp):
+        '''Stripe of a GET_FILE_LOC or PLACE_CHUNKS reply'''
+        if not resp.get('stripe'):
+            return NOT_STRIPED
+        return Stripe(resp['stripe']['size'],
+                      tuple(tuple(Node(*node) for node in nodes)
+                            for nodes in resp['stripe']['chunks']))
+
+    @staticmethod
+    def replica_set(resp):
+        '''Replica set of a GET_FILE_LOC or PLACE_FILE reply, bootstraps
+           without replication only send the owner'''
+        if resp.get('replicas'):
+            return tuple(Node(*node) for node in resp['replicas'])
+        return (Node(resp['addr'], resp['port']),)
+
+    def read_order(self, nodes):
+        '''Replicas in the order reads should try them: ourselves, then by
+           smoothed round trip time and load. Nodes known to be dead are
+           skipped, unless that leaves nothing to try'''
+        nodes = [node for node in nodes if self.alive(node)] or nodes
+        if self.local_node in nodes:
+            return [self.local_node] + self.rtt.rank(n for n in nodes if n != self.local_node)
+        return self.rtt.rank(nodes)
+
+    def apply(self, node, path, msg, ack, local):
+        '''Runs one replica's share of an update, local() for ourselves and
+           msg for everyone else. Returns whether it succeeded'''
+        if node == self.local_node:
+            local()
+            self.break_leases(path, self.local_node)
+            return True
+
+        return self.__send_message(node, dict(msg, path=path))['reply'] == ack
+
+    def replicate(self, path, msg, ack, local, nodes=None, wait_all=False):
+        '''Applies an update to every replica of path in parallel and returns
+           the ones that acked once a majority of them did, or once all are
+           done with wait_all. Raises EIO when a majority didn't ack. The
+           replicas that miss the update are reported stale'''
+        nodes = nodes or self.get_replicas(path)
+
+        if len(nodes) == 1:
+            # nothing to wait for in parallel, errors keep their errno
+            acked = list(nodes) if self.apply(nodes[0], path, msg, ack, local) else []
+
+        else:
+            # dead nodes count against the quorum without a connect timeout
+            futures = dict((self.executor.submit(self.apply, node, path, msg, ack, local), node)
+                           for node in nodes if self.alive(node))
+            acked = []
+            for future in as_completed(futures):
+                if self.applied(future):
+                    acked.append(futures[future])
+                    if not wait_all and len(acked) * 2 > len(nodes):
+                        break
+
+            if not wait_all and len(acked) * 2 > len(nodes):
+                # the stragglers finish in the background
+                for future, node in futures.items():
+                    if node not in acked:
+                        future.add_done_callback(partial(self.check_applied, path, node))
+
+        if len(acked) * 2 <= len(nodes):
+            # our replica set may be stale
+            self.locations.pop(path)
+            raise FuseOSError(EIO)
+
+        # primary first
+        return [node for node in nodes if node in acked]
+
+    @staticmethod
+    def applied(future):
+        try:
+            return future.result()
+        except OSError:
+            return False
+
+    def check_applied(self, path, node, future):
+        if not self.applied(future):
+            self.executor.submit(self.report_stale, path, node)
+
+    def report_stale(self, path, node):
+        '''Has the bootstrap take node, which missed an update to path, out
+           of its replica set until it holds a fresh copy'''
+        msg = {
+            'command': 'STALE_REPLICA',
+            'path': path,
+            'maddr': node.addr,
+            'mport': node.port,
+        }
+        striped = chunk_file(path)
+        if striped:
+            msg.update(path=striped, chunk=int(path.rpartition('.')[2]))
+
+        try:
+            self.__send_message(self.bootstrap_node, msg)
+        except Exception as e:
+            log.warning('reporting %s stale for %s failed: %s', node, path, e)
+        self.forget([msg['path']])
 
     def create(self, path, mode):
         # check if file exists in cluster before creating
@@ -98,142 +470,869 @@ class FuseApi(object):
         except Exception:
             pass
 
-        local_path = os.path.join(self.local_files, path[1:])
-        f = open(local_path, 'x')
-        f.close()
-        os.chmod(local_path, mode)
+        nodes = self.place_file(path)
 
-        resp = self.__send_message(self.bootstrap_node, {
+        acked = self.replicate(path, {
+            'command': 'CREATE',
+            'mode': mode,
+        }, 'ACK_CREATE', lambda: self.create_local(path, mode), nodes, wait_all=True)
+
+        msg = {
             'command': 'FILE_ADD',
             'path': path,
-        })
+            'replicas': acked,
+        }
+        if self.stripe_size:
+            # the replicas only hold its attributes, chunks are placed as
+            # they are written
+            msg['stripe'] = self.stripe_size
+        resp = self.__send_message(self.bootstrap_node, msg)
+
+        self.attrs.pop(path)
+
+        if resp['reply'] == 'ACK_ADD':
+            ttl = resp.get('lease')
+            if self.stripe_size:
+                self.locations.put(path, tuple(acked), ttl)
+                self.stripes.put(path, Stripe(self.stripe_size, ()), ttl)
+            elif acked == [self.local_node]:
+                self.owned.add(path)
+            else:
+                self.locations.put(path, tuple(acked), ttl)
+                self.stripes.put(path, NOT_STRIPED, ttl)
 
         return 0
 
-    def getattr(self, path):
-        node = self.get_file_location(path)
-
-        resp = self.__send_message(node, {
-            'command': 'GET_ATTR',
-            'path':    path,
+    def place_file(self, path):
+        '''Asks the bootstrap which nodes a new file should live on'''
+        resp = self.__send_message(self.bootstrap_node, {
+            'command': 'PLACE_FILE',
+            'path': path,
         })
 
-        if resp['reply'] != 'ACK_GET_ATTR':
+        if resp['reply'] != 'ACK_PLACE_FILE':
+            raise FuseOSError(EIO)
+
+        return self.replica_set(resp)
+
+    def create_local(self, path, mode):
+        '''Creates path in local_files, whoever asked for it registers it
+           with the bootstrap'''
+        local_path = os.path.join(self.local_files, path[1:])
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        f = open(local_path, 'x')
+        f.close()
+        os.chmod(local_path, mode)
+
+        self.attrs.pop(path)
+
+    def getattr(self, path):
+        if path in self.owned:
+            # as cheap as the cache, and never stale
+            self.lease_read(path, self.local_node)
+            stat = stat_file(self.fds, self.local_path(path))
+            if stat is not None:
+                return stat
+            # removed behind our back
+            self.owned.discard(path)
+
+        stat = self.attrs.get(path)
+        if stat is NOT_FOUND:
+            raise FuseOSError(ENOENT)
+        if stat is not None:
+            return dict(stat)
+
+        try:
+            nodes = self.get_replicas(path)
+            stripe = self.get_stripe(path)
+        except FuseOSError as e:
+            if e.errno == EISDIR:
+                return dict(self.cache_attr(path, dir_stat()))
+            self.attrs.put(path, NOT_FOUND, ttl=self.negative_ttl)
+            raise
+
+        stat = self.stat_replica(path, nodes)
+        if stat is None:
+            # our cached replica set may be stale
+            self.locations.pop(path)
             raise FuseOSError(ENOENT)
 
-        return resp['stat']
+        if stripe:
+            stat['st_size'] = self.striped_size(path, stripe)
+        return dict(self.cache_attr(path, stat))
+
+    def stat_replica(self, path, nodes):
+        '''stat of path from the first of nodes that answers, or None'''
+        for node in self.read_order(nodes):
+            if node == self.local_node:
+                self.lease_read(path, self.local_node)
+                stat = stat_file(self.fds, self.local_path(path))
+                if stat is not None:
+                    return stat
+                continue
+
+            try:
+                resp = self.__send_message(node, {
+                    'command': 'GET_ATTR',
+                    'path':    path,
+                })
+            except OSError:
+                continue
+
+            if resp['reply'] == 'ACK_GET_ATTR':
+                return resp['stat']
+
+        return None
+
+    def cache_attr(self, path, stat):
+        if stat is None:
+            self.attrs.put(path, NOT_FOUND, ttl=self.negative_ttl)
+            return NOT_FOUND
+
+        if self.writes:
+            # buffered writes may extend the file
+            stat['st_size'] = max(stat['st_size'], self.writes.end(path))
+
+        self.attrs.put(path, stat)
+        return stat
+
+    def update_attr(self, path, **changes):
+        '''Applies a change made by this client to its cached stat'''
+        with self.attr_locks(path):
+            stat = self.attrs.get(path)
+            if stat is None or stat is NOT_FOUND:
+                return
+
+            stat = dict(stat, **changes)
+            if 'min_size' in changes:
+                stat['st_size'] = max(stat['st_size'], stat.pop('min_size'))
+            self.attrs.put(path, stat)
 
     def read(self, path, size, offset, fh):
-        node = self.get_file_location(path)
+        nodes = self.get_replicas(path)
+        stripe = self.get_stripe(path)
+
+        # after our own buffered writes
+        self.flush(path)
 
         # read locally
-        if node == self.local_node:
+        if self.local_node in nodes and not stripe:
             localpath = os.path.join(self.local_files, path[1:])
 
-            with open(localpath, 'rb') as f:
-                f.seek(offset)
-                return f.read(size)
+            self.lease_read(path, self.local_node)
+            with self.fds.open(localpath) as fd:
+                return os.pread(fd, size, offset)
 
         # read from network
-        else:
-            resp = self.__send_message(node, {
-                'command': 'READ',
-                'path': path,
-                'size': size,
-                'offset': offset,
-            })
 
-            if resp['reply'] != 'ACK_READ':
-                raise FuseOSError(EIO)
+        if self.blocks:
+            return self.blocks.read(path, size, offset)
+
+        return self.read_remote(path, offset, size)
+
+    def read_remote(self, path, offset, size):
+        '''Reads from the best replica, falling back to the others'''
+        stripe = self.get_stripe(path)
+        if stripe:
+            return self.read_striped(path, stripe, offset, size)
 
-            return b64decode(resp['data'].encode())
+        for node in self.read_order(self.get_replicas(path)):
+            try:
+                resp = self.__send_message(node, {
+                    'command': 'READ',
+                    'path': path,
+                    'size': size,
+                    'offset': offset,
+                })
+            except OSError:
+                continue
+
+            if resp['reply'] == 'ACK_READ':
+                return bytes(resp['data'])
+
+        self.locations.pop(path)
+        raise FuseOSError(EIO)
+
+    def read_striped(self, path, stripe, offset, size):
+        '''Reads the chunks offset and size span, all at once'''
+        if size <= 0:
+            return b''
+
+        last = (offset + size - 1) // stripe.size
+        if last >= len(stripe.chunks):
+            # someone may have written past the end we know of
+            stripe = self.lookup(path)[1]
+            if stripe is NOT_STRIPED:
+                # removed and created again meanwhile
+                return self.read_remote(path, offset, size)
+
+        pieces = list(self.split(stripe, offset, size))
+        futures = [self.executor.submit(self.read_chunk, path, stripe.chunks[i], i, start, n)
+                   for i, start, n in pieces]
+
+        data = []
+        for (i, start, n), future in zip(pieces, futures):
+            piece = future.result()
+            if len(piece) < n and i < len(stripe.chunks) - 1:
+                # a hole, chunks before the last read as full
+                piece += bytes(n - len(piece))
+            data.append(piece)
+        return b''.join(data)
+
+    @staticmethod
+    def split(stripe, offset, size):
+        '''Yields (chunk index, offset in it, size) of the existing chunks
+           offset and size span'''
+        end = offset + size
+        last = min((end - 1) // stripe.size, len(stripe.chunks) - 1)
+        for i in range(offset // stripe.size, last + 1):
+            start = max(offset, i * stripe.size)
+            stop = min(end, (i + 1) * stripe.size)
+            yield i, start - i * stripe.size, stop - start
+
+    def read_chunk(self, path, nodes, i, offset, size):
+        chunk = chunk_path(path, i)
+        if self.local_node in nodes:
+            with self.fds.open(self.local_path(chunk)) as fd:
+                return os.pread(fd, size, offset)
+
+        for node in self.read_order(nodes):
+            try:
+                resp = self.__send_message(node, {
+                    'command': 'READ',
+                    'path': chunk,
+                    'size': size,
+                    'offset': offset,
+                })
+            except OSError:
+                continue
+
+            if resp['reply'] == 'ACK_READ':
+                return bytes(resp['data'])
+
+        self.stripes.pop(path)
+        raise FuseOSError(EIO)
+
+    def striped_size(self, path, stripe):
+        '''Size of a striped file: the full chunks before the last, and
+           whatever the last holds'''
+        if not stripe.chunks:
+            return 0
+
+        last = len(stripe.chunks) - 1
+        stat = self.stat_replica(chunk_path(path, last), stripe.chunks[last])
+        if stat is None:
+            raise FuseOSError(EIO)
+        return last * stripe.size + stat['st_size']
+
+    def invalidate_blocks(self, path=None):
+        '''Drops cached blocks of path (or of every file)'''
+        if not self.blocks:
+            return
+        if path is None:
+            self.blocks.clear()
+        else:
+            self.blocks.invalidate(path)
 
     def write(self, path, data, offset, fh):
-        node = self.get_file_location(path)
+        nodes = self.get_replicas(path)
+        stripe = self.get_stripe(path)
 
-        if node == self.local_node:
-            localpath = os.path.join(self.local_files, path[1:])
+        self.invalidate_blocks(path)
 
-            with open(localpath, 'wb') as f:
-                f.seek(offset)
-                return f.write(data)
+        try:
+            if nodes == (self.local_node,) and not stripe:
+                localpath = os.path.join(self.local_files, path[1:])
 
-        else:
-            resp = self.__send_message(node, {
-                'command': 'WRITE',
-                'path': path,
-                'offset': offset,
-                'data': b64encode(data).decode()
-            })
+                with self.fds.open(localpath) as fd:
+                    written = os.pwrite(fd, data, offset)
+                self.break_leases(path, self.local_node)
+                self.report_size(path)
 
-            if resp['reply'] != 'ACK_WRITE':
-                raise FuseOSError(EIO)
+            elif self.writes:
+                if not stripe:
+                    self.take_write_lease(path, nodes)
+                written = self.writes.write(path, data, offset)
 
-            return len(data)
+            else:
+                written = self.write_remote(path, offset, data)
+
+        except Exception:
+            # some of the replicas may have changed
+            self.attrs.pop(path)
+            raise
+
+        now = time()
+        self.update_attr(path, min_size=offset + written, st_mtime=now, st_ctime=now)
+        return written
+
+    def write_remote(self, path, offset, data):
+        '''Writes to every replica of path (our own copy included)'''
+        stripe = self.get_stripe(path)
+        if stripe:
+            return self.write_striped(path, stripe, offset, data)
+
+        def local():
+            with self.fds.open(self.local_path(path)) as fd:
+                os.pwrite(fd, data, offset)
+            self.report_size(path)
+
+        self.replicate(path, {
+            'command': 'WRITE',
+            'offset': offset,
+            'data': data,
+        }, 'ACK_WRITE', local)
+
+        return len(data)
+
+    def write_striped(self, path, stripe, offset, data):
+        '''Writes to the chunks data spans, all at once'''
+        if not data:
+            return 0
+
+        stripe = self.place_chunks(path, stripe, (offset + len(data) - 1) // stripe.size + 1)
+
+        view = memoryview(data)
+        futures = []
+        for i, start, n in self.split(stripe, offset, len(data)):
+            pos = i * stripe.size + start - offset
+            futures.append(self.executor.submit(self.write_chunk, path, stripe.chunks[i],
+                                                i, start, view[pos:pos + n]))
+        for future in futures:
+            future.result()
+
+        return len(data)
+
+    def write_chunk(self, path, nodes, i, offset, data):
+        def local():
+            with self.fds.open(self.local_path(chunk)) as fd:
+                os.pwrite(fd, data, offset)
+
+        chunk = chunk_path(path, i)
+        self.replicate(chunk, {
+            'command': 'WRITE',
+            'offset': offset,
+            'data': data,
+        }, 'ACK_WRITE', local, nodes)
+
+    def place_chunks(self, path, stripe, count):
+        '''Makes sure path has at least count chunks, creating the new ones
+           on the nodes the bootstrap places them on'''
+        if count <= len(stripe.chunks):
+            return stripe
 
-    def readdir(self):
-        '''Gets the current directory contents from the bootstrap node'''
         resp = self.__send_message(self.bootstrap_node, {
-            'command': 'LIST_DIR'
+            'command': 'PLACE_CHUNKS',
+            'path': path,
+            'count': count,
         })
-        if resp['reply'] != 'ACK_LS':
-            raise FuseOSError(ENOENT)
 
-        # print('Files: {}'.format(resp["files"]))
-        return resp['files']
+        if resp['reply'] != 'ACK_PLACE_CHUNKS':
+            raise FuseOSError(EIO)
+
+        old, stripe = stripe, self.stripe_of(resp)
+        futures = [self.executor.submit(self.create_chunk, path, node, i)
+                   for i in range(len(old.chunks), len(stripe.chunks))
+                   for node in stripe.chunks[i]]
+        for future in futures:
+            future.result()
 
-    def truncate(self, path, length, fh):
-        node = self.get_file_location(path)
+        self.stripes.put(path, stripe, resp.get('lease'))
+        return stripe
 
+    def create_chunk(self, path, node, i):
+        chunk = chunk_path(path, i)
         if node == self.local_node:
-            localpath = os.path.join(self.local_files, path[1:])
-            os.truncate(localpath, length)
+            try:
+                self.create_local(chunk, 0o644)
+            except FileExistsError:
+                # another client placed it first
+                pass
+            return
+
+        resp = self.__send_message(node, {
+            'command': 'CREATE',
+            'path': chunk,
+            'mode': 0o644,
+        })
+
+        if resp['reply'] not in ('ACK_CREATE', 'FILE_ALREADY_EXISTS'):
+            raise FuseOSError(EIO)
+
+    def unlink_chunks(self, path, stripe, start=0):
+        '''Removes chunks start and after, their nodes may already be gone'''
+        def unlink(node, i):
+            chunk = chunk_path(path, i)
+            try:
+                self.apply(node, chunk, {
+                    'command': 'UNLINK',
+                }, 'ACK_UNLINK', lambda: self.unlink_local(chunk))
+            except OSError:
+                pass
+
+        futures = [self.executor.submit(unlink, node, i)
+                   for i, nodes in enumerate(stripe.chunks) if i >= start
+                   for node in nodes]
+        for future in futures:
+            future.result()
+
+    def unlink_local(self, path):
+        localpath = self.local_path(path)
+        self.fds.invalidate(localpath)
+        os.unlink(localpath)
+
+    def flush(self, path):
+        '''Sends buffered writes of path to its replicas'''
+        if not self.writes or path not in self.writes:
+            return 0
+
+        try:
+            self.writes.flush(path)
+        except FuseOSError:
+            raise
+        except Exception:
+            raise FuseOSError(EIO)
+
+        return 0
+
+    def readdir(self, path='/'):
+        '''Gets the contents of directory path, with the owner of every
+           entry, from the bootstrap node a page at a time and prefetches
+           their attributes so the getattr calls that follow (ls -l) are
+           cache hits'''
+        files = []
+        cursor = None
+        while True:
+            resp = self.__send_message(self.bootstrap_node, {
+                'command': 'LIST_DIR_PLUS',
+                'path':    path,
+                'cursor':  cursor,
+            })
+            if resp['reply'] != 'ACK_LS_PLUS':
+                raise FuseOSError(REPLY_ERRNO.get(resp['reply'], ENOENT))
+
+            files.extend(self.cache_entries(path, resp['entries'], resp.get('lease')))
+            cursor = resp['cursor']
+            if cursor is None:
+                return files + ['.', '..']
+
+    def cache_entries(self, directory, entries, ttl=None):
+        '''Caches what a LIST_DIR_PLUS page tells about the entries of
+           directory (for ttl seconds, the lease the bootstrap granted on
+           them), returns their names'''
+        prefix = directory.rstrip('/') + '/'
+        files = []
+        by_node = defaultdict(list)
+        for name, nodes, *striped in entries:
+            path = prefix + name
+            files.append(name)
+            if nodes is None:
+                self.cache_attr(path, dir_stat())
+                continue
+
+            nodes = tuple(Node(*node) for node in nodes)
+            self.locations.put(path, nodes, ttl)
+
+            if striped:
+                # the size comes from the chunks, getattr looks it up
+                continue
+            self.stripes.put(path, NOT_STRIPED, ttl)
+            by_node[self.read_order(nodes)[0]].append(path)
+
+        for node, paths in by_node.items():
+            try:
+                self.prefetch_attrs(node, paths)
+            except Exception:
+                # only a prefetch, getattr will ask again
+                pass
 
+        return files
+
+    def mkdir(self, path, mode):
+        '''Directories live only in the bootstrap's metadata, nodes create
+           them on demand for the files they hold. mode isn't kept'''
+        resp = self.__send_message(self.bootstrap_node, {
+            'command': 'MKDIR',
+            'path':    path,
+        })
+        if resp['reply'] != 'ACK_MKDIR':
+            raise FuseOSError(REPLY_ERRNO.get(resp['reply'], EIO))
+
+        self.attrs.pop(path)
+        return 0
+
+    def rmdir(self, path):
+        resp = self.__send_message(self.bootstrap_node, {
+            'command': 'RMDIR',
+            'path':    path,
+        })
+        if resp['reply'] != 'ACK_RMDIR':
+            raise FuseOSError(REPLY_ERRNO.get(resp['reply'], EIO))
+
+        self.attrs.put(path, NOT_FOUND, ttl=self.negative_ttl)
+        return 0
+
+    def rename(self, old, new):
+        '''Renames a file or a directory and everything under it. The
+           bootstrap has the nodes holding the data rename their copies'''
+        if self.writes:
+            # buffered writes belong to the old name
+            self.writes.flush_all()
+
+        msg = {
+            'command': 'RENAME',
+            'path':    old,
+            'new':     new,
+        }
+        resp = self.__send_message(self.bootstrap_node, msg)
+        if resp['reply'] == 'FILE_ALREADY_EXISTS':
+            # rename replaces an existing file. Not atomically, someone
+            # may create it again in between
+            self.unlink(new)
+            resp = self.__send_message(self.bootstrap_node, msg)
+        if resp['reply'] != 'ACK_RENAME':
+            raise FuseOSError(REPLY_ERRNO.get(resp['reply'], EIO))
+
+        self.forget(resp['files'])
+        self.attrs.pop(new)
+        return 0
+
+    def forget(self, paths):
+        '''Drops everything cached about paths'''
+        for path in paths:
+            self.owned.discard(path)
+            self.locations.pop(path)
+            self.stripes.pop(path)
+        self.drop_cached(paths)
+
+    def drop_cached(self, paths):
+        '''Drops the attributes and blocks cached of paths, a chunk's are
+           its file's'''
+        for path in paths:
+            path = chunk_file(path) or path
+            self.attrs.pop(path)
+            self.invalidate_blocks(path)
+
+    def lease_read(self, path, reader):
+        '''Before reader reads our copy of path: has the node holding the
+           write lease on it, unless that is reader, flush its writes, and
+           grants a remote reader a read lease'''
+        if self.leases is None:
+            return
+
+        writer = self.leases.recall(path, reader)
+        if writer is not None:
+            self.recall(path, writer)
+
+        if reader != self.local_node:
+            self.leases.grant(path, reader)
+
+    def lease_write(self, path, writer):
+        '''Grants writer the write lease on our copy of path, returns its
+           duration. The previous writer flushes its writes, and readers
+           drop what they cached so their next read recalls writer's'''
+        duration, previous = self.leases.grant_write(path, writer)
+        if previous is not None:
+            self.recall(path, previous)
+        self.break_leases(path, writer)
+        return duration
+
+    def recall(self, path, writer):
+        '''Has writer flush its buffered writes to path and give up its
+           write lease'''
+        if writer == self.local_node:
+            self.give_back(path)
         else:
-            resp = self.__send_message(node, {
-                'command': 'TRUNCATE',
+            self.call_back([writer], {
+                'command': 'RECALL',
                 'path': path,
-                'length': length,
             })
 
-            if resp['reply'] != 'ACK_TRUNCATE':
-                raise FuseOSError(EIO)
+    def break_leases(self, path, writer):
+        '''After writer changed our copy of path: calls back the other
+           nodes holding read leases on it and waits for them to drop what
+           they cached'''
+        if writer != self.local_node:
+            # our own cache, changes from here keep it up to date instead
+            self.drop_cached([path])
+        if self.leases is None:
+            return
+
+        holders = self.leases.revoke(path, writer)
+        if holders:
+            self.call_back(holders, {
+                'command': 'INVALIDATE',
+                'files': [path],
+            })
 
-    def utimens(self, path, times):
-        node = self.get_file_location(path)
+    def call_back(self, nodes, msg):
+        '''Sends msg to nodes at once, waiting at most CALLBACK_TIMEOUT'''
+        futures = [self.callbacks.submit(self.__send_message, node, dict(msg))
+                   for node in nodes]
+        done, late = wait(futures, CALLBACK_TIMEOUT)
+        failed = sum(1 for future in done if future.exception() is not None)
+        if late or failed:
+            # their leases run out instead
+            log.warning('%d of %d nodes missed %s of %s', len(late) + failed,
+                        len(nodes), msg['command'], msg.get('path') or msg.get('files'))
+
+    def take_write_lease(self, path, nodes):
+        '''Takes the write lease on path from its replicas before writes
+           to it are buffered, readers there then recall them first.
+           Striped files have none, their buffered writes wait for the
+           flush interval'''
+        if self.leases is None or path in self.write_leases:
+            return
+
+        ttl = self.leases.duration
+        for node in nodes:
+            if node == self.local_node:
+                ttl = min(ttl, self.lease_write(path, node))
+                continue
 
+            try:
+                resp = self.__send_message(node, {
+                    'command': 'LEASE',
+                    'path': path,
+                })
+            except OSError:
+                continue
+
+            if resp['reply'] == 'ACK_LEASE':
+                ttl = min(ttl, resp['lease'])
+
+        self.write_leases.put(path, True, ttl)
+
+    def report_size(self, path):
+        '''Has the size of our copy of path sent to the bootstrap in the
+           background. Changes made before it is sent go with it'''
+        if chunk_file(path):
+            # the bootstrap only knows the sizes of whole files
+            return
+
+        with self.resized_lock:
+            if path in self.resized:
+                return
+            self.resized.add(path)
+        self.executor.submit(self.send_size, path)
+
+    def send_size(self, path):
+        with self.resized_lock:
+            self.resized.discard(path)
+
+        stat = stat_file(self.fds, self.local_path(path))
+        if stat is None:
+            return
+        try:
+            self.__send_message(self.bootstrap_node, {
+                'command': 'FILE_SIZE',
+                'path': path,
+                'size': stat['st_size'],
+            })
+        except Exception as e:
+            # NODE_STATS is off until the next change
+            log.warning('reporting the size of %s failed: %s', path, e)
+
+    def give_back(self, path):
+        '''Gives up our write lease on path, flushing what it buffered'''
+        self.write_leases.pop(path)
+        self.flush(path)
+
+    def rename_local(self, old, new):
+        '''Renames our copy of old, a file or a directory, and the chunks
+           of it we hold'''
+        moves = [(self.local_path(old), self.local_path(new))]
+
+        chunks = self.local_path(f'/{CHUNK_DIR}{old}')
+        if os.path.isdir(chunks):
+            moves.append((chunks, self.local_path(f'/{CHUNK_DIR}{new}')))
+        else:
+            directory, base = os.path.split(chunks)
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                index = name[len(base) + 1:]
+                if name.startswith(base + '.') and index.isdigit():
+                    moves.append((os.path.join(directory, name),
+                                  self.local_path(chunk_path(new, int(index)))))
+
+        for src, dst in moves:
+            if not os.path.lexists(src):
+                continue
+            self.fds.invalidate_tree(src)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(src, dst)
+
+        for path in list(self.owned):
+            if path == old or path.startswith(old + '/'):
+                self.owned.discard(path)
+                self.owned.add(new + path[len(old):])
+
+    def prefetch_attrs(self, node, paths):
+        '''Fills the attribute cache for paths with one GET_ATTRS'''
         if node == self.local_node:
-            localpath = os.path.join(self.local_files, path[1:])
-            os.utime(localpath, times=times)
+            stats = dict((path, stat_file(self.fds, self.local_path(path)))
+                         for path in paths)
 
         else:
             resp = self.__send_message(node, {
-                'command': 'UTIMENS',
+                'command': 'GET_ATTRS',
+                'paths': paths,
+            })
+
+            if resp['reply'] != 'ACK_GET_ATTRS':
+                return
+
+            stats = resp['stats']
+
+        for path, stat in stats.items():
+            self.cache_attr(path, stat)
+
+    def local_path(self, path):
+        return os.path.join(self.local_files, path[1:])
+
+    def fetch(self, path, source, rate=0, chunk_size=256 * 1024):
+        '''Copies path from source for the rebalancer, at most rate bytes
+           per second. The copy goes into a partial file, so an interrupted
+           transfer resumes where it stopped, and only replaces path once it
+           matches the source's checksum'''
+        local_path = self.local_path(path)
+        part_path = local_path + PART_SUFFIX
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        throttle = Throttle(rate)
+
+        with open(part_path, 'ab') as f:
+            offset = f.tell()
+            while True:
+                throttle.consume(chunk_size)
+                resp = self.__send_message(source, {
+                    'command': 'READ',
+                    'path': path,
+                    'size': chunk_size,
+                    'offset': offset,
+                })
+
+                if resp['reply'] != 'ACK_READ':
+                    return False
+
+                f.write(resp['data'])
+                offset += len(resp['data'])
+                if len(resp['data']) < chunk_size:
+                    break
+
+        resp = self.__send_message(source, {
+            'command': 'CHECKSUM',
+            'path': path,
+        })
+
+        if resp['reply'] != 'ACK_CHECKSUM' or resp['digest'] != file_digest(part_path):
+            # changed at the source since we started, start over next time
+            os.unlink(part_path)
+            return False
+
+        os.chmod(part_path, resp['mode'])
+        self.fds.invalidate(local_path)
+        os.replace(part_path, local_path)
+        self.attrs.pop(path)
+        self.invalidate_blocks(path)
+        return True
+
+    def truncate(self, path, length, fh):
+        self.flush(path)
+
+        self.invalidate_blocks(path)
+
+        def local():
+            with self.fds.open(self.local_path(path)) as fd:
+                os.ftruncate(fd, length)
+            self.report_size(path)
+
+        try:
+            stripe = self.get_stripe(path)
+            if stripe:
+                self.truncate_striped(path, stripe, length)
+            else:
+                self.replicate(path, {
+                    'command': 'TRUNCATE',
+                    'length': length,
+                }, 'ACK_TRUNCATE', local)
+
+        except Exception:
+            # some of the replicas may have changed
+            self.attrs.pop(path)
+            raise
+
+        now = time()
+        self.update_attr(path, st_size=length, st_mtime=now, st_ctime=now)
+
+    def truncate_striped(self, path, stripe, length):
+        count = -(-length // stripe.size)
+
+        if count < len(stripe.chunks):
+            # forget the chunks first, a failed unlink then only leaks them
+            resp = self.__send_message(self.bootstrap_node, {
+                'command': 'TRUNCATE_CHUNKS',
                 'path': path,
-                'times': times,
+                'count': count,
             })
 
-            if resp['reply'] != 'ACK_UTIMENS':
+            if resp['reply'] != 'ACK_TRUNCATE_CHUNKS':
                 raise FuseOSError(EIO)
 
+            self.unlink_chunks(path, stripe, count)
+            stripe = Stripe(stripe.size, stripe.chunks[:count])
+            self.stripes.put(path, stripe, resp.get('lease'))
+        else:
+            stripe = self.place_chunks(path, stripe, count)
+
+        if not count:
+            return
+
+        i = count - 1
+        chunk = chunk_path(path, i)
+
+        def local():
+            with self.fds.open(self.local_path(chunk)) as fd:
+                os.ftruncate(fd, length - i * stripe.size)
+
+        self.replicate(chunk, {
+            'command': 'TRUNCATE',
+            'length': length - i * stripe.size,
+        }, 'ACK_TRUNCATE', local, stripe.chunks[i])
+
+    def utimens(self, path, times):
+        atime, mtime = times if times else (time(), time())
+
+        try:
+            self.replicate(path, {
+                'command': 'UTIMENS',
+                'times': times,
+            }, 'ACK_UTIMENS', lambda: os.utime(self.local_path(path), times=times))
+        except Exception:
+            self.attrs.pop(path)
+            raise
+
+        self.update_attr(path, st_atime=atime, st_mtime=mtime)
         return 0
 
     def unlink(self, path):
-        # We need to delete from bootstrap and node
-        node = self.get_file_location(path)
+        # We need to delete from bootstrap and every replica
+        if self.writes:
+            self.writes.discard(path)
 
-        if node == self.local_node:
-            localpath = os.path.join(self.local_files, path[1:])
-            os.unlink(localpath)
+        stripe = self.get_stripe(path)
 
-        else:
-            resp = self.__send_message(node, {
-                'command': 'UNLINK',
-                'path': path,
-            })
+        self.replicate(path, {
+            'command': 'UNLINK',
+        }, 'ACK_UNLINK', lambda: self.unlink_local(path))
 
-            if resp['reply'] != 'ACK_UNLINK':
-                raise FuseOSError(EIO)
+        self.owned.discard(path)
+        self.locations.pop(path)
+        self.stripes.pop(path)
+        self.attrs.put(path, NOT_FOUND, ttl=self.negative_ttl)
+        self.invalidate_blocks(path)
 
         # could make it into single bootstrap call
         resp = self.__send_message(self.bootstrap_node, {
@@ -244,159 +1343,329 @@ class FuseApi(object):
         if resp['reply'] != 'ACK_RM':
             raise FuseOSError(EIO)
 
+        if stripe:
+            self.unlink_chunks(path, stripe)
+
+
+def dir_stat():
+    '''Attributes of a directory, they have none of their own'''
+    now = time()
+    return dict(st_mode=(S_IFDIR | 0o755), st_ctime=now,
+                st_mtime=now, st_atime=now, st_nlink=2, st_size=0)
+
+
+def chunk_path(path, i):
+    '''Path of chunk i of the striped file path'''
+    return f'/{CHUNK_DIR}{path}.{i}'
+
+
+def chunk_file(path):
+    '''The striped file path is a chunk of, None if it isn't one'''
+    if not path.startswith(f'/{CHUNK_DIR}/'):
+        return None
+    return path[len(CHUNK_DIR) + 1:].rpartition('.')[0]
+
+
+def file_digest(path):
+    '''sha256 of the contents of path'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stat_file(fds, path):
+    '''Returns the stat dict sent in GET_ATTR replies, or None if path
+       doesn't exist'''
+    # fstat an already open descriptor, saves the path lookup
+    entry = fds.cached(path)
+    try:
+        stat = os.fstat(entry.fd) if entry else os.lstat(path)
+    except FileNotFoundError:
+        return None
+    finally:
+        if entry:
+            fds.release(entry)
+
+    return dict((key, getattr(stat, key)) for key in
+                ('st_atime', 'st_ctime', 'st_gid', 'st_mode',
+                 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+
 
 # FUSE(client) CODE
 class DifuseFilesystem(Operations):
     def __init__(self, api):
         self.api = api
 
-        now = time()
-        self.root = dict(st_mode=(S_IFDIR | 0o755), st_ctime=now,
-                         st_mtime=now, st_atime=now, st_nlink=2)
+        self.root = dir_stat()
+
+    def __call__(self, op, *args):
+        # every FUSE callback comes through here
+        stats = self.api.stats
+        stats.gauge('fuse_inflight', 1)
+        start = perf_counter()
+        try:
+            return super().__call__(op, *args)
+        finally:
+            stats.record(f'fuse.{op}', perf_counter() - start)
+            stats.gauge('fuse_inflight', -1)
 
     def create(self, path, mode):
-        print('create', path, mode)
+        log.debug('create %s %o', path, mode)
         return self.api.create(path, mode)
 
     def getattr(self, path, fh=None):
-        print('getattr', path, fh)
+        log.debug('getattr %s %s', path, fh)
         if path == '/':
             return self.root
 
         return self.api.getattr(path)
 
     def open(self, path, flags):
-        print('open', path, flags)
+        log.debug('open %s %s', path, flags)
         # We don't need to actually open the file,
         # we can just return 0 and handle read
         return self.api.create(path, 0o755)
         # return 0
 
     def read(self, path, size, offset, fh):
-        print('read', path, size, offset, fh)
-        return self.api.read(path, size, offset, fh)
+        log.debug('read %s %d at %d', path, size, offset)
+        data = self.api.read(path, size, offset, fh)
+        self.api.stats.count('fuse_bytes_read', len(data))
+        return data
 
     def readdir(self, path, fh):
-        print(f'readdir {path}')
-        return self.api.readdir()
+        log.debug('readdir %s', path)
+        return self.api.readdir(path)
+
+    def mkdir(self, path, mode):
+        log.debug('mkdir %s %s', path, mode)
+        return self.api.mkdir(path, mode)
+
+    def rmdir(self, path):
+        log.debug('rmdir %s', path)
+        return self.api.rmdir(path)
+
+    def rename(self, old, new):
+        log.debug('rename %s to %s', old, new)
+        return self.api.rename(old, new)
 
     statfs = None
     # def statfs(self, path):
-    #     print(f'statfs {path}')
+    #     log.debug('statfs %s', path)
     #     pass
 
     def truncate(self, path, length, fh=None):
-        print(f'truncate {path} to {length}')
+        log.debug('truncate %s to %d', path, length)
         return self.api.truncate(path, length, fh)
 
     def utimens(self, path, times=None):
-        print('utimens', path, times)
+        log.debug('utimens %s %s', path, times)
         self.api.utimens(path, times)
         pass
 
     def write(self, path, data, offset, fh):
-        print('write', path, len(data), offset)
+        log.debug('write %s %d at %d', path, len(data), offset)
+        self.api.stats.count('fuse_bytes_written', len(data))
         return self.api.write(path, data, offset, fh)
 
+    def flush(self, path, fh):
+        log.debug('flush %s', path)
+        return self.api.flush(path)
+
+    def release(self, path, fh):
+        log.debug('release %s', path)
+        return self.api.flush(path)
+
+    def fsync(self, path, datasync, fh):
+        log.debug('fsync %s', path)
+        return self.api.flush(path)
+
     def unlink(self, path):
-        print(f'unlink {path}')
+        log.debug('unlink %s', path)
         return self.api.unlink(path)
 
     def destroy(self, path):
-        print('destroy')
+        log.debug('destroy')
         shutdown()
 
 
 # Server
 class ServerHandler(RequestHandler):
+    # WRITE payloads go to disk as they arrive
+    stream_commands = ('WRITE',)
+
+    @property
+    def api(self):
+        '''The FuseApi this server serves, set as server.api (several nodes
+           can then share a process)'''
+        return self.server.api
+
     def process_msg(self, msg, client_node):
         cmd = msg.get('command')
 
         if cmd == 'GET_ATTR':
-            return self.get_attr(msg)
+            return self.get_attr(msg, client_node)
+
+        elif cmd == 'GET_ATTRS':
+            return self.get_attrs(msg, client_node)
 
         elif cmd == 'READ':
-            return self.read(msg)
+            return self.read(msg, client_node)
 
         elif cmd == 'WRITE':
-            return self.write(msg)
+            return self.write(msg, client_node)
 
         elif cmd == 'TRUNCATE':
-            return self.truncate(msg)
+            return self.truncate(msg, client_node)
 
         elif cmd == 'UTIMENS':
-            return self.utimens(msg)
+            return self.utimens(msg, client_node)
 
         elif cmd == 'UNLINK':
-            return self.unlink(msg)
+            return self.unlink(msg, client_node)
+
+        elif cmd == 'CREATE':
+            return self.create(msg)
 
         elif cmd == 'PING':
             return self.ping(msg)
 
-    def utimens(self, msg):
-        path = os.path.join(api.local_files, msg['path'][1:])
+        elif cmd == 'INVALIDATE_LOC':
+            return self.invalidate_loc(msg)
+
+        elif cmd == 'INVALIDATE':
+            return self.invalidate(msg)
+
+        elif cmd == 'LEASE':
+            return self.lease(msg, client_node)
+
+        elif cmd == 'RECALL':
+            return self.recall(msg)
+
+        elif cmd == 'RENAME':
+            return self.rename(msg)
+
+        elif cmd == 'MEMBERSHIP':
+            return self.membership(msg)
+
+        elif cmd == 'FETCH':
+            return self.fetch(msg)
+
+        elif cmd == 'CHECKSUM':
+            return self.checksum(msg)
+
+        elif cmd == 'STATS':
+            return self.stats()
+
+    def create(self, msg):
+        try:
+            self.api.create_local(msg['path'], msg['mode'])
+        except FileExistsError:
+            return {
+                'reply': 'FILE_ALREADY_EXISTS',
+            }
+
+        return {
+            'reply': 'ACK_CREATE',
+        }
+
+    def utimens(self, msg, client_node):
+        path = os.path.join(self.api.local_files, msg['path'][1:])
         times = msg['times']
 
         os.utime(path, times=tuple(times))
+        self.api.break_leases(msg['path'], client_node)
 
         return {
             'reply': 'ACK_UTIMENS',
         }
 
-    def read(self, msg):
-        path = os.path.join(api.local_files, msg['path'][1:])
+    def read(self, msg, client_node):
+        path = os.path.join(self.api.local_files, msg['path'][1:])
         size = msg['size']
         offset = msg['offset']
 
-        with open(path, 'rb') as f:
-            f.seek(offset)
-            buf = f.read(size)
+        self.api.lease_read(msg['path'], client_node)
+
+        # the descriptor stays acquired until the reply has been sent
+        entry = self.api.fds.acquire(path)
+        try:
+            size = max(0, min(size, os.fstat(entry.fd).st_size - offset))
+        except Exception:
+            self.api.fds.release(entry)
+            raise
 
+        self.api.stats.count('bytes_out', size)
         return {
             'reply': 'ACK_READ',
-            'data': b64encode(buf).decode(),
+            'data': FileRange(entry.fd, offset, size,
+                              release=lambda: self.api.fds.release(entry)),
         }
 
-    def write(self, msg):
-        path = os.path.join(api.local_files, msg['path'][1:])
+    def write(self, msg, client_node):
+        path = os.path.join(self.api.local_files, msg['path'][1:])
         offset = msg['offset']
-        data = b64decode(msg['data'].encode())
 
-        with open(path, 'wb') as f:
-            f.seek(offset)
-            f.write(data)
+        start = offset
+        with self.api.fds.open(path) as fd:
+            for chunk in msg['data']:
+                offset += os.pwrite(fd, chunk, offset)
+        self.api.stats.count('bytes_in', offset - start)
+        self.api.break_leases(msg['path'], client_node)
+        self.api.report_size(msg['path'])
 
         return {
             'reply': 'ACK_WRITE',
         }
 
-    def truncate(self, msg):
-        path = os.path.join(api.local_files, msg['path'][1:])
+    def truncate(self, msg, client_node):
+        path = os.path.join(self.api.local_files, msg['path'][1:])
         length = msg['length']
 
-        os.truncate(path, length)
+        with self.api.fds.open(path) as fd:
+            os.ftruncate(fd, length)
+        self.api.break_leases(msg['path'], client_node)
+        self.api.report_size(msg['path'])
 
         return {
             'reply': 'ACK_TRUNCATE',
         }
 
-    def get_attr(self, msg):
-        path = os.path.join(api.local_files, msg['path'][1:])
+    def get_attr(self, msg, client_node):
+        path = os.path.join(self.api.local_files, msg['path'][1:])
 
-        stat = os.lstat(path)
-        stat = dict((key, getattr(stat, key)) for key in
-                    ('st_atime', 'st_ctime', 'st_gid', 'st_mode',
-                     'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        self.api.lease_read(msg['path'], client_node)
+        stat = stat_file(self.api.fds, path)
+        if stat is None:
+            return {
+                'reply': 'FILE_NOT_FOUND',
+            }
 
         return {
             'reply': 'ACK_GET_ATTR',
             'stat': stat,
         }
 
-    def unlink(self, msg):
-        path = os.path.join(api.local_files, msg['path'][1:])
+    def get_attrs(self, msg, client_node):
+        for path in msg['paths']:
+            self.api.lease_read(path, client_node)
+        stats = dict((path, stat_file(self.api.fds, os.path.join(self.api.local_files, path[1:])))
+                     for path in msg['paths'])
+
+        return {
+            'reply': 'ACK_GET_ATTRS',
+            'stats': stats,
+        }
+
+    def unlink(self, msg, client_node):
+        path = os.path.join(self.api.local_files, msg['path'][1:])
 
+        self.api.fds.invalidate(path)
         os.unlink(path)
+        self.api.owned.discard(msg['path'])
+        self.api.break_leases(msg['path'], client_node)
 
         return {
             'reply': 'ACK_UNLINK'
@@ -407,10 +1676,96 @@ class ServerHandler(RequestHandler):
             'reply': 'ACK_PING'
         }
 
+    def stats(self):
+        return {
+            'reply': 'ACK_STATS',
+            'stats': self.api.stats.snapshot(),
+        }
+
+    def fetch(self, msg):
+        '''Rebalancer: pull a copy of a file from another node'''
+        try:
+            ok = self.api.fetch(msg['path'], Node(*msg['source']), msg.get('rate', 0))
+        except OSError:
+            ok = False
+
+        return {
+            'reply': 'ACK_FETCH' if ok else 'FETCH_FAILED',
+        }
+
+    def checksum(self, msg):
+        path = os.path.join(self.api.local_files, msg['path'][1:])
+
+        try:
+            digest = file_digest(path)
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            return {
+                'reply': 'FILE_NOT_FOUND',
+            }
+
+        return {
+            'reply': 'ACK_CHECKSUM',
+            'digest': digest,
+            'mode': mode,
+        }
+
+    def rename(self, msg):
+        '''Bootstrap: a file or directory we hold data of was renamed'''
+        self.api.rename_local(msg['path'], msg['new'])
+
+        return {
+            'reply': 'ACK_RENAME'
+        }
+
+    def invalidate_loc(self, msg):
+        '''Bootstrap push: ownership of these files changed'''
+        self.api.forget(msg.get('files', []))
+
+        return {
+            'reply': 'ACK_INVALIDATE_LOC'
+        }
+
+    def invalidate(self, msg):
+        '''Callback: files we hold read leases on changed'''
+        self.api.drop_cached(msg['files'])
+
+        return {
+            'reply': 'ACK_INVALIDATE'
+        }
+
+    def lease(self, msg, client_node):
+        '''A remote writer wants to buffer its writes to path'''
+        if self.api.leases is None:
+            return {
+                'reply': 'NO_LEASE'
+            }
+
+        return {
+            'reply': 'ACK_LEASE',
+            'lease': self.api.lease_write(msg['path'], client_node),
+        }
+
+    def recall(self, msg):
+        '''A reader of path wants our buffered writes to it first'''
+        self.api.give_back(msg['path'])
+
+        return {
+            'reply': 'ACK_RECALL'
+        }
+
+    def membership(self, msg):
+        self.api.update_membership(msg['epoch'], msg['nodes'])
+
+        return {
+            'reply': 'ACK_MEMBERSHIP'
+        }
+
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True
-    pass
+    # handler threads live as long as a peer's pooled connection
+    daemon_threads = True
 
 
 def shutdown():
@@ -428,8 +1783,40 @@ if __name__ == "__main__":
     parse.add_argument("mount_point",    type=str, help="FUSE mount point")
     parse.add_argument("local_files",    type=str, help="FUSE local file cache")
     parse.add_argument("-p", "--port",   type=int, default=8080, help="Server port (default 8080)")
+    parse.add_argument("-w", "--weight",   type=float, default=1, help="Relative share of new files placed on this node (default 1)")
+    parse.add_argument("--protocol",       type=int, default=2, choices=[1, 2], help="Highest wire protocol to negotiate, 1 is JSON+base64 (default 2)")
+    parse.add_argument("--loc-cache-size", type=int, default=4096, help="File locations to cache (default 4096)")
+    parse.add_argument("--loc-cache-ttl",  type=float, default=30.0, help="Seconds a cached file location is trusted (default 30)")
+    parse.add_argument("--attr-cache-ttl", type=float, help="Seconds a cached stat or block is trusted, at most --lease-time with leases (default the lease time, 1 without leases)")
+    parse.add_argument("--lease-time",     type=float, default=10.0, help="Seconds other nodes may cache what they read of our files without hearing from us, use the same on every node. Caches here keep entries for --attr-cache-ttl if that is shorter. 0 disables leases (default 10)")
+    parse.add_argument("--negative-ttl",   type=float, default=0.5, help="Seconds a missing file is remembered (default 0.5)")
+    parse.add_argument("--block-size",     type=int, default=128, help="Remote read cache block size in KiB (default 128)")
+    parse.add_argument("--block-cache",    type=int, default=64, help="Remote read cache budget in MiB, 0 disables (default 64)")
+    parse.add_argument("--readahead",      type=int, default=4, help="Blocks read ahead of sequential readers (default 4)")
+    parse.add_argument("--write-buffer",   type=int, default=4, help="Buffered MiB per remote file before it is flushed, 0 disables (default 4)")
+    parse.add_argument("--flush-interval", type=float, default=1.0, help="Seconds buffered writes may wait (default 1)")
+    parse.add_argument("--fd-cache",       type=int, default=256, help="Open local file descriptors to keep (default 256)")
+    parse.add_argument("--heartbeat-interval", type=float, default=1.0, help="Seconds between heartbeats to the bootstrap, 0 disables (default 1)")
+    parse.add_argument("--request-timeout", type=float, default=30.0, help="Seconds a reply from another node is waited for before trying the next replica (default 30)")
+    parse.add_argument("--stripe-size",    type=int, default=0, help="Split new files into chunks of this many KiB spread over the cluster, 0 disables (default 0)")
+    parse.add_argument("--server",         choices=['threaded', 'asyncio'], default='threaded', help="Thread per connection or asyncio node server (default threaded)")
+    parse.add_argument("--workers",        type=int, default=32, help="asyncio server request threads (default 32)")
+    parse.add_argument("-s", "--single-threaded", action='store_true', help="Run FUSE single threaded, requests then use one connection each")
+    parse.add_argument("--lock-stripes",   type=int, default=16, help="Locks each shared cache is split into for concurrent FUSE threads (default 16)")
+    parse.add_argument("--attr-timeout",   type=float, default=1.0, help="Kernel attribute cache timeout (default 1)")
+    parse.add_argument("--entry-timeout",  type=float, default=1.0, help="Kernel dentry cache timeout (default 1)")
+    parse.add_argument("--log-level",      choices=['debug', 'info', 'warning', 'error'], default='info', help="Least severe messages logged, debug logs every FUSE call (default info)")
+    parse.add_argument("--stats-file",     type=str, help="Periodically write the STATS reply here as JSON")
+    parse.add_argument("--stats-interval", type=float, default=10.0, help="Seconds between --stats-file writes (default 10)")
     args = parse.parse_args()
 
+    logging.basicConfig(level=args.log_level.upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    attr_cache_ttl = args.attr_cache_ttl
+    if attr_cache_ttl is None:
+        attr_cache_ttl = args.lease_time or 1.0
+
     local_node = Node('localhost', args.port)
     bootstrap_node = Node(args.bootstrap_addr, args.bootstrap_port)
     fuse_mount_point = args.mount_point
@@ -451,23 +1838,52 @@ if __name__ == "__main__":
             raise ValueError('fuse_mount_point exists, but is not a directory')
 
         # Connect to Bootstrap node first. Exit on failure
-        api = FuseApi(bootstrap_node, local_node, local_files)
-        print("Registered with Bootstrap")
-        print(f"We are {api.local_node.addr}:{api.local_node.port}")
+        api = FuseApi(bootstrap_node, local_node, local_files,
+                      protocol=args.protocol,
+                      loc_cache_size=args.loc_cache_size,
+                      loc_cache_ttl=args.loc_cache_ttl,
+                      attr_cache_ttl=attr_cache_ttl,
+                      negative_ttl=args.negative_ttl,
+                      block_size=args.block_size * 1024,
+                      block_cache_size=args.block_cache * 1024 * 1024,
+                      readahead=args.readahead,
+                      write_buffer=args.write_buffer * 1024 * 1024,
+                      flush_interval=args.flush_interval,
+                      fd_cache_size=args.fd_cache,
+                      weight=args.weight,
+                      multiplex=not args.single_threaded,
+                      heartbeat_interval=args.heartbeat_interval,
+                      request_timeout=args.request_timeout,
+                      stripe_size=args.stripe_size * 1024,
+                      lock_stripes=1 if args.single_threaded else args.lock_stripes,
+                      lease_time=args.lease_time)
+        log.info("Registered with Bootstrap")
+        log.info("We are %s:%d", api.local_node.addr, api.local_node.port)
 
         # Start the local server
-        server = ThreadedTCPServer(api.local_node, ServerHandler)
+        if args.server == 'asyncio':
+            server = AsyncServer(api.local_node, ServerHandler, args.workers)
+        else:
+            server = ThreadedTCPServer(api.local_node, ServerHandler)
+        server.api = api
+        server.stats = api.stats
         server_thread = threading.Thread(target=server.serve_forever)
         server_thread.daemon = True
         server_thread.start()
-        print(f"Node server started on port: {api.local_node.port}")
+        log.info("Node server started on port: %d", api.local_node.port)
+
+        if args.stats_file:
+            threading.Thread(target=api.stats.dump_loop, args=(args.stats_file, args.stats_interval), daemon=True).start()
 
         # start FUSE
-        print(f"Fuse serving files at: {fuse_mount_point}")
-        fuse = FUSE(DifuseFilesystem(api), fuse_mount_point, foreground=True)
+        log.info("Fuse serving files at: %s", fuse_mount_point)
+        fuse = FUSE(DifuseFilesystem(api), fuse_mount_point, foreground=True,
+                    nothreads=args.single_threaded,
+                    attr_timeout=args.attr_timeout,
+                    entry_timeout=args.entry_timeout)
 
     except SystemExit:
-        print('ctrl-c')
+        log.info('ctrl-c')
         # api.disconnect()
 
     except Exception as e:
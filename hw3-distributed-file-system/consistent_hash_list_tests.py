@@ -1,5 +1,7 @@
 import unittest
-from bootstrap import ConsistentHashManager
+from collections import Counter
+from bootstrap import ConsistentHashManager, BaseProtocolManager
+from utils.node import Node
 
 class TestConsistentHashManager(unittest.TestCase):
     def setUp(self):
@@ -40,6 +42,72 @@ class TestConsistentHashManager(unittest.TestCase):
 
         self.assertEqual(self.list.get_client(20000), '192.168.1.71', 'wrong client for hash')
 
+    def test_remove_client(self):
+        id = self.list.add_client('192.168.1.21')
+        self.list.add_client('192.168.1.4')
+
+        self.assertTrue(self.list.remove_client(id), 'remove failed')
+        self.assertFalse(self.list.remove_client(id), 'removed twice')
+        self.assertEqual(self.list.get_client(800000), '192.168.1.4', 'wrong client for hash')
+
+
+class TestVirtualNodes(unittest.TestCase):
+    def setUp(self):
+        self.ring = ConsistentHashManager(2 ** 32, vnodes=50)
+        self.nodes = [Node('10.0.0.{}'.format(i), 8080) for i in range(10)]
+        for node in self.nodes:
+            self.ring.add_client(node)
+
+    def test_points(self):
+        self.assertEqual(len(self.ring), 500, 'wrong number of points')
+        self.assertEqual(self.ring.ids, sorted(self.ring.ids), 'ring not sorted')
+
+    def test_remove_node(self):
+        self.assertTrue(self.ring.remove_node(self.nodes[0]))
+        self.assertEqual(len(self.ring), 450, 'points left behind')
+
+        owners = {self.ring.get_node(str(i)) for i in range(1000)}
+        self.assertNotIn(self.nodes[0], owners, 'removed node still owns keys')
+
+    def test_distribution(self):
+        counts = Counter(self.ring.get_node(f'file{i}') for i in range(10000))
+
+        self.assertEqual(len(counts), 10, 'some node owns nothing')
+        self.assertLess(max(counts.values()) / 1000, 1.5, 'load too skewed')
+
+    def test_weight(self):
+        heavy = Node('10.0.1.1', 8080)
+        self.ring.add_client(heavy, weight=3)
+
+        counts = Counter(self.ring.get_node(f'file{i}') for i in range(10000))
+        light = sum(counts[node] for node in self.nodes) / len(self.nodes)
+        self.assertGreater(counts[heavy] / light, 2, 'weight ignored')
+
+    def test_get_nodes(self):
+        nodes = self.ring.get_nodes('file', 3)
+
+        self.assertEqual(len(set(nodes)), 3, 'replicas not distinct')
+        self.assertEqual(nodes[0], self.ring.get_node('file'), 'first replica is not the owner')
+
+
+class TestPlacement(unittest.TestCase):
+    def test_ring_placement(self):
+        mgr = BaseProtocolManager(placement='ring')
+        a, b = Node('10.0.0.1', 8080), Node('10.0.0.2', 8080)
+        mgr.add_client(a)
+        mgr.add_client(b)
+
+        owners = {mgr.place_file(f'file{i}', a)[0] for i in range(100)}
+        self.assertEqual(owners, {a, b}, 'ring placement ignored')
+
+    def test_local_placement(self):
+        mgr = BaseProtocolManager()
+        a, b = Node('10.0.0.1', 8080), Node('10.0.0.2', 8080)
+        mgr.add_client(a)
+        mgr.add_client(b)
+
+        self.assertEqual(mgr.place_file('file', b), [b], 'file not kept local')
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
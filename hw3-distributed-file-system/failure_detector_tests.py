@@ -0,0 +1,50 @@
+import unittest
+from utils.failure import PhiAccrualDetector
+
+class TestPhiAccrual(unittest.TestCase):
+    def setUp(self):
+        self.detector = PhiAccrualDetector(threshold=8, interval=1.0)
+        self.node = ('10.0.0.1', 8080)
+
+        for t in range(10):
+            self.detector.heartbeat(self.node, now=float(t))
+
+    def test_unknown(self):
+        self.assertEqual(self.detector.phi(('10.0.0.2', 8080), now=100.0), 0.0, 'unknown node suspected')
+        self.assertNotIn(('10.0.0.2', 8080), self.detector)
+
+    def test_on_time(self):
+        self.assertLess(self.detector.phi(self.node, now=10.0), 1, 'on time heartbeat suspected')
+        self.assertEqual(self.detector.suspects(now=10.0), [])
+
+    def test_grows(self):
+        phis = [self.detector.phi(self.node, now=9.0 + t) for t in (1, 1.5, 2, 3)]
+        self.assertEqual(phis, sorted(phis), 'phi not growing with silence')
+
+    def test_pause(self):
+        # a stalled node (GC, swapping) isn't declared dead after a few seconds
+        for pause in (1.6, 2, 3):
+            self.assertLess(self.detector.phi(self.node, now=9.0 + pause), self.detector.threshold,
+                            f'{pause}s pause is fatal')
+        self.assertEqual(self.detector.suspects(now=12.0), [])
+
+    def test_silent(self):
+        self.assertEqual(self.detector.suspects(now=20.0), [self.node], 'silent node not suspected')
+
+        self.detector.remove(self.node)
+        self.assertEqual(self.detector.suspects(now=20.0), [], 'removed node suspected')
+
+    def test_irregular(self):
+        # a node with jittery heartbeats gets more slack
+        jittery = ('10.0.0.3', 8080)
+        t = 0.0
+        for i in range(10):
+            t += 0.5 if i % 2 else 1.5
+            self.detector.heartbeat(jittery, now=t)
+
+        self.assertGreater(self.detector.phi(self.node, now=9.0 + 2.5),
+                           self.detector.phi(jittery, now=t + 2.5), 'jitter not tolerated')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+from unittest import mock
+
+import bootstrap
+from utils.lease import LeaseTable
+from utils.node import Node
+
+class TestLeaseTable(unittest.TestCase):
+    def setUp(self):
+        self.leases = LeaseTable(duration=10)
+        self.a, self.b, self.c = Node('a', 1), Node('b', 1), Node('c', 1)
+
+    def test_revoke(self):
+        self.assertEqual(self.leases.grant('/f', self.a), 10)
+        self.leases.grant('/f', self.b)
+        self.leases.grant('/g', self.c)
+
+        self.assertEqual(sorted(self.leases.revoke('/f')), [self.a, self.b])
+        self.assertEqual(self.leases.revoke('/f'), [], 'revoked leases called back twice')
+        self.assertEqual(self.leases.revoke('/g'), [self.c])
+
+    def test_changer_keeps_lease(self):
+        self.leases.grant('/f', self.a)
+        self.leases.grant('/f', self.b)
+
+        self.assertEqual(self.leases.revoke('/f', self.a), [self.b])
+        # a still caches what it wrote
+        self.assertEqual(self.leases.revoke('/f', self.b), [self.a])
+
+    def test_recall(self):
+        self.assertEqual(self.leases.recall('/f', self.b), None)
+
+        self.assertEqual(self.leases.grant_write('/f', self.a), (10, None))
+        self.assertEqual(self.leases.recall('/f', self.a), None, "writer's own reads recalled it")
+        self.assertEqual(self.leases.recall('/f', self.b), self.a)
+        self.assertEqual(self.leases.recall('/f', self.b), None, 'recalled twice')
+
+    def test_write_taken_over(self):
+        self.leases.grant_write('/f', self.a)
+        self.assertEqual(self.leases.grant_write('/f', self.a), (10, None))
+        self.assertEqual(self.leases.grant_write('/f', self.b), (10, self.a))
+        self.assertEqual(self.leases.recall('/f', self.c), self.b)
+
+    def test_expired(self):
+        with mock.patch('utils.lease.monotonic', return_value=100):
+            self.leases.grant('/f', self.a)
+            self.leases.grant_write('/g', self.a)
+
+        with mock.patch('utils.lease.monotonic', return_value=105):
+            self.leases.grant('/f', self.b)
+
+        with mock.patch('utils.lease.monotonic', return_value=111):
+            # a's lease ran out, its cache already dropped the entries
+            self.assertEqual(self.leases.revoke('/f'), [self.b])
+            self.assertEqual(self.leases.recall('/g', self.b), None)
+            self.assertEqual(self.leases.grant_write('/g', self.b), (10, None))
+
+    def test_sweep(self):
+        self.leases.sweep_at = 4
+        with mock.patch('utils.lease.monotonic', return_value=100):
+            for i in range(3):
+                self.leases.grant(f'/f{i}', self.a)
+        self.assertEqual(len(self.leases), 3)
+
+        with mock.patch('utils.lease.monotonic', return_value=200):
+            self.leases.grant('/g', self.a)
+        self.assertEqual(len(self.leases), 1, 'expired leases kept')
+
+
+class TestMetadataLeases(unittest.TestCase):
+    '''The bootstrap only calls back the nodes caching a location'''
+    def setUp(self):
+        self.leases = bootstrap.leases
+        bootstrap.leases = LeaseTable(30)
+        self.a, self.b, self.c = Node('a', 1), Node('b', 1), Node('c', 1)
+
+    def tearDown(self):
+        bootstrap.leases = self.leases
+
+    def called_back(self, files, exclude=None, holders=()):
+        with mock.patch('bootstrap.push') as push:
+            bootstrap.call_back(files, exclude, holders)
+        if not push.called:
+            return None
+        json, exclude, nodes = push.call_args[0]
+        self.assertEqual(json, {'command': 'INVALIDATE_LOC', 'files': files})
+        return nodes - {exclude} if nodes is not None else None
+
+    def test_grant(self):
+        resp = bootstrap.grant({'reply': 'ACK_GET_FILE_LOC'}, self.a, ['/f'])
+        self.assertEqual(resp['lease'], 30)
+
+    def test_holders_only(self):
+        bootstrap.grant({}, self.a, ['/f'])
+        bootstrap.grant({}, self.b, ['/f', '/g'])
+
+        self.assertEqual(self.called_back(['/f'], exclude=self.a), {self.b})
+        self.assertEqual(self.called_back(['/f']), {self.a})
+        self.assertEqual(self.called_back(['/f']), None, 'nobody caches it any more')
+        # the nodes holding its data hear of it, leases or not
+        self.assertEqual(self.called_back(['/g'], holders=[self.c]), {self.b, self.c})
+
+    def test_disabled(self):
+        bootstrap.leases = None
+        self.assertEqual(bootstrap.grant({}, self.a, ['/f']), {})
+        # every node
+        with mock.patch('bootstrap.push') as push:
+            bootstrap.call_back(['/f'], self.a)
+        self.assertEqual(push.call_args[0][2], None)
+
+
+if __name__ == "__main__":
+    unittest.main()
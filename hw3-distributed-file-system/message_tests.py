@@ -0,0 +1,308 @@
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+from utils.connection import Connection, FileRange, SENDFILE_MIN
+from utils.message import Message, BinaryMessage
+from utils.handler import RequestHandler
+from utils.aio import AsyncServer
+from utils.mux import MuxPool
+from utils.pool import ConnectionPool
+
+class TestMessage(unittest.TestCase):
+    def test_v1_base64_data(self):
+        msg = {'command': 'WRITE', 'data': b'\x00\xffhello'}
+        buf = Message.build(msg)
+
+        self.assertNotIn(b'\x00\xff', buf, 'v1 data should be base64')
+        self.assertEqual(Message.parse(buf), msg, 'v1 round trip failed')
+
+    def test_v2_raw_data(self):
+        msg = {'command': 'WRITE', 'data': b'\x00\xffhello'}
+        buf = BinaryMessage.build(msg)
+        head = BinaryMessage.header_len
+
+        json_len, payload_len = BinaryMessage.parse_header(buf[:head])
+        self.assertEqual(payload_len, 7, 'wrong payload length')
+        self.assertEqual(buf[head + json_len:], b'\x00\xffhello', 'payload not raw')
+
+        parsed = BinaryMessage.parse_body(buf[head:head + json_len], buf[head + json_len:])
+        self.assertEqual(parsed, msg, 'v2 round trip failed')
+
+    def test_v2_empty_data(self):
+        buf = BinaryMessage.build({'reply': 'ACK_READ', 'data': b''})
+        head = BinaryMessage.header_len
+        json_len, _ = BinaryMessage.parse_header(buf[:head])
+
+        parsed = BinaryMessage.parse_body(buf[head:head + json_len], b'')
+        self.assertEqual(parsed['data'], b'', 'empty payload lost')
+
+
+class TestConnection(unittest.TestCase):
+    def test_hello(self):
+        client_sock, server_sock = socket.socketpair()
+        client, server = Connection(client_sock), Connection(server_sock)
+
+        def serve():
+            server.accept_hello(server.recv())
+            server.send(server.recv())
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        client.hello(2)
+        self.assertEqual(client.version, 2, 'client did not switch version')
+
+        client.send({'command': 'READ', 'data': b'x' * 100000})
+        self.assertEqual(client.recv()['data'], b'x' * 100000, 'large payload corrupted')
+
+        thread.join()
+        client.close()
+        server.close()
+        self.assertEqual(server.version, 2, 'server did not switch version')
+
+    def test_iter_payload(self):
+        client_sock, server_sock = socket.socketpair()
+        client, server = Connection(client_sock, 2), Connection(server_sock, 2)
+        data = bytes(range(256)) * 4096
+
+        thread = threading.Thread(target=client.send, args=({'command': 'WRITE', 'data': data},))
+        thread.start()
+
+        msg = server.recv_header()
+        self.assertEqual(server.pending, len(data), 'wrong pending length')
+        chunks = [bytes(chunk) for chunk in server.iter_payload(4096)]
+
+        thread.join()
+        client.close()
+        server.close()
+        self.assertEqual(msg['command'], 'WRITE')
+        self.assertEqual(len(chunks), len(data) // 4096, 'wrong chunking')
+        self.assertEqual(b''.join(chunks), data, 'payload corrupted')
+
+    def test_stream_failed(self):
+        server = ThreadedServer(('localhost', 0), FailingWriteHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        conn = Connection(socket.create_connection(server.server_address))
+        conn.hello(2)
+
+        data = bytes(range(256)) * 16384
+        thread = threading.Thread(target=conn.send, args=({'command': 'WRITE', 'data': data},))
+        thread.start()
+        thread.join()
+        self.assertEqual(conn.recv()['reply'], 'NO_REPLY')
+
+        # the unread payload wasn't taken for the next header
+        conn.send({'command': 'PING'})
+        self.assertEqual(conn.recv()['reply'], 'ACK_PING', 'connection broken by failed stream')
+
+        conn.close()
+        server.shutdown()
+        server.server_close()
+
+    def test_file_range(self):
+        data = os.urandom(SENDFILE_MIN * 3)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+
+            for version in (1, 2):
+                for offset, count in ((10, 100), (5, SENDFILE_MIN * 2)):
+                    client_sock, server_sock = socket.socketpair()
+                    client = Connection(client_sock, version)
+                    server = Connection(server_sock, version)
+                    released = []
+
+                    file_range = FileRange(f.fileno(), offset, count,
+                                           release=lambda: released.append(True))
+                    thread = threading.Thread(target=server.send, args=({'reply': 'ACK_READ', 'data': file_range},))
+                    thread.start()
+                    resp = client.recv()
+                    thread.join()
+                    client.close()
+                    server.close()
+
+                    self.assertEqual(resp['data'], data[offset:offset + count], f'v{version} range corrupted')
+                    self.assertEqual(released, [True], 'range not released')
+
+
+class SlowEchoHandler(RequestHandler):
+    def process_msg(self, msg, client_node):
+        time.sleep(msg['delay'])
+        return {
+            'reply': 'ACK_ECHO',
+            'n': msg['n'],
+        }
+
+
+class FailingWriteHandler(RequestHandler):
+    stream_commands = ('WRITE',)
+
+    def process_msg(self, msg, client_node):
+        if msg['command'] == 'WRITE':
+            # reads a chunk and fails, the rest is left on the socket
+            next(msg['data'])
+            raise OSError('disk full')
+        return {
+            'reply': 'ACK_PING',
+        }
+
+
+class DroppingHandler(RequestHandler):
+    '''Answers PING, carries out anything else and hangs up without a
+       reply, as a peer dying mid request would'''
+    def process_msg(self, msg, client_node):
+        if msg['command'] == 'PING':
+            return {
+                'reply': 'ACK_PING',
+            }
+        self.server.carried_out.append(msg['command'])
+
+
+class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_resend(self):
+        server = ThreadedServer(('localhost', 0), DroppingHandler)
+        server.carried_out = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = ConnectionPool()
+
+        for command in ('FILE_ADD', 'READ'):
+            # a reused connection
+            pool.request(server.server_address, {'command': 'PING'})
+            with self.assertRaises(OSError):
+                pool.request(server.server_address, {'command': command})
+
+        pool.close()
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(server.carried_out, ['FILE_ADD', 'READ', 'READ'],
+                         'only idempotent requests are resent')
+
+    def test_connection_limit(self):
+        server = ThreadedServer(('localhost', 0), SlowEchoHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = ConnectionPool(max_connections=2)
+        connect = pool.connect
+        opened = []
+
+        def counting_connect(node):
+            opened.append(node)
+            return connect(node)
+
+        pool.connect = counting_connect
+        results = []
+        threads = [threading.Thread(target=lambda n: results.append(
+                       pool.request(server.server_address, {'n': n, 'delay': 0.05})['n']), args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        pool.close()
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(sorted(results), list(range(8)), 'requests waiting for a connection lost')
+        self.assertEqual(len(opened), 2, 'more connections than the limit')
+
+    def test_timeout(self):
+        server = ThreadedServer(('localhost', 0), SlowEchoHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = ConnectionPool(timeout=0.2, max_connections=1)
+
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            pool.request(server.server_address, {'command': 'READ', 'n': 0, 'delay': 1})
+        self.assertLess(time.monotonic() - start, 0.5, 'stalled peer waited for (or resent to)')
+
+        # the late reply doesn't answer the next request, nor holds its slot
+        resp = pool.request(server.server_address, {'n': 1, 'delay': 0})
+        self.assertEqual(resp['n'], 1)
+
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+
+class TestMultiplexing(unittest.TestCase):
+    def check_out_of_order(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = MuxPool(connections=1)
+        results = {}
+        done = []
+
+        def request(n):
+            # later requests finish first
+            resp = pool.request(server.server_address, {'n': n, 'delay': (10 - n) / 100})
+            results[n] = resp['n']
+            done.append(n)
+
+        threads = [threading.Thread(target=request, args=(n,)) for n in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        pool.close()
+        server.shutdown()
+
+        self.assertEqual(results, {n: n for n in range(10)}, 'replies mixed up')
+        self.assertNotEqual(done, sorted(done), 'replies were serialised')
+
+    def test_connection_limit(self):
+        server = ThreadedServer(('localhost', 0), SlowEchoHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = MuxPool(connections=2)
+        connect = pool.connect
+        opened = []
+
+        def slow_connect(node):
+            # every caller finds all connections busy or being opened
+            time.sleep(0.05)
+            opened.append(node)
+            return connect(node)
+
+        pool.connect = slow_connect
+        threads = [threading.Thread(target=pool.request, args=(server.server_address, {'n': n, 'delay': 0.1}))
+                   for n in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        pool.close()
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(len(opened), 2, 'more connections than the limit')
+
+    def test_timeout(self):
+        server = ThreadedServer(('localhost', 0), SlowEchoHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = MuxPool(connections=1, timeout=0.2)
+
+        with self.assertRaises(TimeoutError):
+            pool.request(server.server_address, {'n': 0, 'delay': 1})
+        # other requests share the connection, it stays open
+        self.assertEqual(pool.request(server.server_address, {'n': 1, 'delay': 0})['n'], 1)
+
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+    def test_threaded_server(self):
+        self.check_out_of_order(ThreadedServer(('localhost', 0), SlowEchoHandler))
+
+    def test_asyncio_server(self):
+        self.check_out_of_order(AsyncServer(('localhost', 0), SlowEchoHandler))
+
+
+if __name__ == "__main__":
+    unittest.main()
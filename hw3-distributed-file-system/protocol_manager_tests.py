@@ -0,0 +1,450 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import bootstrap
+from bootstrap import BaseProtocolManager, Rebalancer
+from utils.node import Node
+
+class TestReverseIndex(unittest.TestCase):
+    def setUp(self):
+        self.mgr = BaseProtocolManager()
+        self.a = Node('10.0.0.1', 8080)
+        self.b = Node('10.0.0.2', 8080)
+        self.mgr.add_client(self.a)
+        self.mgr.add_client(self.b)
+
+        for i in range(10):
+            self.mgr.add_file(f'a{i}', self.a, 100)
+        for i in range(5):
+            self.mgr.add_file(f'b{i}', self.b, 10)
+
+    def stats(self, node):
+        for stats in self.mgr.node_stats():
+            if (stats['addr'], stats['port']) == node:
+                return stats
+
+    def test_stats(self):
+        self.assertEqual(self.stats(self.a)['files'], 10, 'wrong file count')
+        self.assertEqual(self.stats(self.a)['bytes'], 1000, 'wrong byte count')
+        self.assertEqual(self.stats(self.b)['bytes'], 50, 'wrong byte count')
+
+    def test_remove_file(self):
+        self.mgr.remove_file('a0')
+        self.mgr.set_file_size('a1', 300)
+
+        self.assertEqual(self.stats(self.a)['files'], 9, 'wrong file count')
+        self.assertEqual(self.stats(self.a)['bytes'], 1100, 'wrong byte count')
+
+    def test_remove_client(self):
+        self.mgr.remove_client(self.a)
+
+        self.assertIsNone(self.mgr.get_file_location('/a0'), 'file of dead node kept')
+        self.assertEqual(self.mgr.get_file_location('/b0'), self.b, 'other node lost files')
+        self.assertEqual(len(self.mgr.file_dict), 5, 'wrong file count')
+        self.assertIsNone(self.stats(self.a), 'dead node still reported')
+        entries, _ = self.mgr.list_dir('/')
+        self.assertEqual(sorted(name for name, _ in entries), [f'b{i}' for i in range(5)],
+                         'files of dead node still listed')
+
+
+class TestReplication(unittest.TestCase):
+    def setUp(self):
+        self.mgr = BaseProtocolManager(replicas=3)
+        self.nodes = [Node(f'10.0.0.{i}', 8080) for i in range(5)]
+        for node in self.nodes:
+            self.mgr.add_client(node)
+
+    def test_place_file(self):
+        nodes = self.mgr.place_file('file', self.nodes[2])
+
+        self.assertEqual(len(set(nodes)), 3, 'wrong replica count')
+        self.assertEqual(nodes[0], self.nodes[2], 'creator is not the primary')
+
+    def test_failover(self):
+        a, b, c = self.nodes[:3]
+        self.mgr.add_file('file', a, 10, replicas=[a, b, c])
+        self.mgr.remove_client(a)
+
+        self.assertEqual(self.mgr.get_replicas('/file'), (b, c), 'replica set not shrunk')
+        self.assertEqual(self.mgr.get_file_location('/file'), b, 'no new primary')
+
+        self.mgr.remove_client(b)
+        self.mgr.remove_client(c)
+        self.assertIsNone(self.mgr.get_file_location('/file'), 'file without replicas kept')
+
+    def test_add_replica(self):
+        a, b, c, d = self.nodes[:4]
+        self.mgr.add_file('file', a, 10, replicas=[a, b])
+
+        self.assertTrue(self.mgr.add_replica('file', c))
+        self.assertFalse(self.mgr.add_replica('file', d), 'replica set over target')
+        self.assertEqual(self.mgr.node_bytes[c], 10, 'replica bytes not counted')
+
+    def test_drop_replica(self):
+        a, b, c, d = self.nodes[:4]
+        self.mgr.add_file('file', a, 10, replicas=[a, b, c])
+
+        self.assertTrue(self.mgr.drop_replica('file', b))
+        self.assertEqual(self.mgr.get_replicas('/file'), (a, c), 'stale replica kept')
+        self.assertNotIn('file', self.mgr.node_files[b], 'stale replica still indexed')
+        self.assertEqual(self.mgr.node_bytes[b], 0)
+        self.assertIn('file', [file for file, _, _ in self.mgr.plan_moves()], 'not copied back')
+
+        self.assertFalse(self.mgr.drop_replica('file', d), 'dropped a node not holding it')
+        self.assertTrue(self.mgr.drop_replica('file', a))
+        self.assertFalse(self.mgr.drop_replica('file', c), 'last copy dropped')
+
+    def test_add_files(self):
+        a, b = self.nodes[:2]
+        self.mgr.add_files(a, ['x', 'y'], [1, 2])
+
+        self.assertEqual(self.mgr.add_files(b, ['y', 'z'], [2, 3]), ['y'], 'wrong shared files')
+        self.assertEqual(self.mgr.get_replicas('/y'), (a, b), 'rejoining holder not added')
+        self.assertEqual(self.mgr.get_replicas('/z'), (b,))
+
+
+class TestRebalance(unittest.TestCase):
+    def setUp(self):
+        self.mgr = BaseProtocolManager('ring', replicas=2)
+        self.nodes = [Node(f'10.0.0.{i}', 8080) for i in range(4)]
+        for node in self.nodes[:3]:
+            self.mgr.add_client(node)
+
+        for i in range(100):
+            name = f'file{i}'
+            nodes = self.mgr.place_file(name, None)
+            self.mgr.add_file(name, nodes[0], 10, nodes)
+
+    def test_balanced(self):
+        self.assertEqual(self.mgr.plan_moves(), [], 'moves planned for a balanced ring')
+
+    def test_join(self):
+        new = self.nodes[3]
+        self.mgr.add_client(new)
+
+        moves = self.mgr.plan_moves()
+        self.assertTrue(moves, 'nothing moves to a new node')
+        for file, holders, dest in moves:
+            self.assertEqual(dest, new, 'copy planned to an old node')
+
+        for file, holders, dest in moves:
+            self.assertTrue(self.mgr.commit_move(file, dest))
+            self.assertEqual(len(self.mgr.get_replicas('/' + file)), 3, 'new holder not added')
+
+            dropped = self.mgr.trim_replicas(file)
+            self.assertEqual(len(dropped), 1, 'replica set not trimmed')
+            self.assertNotIn(new, dropped, 'new holder dropped')
+            self.assertEqual(self.mgr.get_replicas('/' + file),
+                             tuple(self.mgr.ring.get_nodes(file, 2)), 'not the ring\'s replica set')
+
+        self.assertEqual(self.mgr.plan_moves(), [], 'not balanced after moving')
+        self.assertEqual(self.mgr.node_bytes[new], 10 * len(moves), 'moved bytes not counted')
+
+    def test_leave(self):
+        gone = self.nodes[0]
+        files = set(self.mgr.node_files[gone])
+        self.mgr.remove_client(gone)
+
+        moves = self.mgr.plan_moves()
+        self.assertEqual(set(file for file, _, _ in moves), files, 'under replicated files not planned')
+        for file, holders, dest in moves:
+            self.assertNotIn(gone, holders, 'copy planned from a dead node')
+
+    def test_removed_while_copying(self):
+        self.mgr.add_client(self.nodes[3])
+        file, holders, dest = self.mgr.plan_moves(1)[0]
+
+        self.mgr.remove_file(file)
+        self.assertFalse(self.mgr.commit_move(file, dest), 'removed file committed')
+
+    def moved(self, digests):
+        '''Runs a move while the source and dest copies have the checksums
+           digests[node] in turn. Returns whether it moved and the fetches'''
+        self.mgr.add_client(self.nodes[3])
+        file, holders, dest = self.mgr.plan_moves(1)[0]
+
+        rebalancer = Rebalancer(self.mgr, retry=3600)
+        rebalancer.fetch = mock.Mock(side_effect=lambda file, holders, dest: holders[0])
+        rebalancer.checksum = lambda node, file: digests[node == dest].pop(0)
+        with mock.patch('bootstrap.call_back'), mock.patch('bootstrap.send_message'):
+            moved = rebalancer.move(file, holders, dest)
+
+        self.assertEqual(len(self.mgr.get_replicas('/' + file)), 2 if moved else 3)
+        return moved, rebalancer.fetch.call_count
+
+    def test_move_refetched(self):
+        # written to again while being copied, twice
+        self.assertEqual(self.moved({False: ['a', 'b', 'c'], True: ['x', 'a', 'c']}), (True, 3))
+
+    def test_move_gives_up(self):
+        moved, fetches = self.moved({False: ['a', 'b', 'c'], True: ['x', 'y', 'z']})
+        self.assertFalse(moved, 'trimmed with copies that differ')
+        self.assertEqual(fetches, 3)
+
+
+class TestStriping(unittest.TestCase):
+    def setUp(self):
+        self.mgr = BaseProtocolManager('ring')
+        self.nodes = [Node(f'10.0.0.{i}', 8080) for i in range(4)]
+        for node in self.nodes:
+            self.mgr.add_client(node)
+        self.mgr.add_file('big', self.nodes[0], 0, (), 1024)
+
+    def test_place_chunks(self):
+        size, chunks = self.mgr.place_chunks('big', 64)
+        self.assertEqual(size, 1024)
+        self.assertEqual(len(chunks), 64)
+        self.assertEqual(set(node for nodes in chunks for node in nodes), set(self.nodes),
+                         'chunks not spread over the ring')
+
+        # growing keeps the chunks already placed
+        self.assertEqual(self.mgr.place_chunks('big', 80)[1][:64], chunks)
+        self.assertEqual(self.mgr.place_chunks('big', 10)[1], self.mgr.get_stripe('/big')[1])
+
+    def test_truncate_chunks(self):
+        chunks = self.mgr.place_chunks('big', 8)[1]
+        self.mgr.truncate_chunks('big', 3)
+        self.assertEqual(self.mgr.get_stripe('/big'), (1024, chunks[:3]))
+
+    def test_not_striped(self):
+        self.mgr.add_file('small', self.nodes[0])
+        self.assertIsNone(self.mgr.get_stripe('/small'))
+        self.assertIsNone(self.mgr.place_chunks('small', 2))
+
+        entries = dict((entry[0], entry[2:]) for entry in self.mgr.list_dir('/')[0])
+        self.assertEqual(entries, {'big': [1024], 'small': []})
+
+    def test_remove_file(self):
+        self.mgr.place_chunks('big', 2)
+        self.mgr.remove_file('big')
+        self.assertIsNone(self.mgr.get_stripe('/big'))
+
+    def test_replicated(self):
+        self.mgr.replicas = 2
+        chunks = self.mgr.place_chunks('big', 8)[1]
+        self.assertTrue(all(len(set(nodes)) == 2 for nodes in chunks), 'chunks not replicated')
+
+        gone = chunks[0][0]
+        self.mgr.remove_client(gone)
+        chunks = self.mgr.get_stripe('/big')[1]
+        self.assertTrue(all(chunks) and not any(gone in nodes for nodes in chunks),
+                        'chunk copies of a removed node kept')
+
+        i = next(i for i, nodes in enumerate(chunks) if len(nodes) == 2)
+        self.assertTrue(self.mgr.drop_replica('big', chunks[i][0], i))
+        self.assertEqual(self.mgr.get_stripe('/big')[1][i], chunks[i][1:], 'stale chunk copy kept')
+        self.assertFalse(self.mgr.drop_replica('big', chunks[i][1], i), 'last chunk copy dropped')
+
+    def test_chunk_lost(self):
+        chunks = self.mgr.place_chunks('big', 8)[1]
+        holder = chunks[0][0] if chunks[0][0] != self.nodes[0] else chunks[1][0]
+        self.mgr.remove_client(holder)
+
+        self.assertIsNone(self.mgr.get_stripe('/big'), 'file with a lost chunk kept')
+        self.assertEqual(self.mgr.list_dir('/')[0], [])
+
+
+class TestNamespace(unittest.TestCase):
+    def setUp(self):
+        self.mgr = BaseProtocolManager()
+        self.a = Node('10.0.0.1', 8080)
+        self.b = Node('10.0.0.2', 8080)
+        self.mgr.add_client(self.a)
+        self.mgr.add_client(self.b)
+
+    def names(self, path):
+        return [entry[0] for entry in self.mgr.list_dir(path)[0]]
+
+    def test_parents_created(self):
+        self.assertTrue(self.mgr.add_file('a/b/f', self.a))
+        self.assertTrue(self.mgr.is_dir('/a/b'))
+        self.assertEqual(self.names('/'), ['a'])
+        self.assertEqual(self.names('/a'), ['b'])
+        self.assertEqual(self.mgr.list_dir('/a/b')[0], [['f', [['10.0.0.1', 8080]]]])
+
+        self.assertFalse(self.mgr.add_file('a/b', self.a), 'file replaced a directory')
+        self.assertFalse(self.mgr.add_file('a/b/f/g', self.a), 'file under a file')
+        self.assertIsNone(self.mgr.list_dir('/a/b/f'))
+
+    def test_mkdir_rmdir(self):
+        self.assertIsNone(self.mgr.mkdir('d'))
+        self.assertEqual(self.mgr.mkdir('d'), 'FILE_ALREADY_EXISTS')
+        self.assertEqual(self.mgr.mkdir('x/y'), 'FILE_NOT_FOUND')
+
+        self.mgr.add_file('d/f', self.a)
+        self.assertEqual(self.mgr.mkdir('d/f/g'), 'NOT_DIR')
+        self.assertEqual(self.mgr.rmdir('d'), 'NOT_EMPTY')
+        self.assertEqual(self.mgr.rmdir('d/f'), 'NOT_DIR')
+
+        self.mgr.remove_file('d/f')
+        self.assertIsNone(self.mgr.rmdir('d'))
+        self.assertEqual(self.mgr.rmdir('d'), 'FILE_NOT_FOUND')
+        self.assertEqual(self.names('/'), [])
+
+    def test_rename_file(self):
+        self.mgr.add_file('f', self.a, 5, [self.a, self.b])
+        error, nodes, files = self.mgr.rename('f', 'd/g')
+        self.assertEqual(error, 'FILE_NOT_FOUND', 'renamed into a missing directory')
+
+        self.mgr.mkdir('d')
+        error, nodes, files = self.mgr.rename('f', 'd/g')
+        self.assertIsNone(error)
+        self.assertEqual(set(nodes), {self.a, self.b})
+        self.assertEqual(files, ['f'])
+        self.assertIsNone(self.mgr.get_file_location('/f'))
+        self.assertEqual(self.mgr.get_replicas('/d/g'), (self.a, self.b))
+        self.assertEqual(self.mgr.file_sizes['d/g'], 5)
+        self.assertEqual(self.mgr.node_files[self.a], {'d/g'})
+
+        self.mgr.add_file('h', self.a)
+        self.assertEqual(self.mgr.rename('h', 'd/g')[0], 'FILE_ALREADY_EXISTS')
+
+    def test_rename_dir(self):
+        self.mgr.add_file('d/e/f', self.a)
+        self.mgr.add_file('d/g', self.b)
+        self.assertEqual(self.mgr.rename('d', 'd/e/x')[0], 'INVALID', 'directory moved into itself')
+
+        error, nodes, files = self.mgr.rename('d', 'n')
+        self.assertIsNone(error)
+        self.assertEqual(set(nodes), {self.a, self.b})
+        self.assertEqual(sorted(files), ['d/e/f', 'd/g'])
+        self.assertFalse(self.mgr.is_dir('/d'))
+        self.assertEqual(self.names('/n'), ['e', 'g'])
+        self.assertEqual(self.mgr.get_file_location('/n/e/f'), self.a)
+
+    def test_pages(self):
+        for i in range(25):
+            self.mgr.add_file(f'd/{i:02d}', self.a)
+        self.mgr.mkdir('d/sub')
+
+        names = []
+        cursor = None
+        while True:
+            entries, cursor = self.mgr.list_dir('/d', cursor, 10)
+            self.assertLessEqual(len(entries), 10)
+            names += [entry[0] for entry in entries]
+            if cursor is None:
+                break
+        self.assertEqual(names, [f'{i:02d}' for i in range(25)] + ['sub'])
+
+        # entries removed between pages don't shift the next one
+        entries, cursor = self.mgr.list_dir('/d', None, 10)
+        self.mgr.remove_file('d/05')
+        self.assertEqual(self.mgr.list_dir('/d', cursor, 1)[0][0][0], '10')
+
+
+class TestDurability(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.nodes = [Node(f'10.0.0.{i}', 8080) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def manager(self):
+        mgr = BaseProtocolManager('ring', replicas=2)
+        mgr.open_log(self.dir)
+        return mgr
+
+    def restored(self):
+        mgr = self.manager()
+        mgr.wal.close()
+        return mgr
+
+    def state(self, mgr):
+        return (mgr.file_dict, mgr.file_sizes, mgr.node_files, mgr.node_bytes,
+                mgr.nodes, mgr.weights, mgr.epoch, mgr.ring.ids, mgr.ring.addrs,
+                mgr.stripes, mgr.dirs)
+
+    def mutate(self, mgr, prefix):
+        a, b, c = self.nodes
+        mgr.add_client(a)
+        mgr.add_client(b, 2)
+        mgr.add_files(a, [f'{prefix}x', f'{prefix}y'], [1, 2])
+        mgr.add_file(f'{prefix}z', b, 3, [b, c])
+        mgr.add_replica(f'{prefix}x', b)
+        mgr.set_file_size(f'{prefix}y', 20)
+        mgr.remove_file(f'{prefix}z')
+        mgr.add_client(c)
+        mgr.commit_move(f'{prefix}y', c)
+        mgr.trim_replicas(f'{prefix}y')
+        mgr.add_replica(f'{prefix}y', b)
+        mgr.drop_replica(f'{prefix}y', c)
+        mgr.add_file(f'{prefix}s', c, 0, [c], 4096)
+        mgr.place_chunks(f'{prefix}s', 4)
+        mgr.truncate_chunks(f'{prefix}s', 2)
+        mgr.drop_replica(f'{prefix}s', mgr.get_stripe(f'/{prefix}s')[1][1][0], 1)
+        mgr.add_file(f'{prefix}d/e/f', b, 6)
+        mgr.mkdir(f'{prefix}d/empty')
+        mgr.rename(f'{prefix}d', f'{prefix}n')
+        mgr.rename(f'{prefix}x', f'{prefix}n/x')
+        mgr.rmdir(f'{prefix}n/empty')
+        mgr.remove_client(a)
+
+    def test_replay(self):
+        mgr = self.manager()
+        self.mutate(mgr, '')
+        mgr.wal.close()
+
+        self.assertEqual(self.state(self.restored()), self.state(mgr), 'state not restored from the log')
+
+    def test_snapshot(self):
+        mgr = self.manager()
+        self.mutate(mgr, 'old')
+        mgr.checkpoint()
+        mgr.remove_file('oldy')
+        mgr.add_file('new', self.nodes[1], 5)
+        mgr.wal.close()
+
+        self.assertEqual(mgr.wal.segments(), [mgr.wal.segment], 'covered segments kept')
+        self.assertEqual(self.state(self.restored()), self.state(mgr), 'state not restored from the snapshot')
+
+    def test_checkpoint_failed(self):
+        mgr = mock.Mock()
+        mgr.wal.records = 1
+        mgr.checkpoint.side_effect = [OSError('disk full'), None]
+
+        with mock.patch('bootstrap.base_mgr', mgr), mock.patch('bootstrap.sleep', side_effect=[None, None]):
+            with self.assertLogs('bootstrap', 'ERROR'), self.assertRaises(StopIteration):
+                bootstrap.checkpoint_log(60)
+        self.assertEqual(mgr.checkpoint.call_count, 2, 'checkpoints stopped after a failure')
+
+    def test_torn_record(self):
+        mgr = self.manager()
+        mgr.add_client(self.nodes[0])
+        mgr.add_file('kept', self.nodes[0], 1)
+        mgr.wal.close()
+
+        with open(mgr.wal.path(mgr.wal.segment), 'ab') as f:
+            f.write(b'["add_file","lost"')
+
+        restored = self.restored()
+        self.assertEqual(list(restored.file_dict), ['kept'], 'torn record not skipped')
+
+    def test_concurrent(self):
+        mgr = self.manager()
+        mgr.add_client(self.nodes[0])
+
+        def work(t):
+            for i in range(50):
+                mgr.add_file(f'{t}-{i}', self.nodes[0], i)
+                if i % 2:
+                    mgr.remove_file(f'{t}-{i}')
+
+        threads = [threading.Thread(target=work, args=(t,)) for t in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        mgr.wal.close()
+
+        self.assertEqual(len(mgr.file_dict), 200)
+        self.assertEqual(self.state(self.restored()), self.state(mgr), 'concurrent mutations replayed out of order')
+
+
+if __name__ == "__main__":
+    unittest.main()
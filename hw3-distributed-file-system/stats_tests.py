@@ -0,0 +1,47 @@
+import unittest
+from utils.stats import Histogram, Stats, bucket_of, value_of
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.histogram = Histogram()
+
+    def test_buckets(self):
+        for us in [0, 1, 63, 64, 100, 1000, 123456, 10 ** 9]:
+            value = value_of(bucket_of(us))
+            self.assertLessEqual(abs(value - us), us * 0.04, f'{us}us lands at {value}us')
+
+        buckets = [bucket_of(us) for us in range(200000)]
+        self.assertEqual(buckets, sorted(buckets), 'buckets out of order')
+
+    def test_percentiles(self):
+        # 1..1000 ms
+        for ms in range(1, 1001):
+            self.histogram.record(ms / 1000)
+
+        p50, p99 = self.histogram.percentiles([50, 99])
+        self.assertAlmostEqual(p50, 500000, delta=500000 * 0.04)
+        self.assertAlmostEqual(p99, 990000, delta=990000 * 0.04)
+
+        snapshot = self.histogram.snapshot()
+        self.assertEqual(snapshot['count'], 1000)
+        self.assertEqual(snapshot['max_us'], 1000000)
+        self.assertAlmostEqual(snapshot['mean_us'], 500500, delta=1)
+
+    def test_empty(self):
+        self.assertEqual(self.histogram.snapshot()['p99_us'], 0)
+
+
+class TestStats(unittest.TestCase):
+    def test_snapshot(self):
+        stats = Stats()
+        stats.record('rpc.READ', 0.001)
+        stats.count('bytes_out', 10)
+        stats.count('bytes_out', 5)
+        stats.gauge('inflight', 1)
+        stats.register('caches', lambda: {'attrs': {'hits': 1}})
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['latency']['rpc.READ']['count'], 1)
+        self.assertEqual(snapshot['counters'], {'bytes_out': 15})
+        self.assertEqual(snapshot['gauges'], {'inflight': 1})
+        self.assertEqual(snapshot['caches'], {'attrs': {'hits': 1}})
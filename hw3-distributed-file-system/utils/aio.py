@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.connection import FileRange, COALESCE_LIMIT
+from utils.message import Message, BinaryMessage, PROTOCOLS, DATA
+from utils.node import Node
+
+log = logging.getLogger(__name__)
+
+
+class AsyncServer():
+    '''asyncio alternative to ThreadedTCPServer. One event loop owns every
+       connection, handler_class.process_msg (which does blocking file and
+       network I/O) runs on a bounded thread pool'''
+    def __init__(self, server_address, handler_class, max_workers=32):
+        self.handler_class = handler_class
+        self.executor = ThreadPoolExecutor(max_workers)
+
+        # bind now so errors surface like they do for TCPServer
+        # (create_server sets SO_REUSEADDR)
+        self.socket = socket.create_server(tuple(server_address))
+        self.server_address = self.socket.getsockname()[:2]
+
+        self.loop = None
+        self.server = None
+        self.stopped = threading.Event()
+
+    def serve_forever(self):
+        asyncio.run(self.main())
+        self.stopped.set()
+
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.stopped.wait()
+        self.executor.shutdown(wait=False)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, sock=self.socket)
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                # close() from shutdown
+                pass
+
+    async def handle(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        handler = self.handler_class.detached(self, writer.get_extra_info('peername'))
+        version = 1
+        # multiplexed replies are written by their own tasks
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        try:
+            while True:
+                msg = await self.read_message(reader, version)
+                if msg is None:
+                    break
+
+                if msg.get('command') == 'HELLO':
+                    common = set(msg.get('versions', [])) & set(PROTOCOLS)
+                    new_version = max(common, default=version)
+                    async with write_lock:
+                        await self.write_message(writer, version, {
+                            'reply': 'ACK_HELLO',
+                            'version': new_version,
+                        })
+                    version = new_version
+                    continue
+
+                if msg.get('command') in handler.stream_commands:
+                    # already in memory, hand it over as a single chunk
+                    msg[DATA] = iter([msg[DATA]] if msg.get(DATA) else [])
+
+                client_node = Node(handler.client_address[0], msg.get('port'))
+
+                if 'id' in msg:
+                    # answered out of order, whenever it is done
+                    task = asyncio.create_task(self.process_mux(
+                        handler, writer, write_lock, version, msg, client_node))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    continue
+
+                response = await self.loop.run_in_executor(
+                    self.executor, handler.dispatch, msg, client_node)
+                if not response:
+                    break
+
+                async with write_lock:
+                    await self.write_message(writer, version, response)
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+        except asyncio.CancelledError:
+            # server shutting down with the connection still open
+            pass
+
+        finally:
+            writer.close()
+
+    async def process_mux(self, handler, writer, write_lock, version, msg, client_node):
+        try:
+            response = await self.loop.run_in_executor(
+                self.executor, handler.dispatch, msg, client_node)
+        except Exception as e:
+            log.warning('%s failed: %s', msg.get('command'), e)
+            response = None
+
+        response = dict(response or {'reply': 'NO_REPLY'})
+        response['id'] = msg['id']
+        try:
+            async with write_lock:
+                await self.write_message(writer, version, response)
+        except ConnectionError:
+            pass
+
+    async def read_message(self, reader, version):
+        '''Returns the next message, or None at a clean end of stream'''
+        if version == 1:
+            length = await reader.read(4)
+            if not length:
+                return None
+            length += await reader.readexactly(4 - len(length))
+            data = await reader.readexactly(Message.parse_length(length))
+            return Message.parse(length + data)
+
+        header = await reader.read(BinaryMessage.header_len)
+        if not header:
+            return None
+        header += await reader.readexactly(BinaryMessage.header_len - len(header))
+        json_len, payload_len = BinaryMessage.parse_header(header)
+
+        body = await reader.readexactly(json_len)
+        payload = await reader.readexactly(payload_len) if payload_len else b''
+        return BinaryMessage.parse_body(body, payload)
+
+    async def write_message(self, writer, version, obj):
+        data = obj.get(DATA)
+        if isinstance(data, FileRange):
+            # blocking pread, keep it off the loop
+            try:
+                obj = dict(obj)
+                obj[DATA] = await self.loop.run_in_executor(self.executor, data.read)
+            finally:
+                data.close()
+
+        if version == 1:
+            writer.write(Message.build(obj))
+        else:
+            head, data = BinaryMessage.build_parts(obj)
+            if len(data) < COALESCE_LIMIT:
+                writer.write(head + bytes(data))
+            else:
+                writer.write(head)
+                writer.write(data)
+
+        await writer.drain()
@@ -0,0 +1,203 @@
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic
+
+from utils.stats import ratio
+
+
+class BlockCache():
+    '''LRU cache of fixed size blocks of remote files. Sequential readers
+       get the next blocks fetched in the background (read-ahead)'''
+    def __init__(self, fetch, block_size=128 * 1024, capacity=64 * 1024 * 1024,
+                 readahead=4, ttl=1.0, workers=4, streams=1024):
+        # fetch(path, offset, size) -> bytes, does the actual remote READ
+        self.fetch = fetch
+        self.block_size = block_size
+        # memory budget in bytes
+        self.capacity = capacity
+        # blocks fetched ahead of a sequential reader
+        self.readahead = readahead
+        self.ttl = ttl
+        # files whose sequential readers are followed, the least recently
+        # read are forgotten
+        self.streams = streams
+
+        self.lock = threading.Lock()
+        # (path, index) -> (bytes, expires)
+        self.blocks = OrderedDict()
+        self.size = 0
+        # path -> cached block indices, for invalidation
+        self.paths = defaultdict(set)
+        # (path, index) -> Future of a fetch in progress. Invalidation drops
+        # them, a fetch no longer in here is stale and isn't cached
+        self.inflight = {}
+        # Futures whose fetch a thread is running
+        self.started = set()
+        # path -> offset the next sequential read would start at, least
+        # recently read first
+        self.next_offset = OrderedDict()
+        # reads of a block that was cached (or being read ahead), and of
+        # one that had to be fetched
+        self.hits = 0
+        self.misses = 0
+
+        self.executor = ThreadPoolExecutor(workers)
+
+    def read(self, path, size, offset):
+        bs = self.block_size
+
+        with self.lock:
+            sequential = self.next_offset.pop(path, None) == offset
+            self.next_offset[path] = offset + size
+            if len(self.next_offset) > self.streams:
+                self.next_offset.popitem(last=False)
+
+        first = offset // bs
+        last = (offset + size - 1) // bs if size else first
+
+        parts = []
+        full = True
+        for index in range(first, last + 1):
+            block = self.get_block(path, index)
+
+            start = offset - index * bs if index == first else 0
+            end = offset + size - index * bs
+            parts.append(block[start:end])
+
+            if len(block) < bs:
+                # end of file
+                full = False
+                break
+
+        if sequential and full:
+            self.prefetch(path, range(last + 1, last + 1 + self.readahead))
+
+        return b''.join(parts)
+
+    def lookup(self, key):
+        '''Returns the cached block, or the Future of its fetch, or None.
+           Called with the lock held'''
+        entry = self.blocks.get(key)
+        if entry is not None:
+            block, expires = entry
+            if expires > monotonic():
+                self.blocks.move_to_end(key)
+                return block
+            self.drop(key)
+
+        return self.inflight.get(key)
+
+    def get_block(self, path, index):
+        key = (path, index)
+        with self.lock:
+            found = self.lookup(key)
+            owner = found is None
+            if owner:
+                found = self.start_fetch(key)
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if isinstance(found, Future):
+            # a read ahead still queued behind the other readers' is done
+            # here instead, the executor's turn finds it claimed
+            self.run_fetch(key, found)
+            return found.result()
+        return found
+
+    def prefetch(self, path, indices):
+        with self.lock:
+            keys = [(path, index) for index in indices]
+            keys = [key for key in keys if self.lookup(key) is None]
+            futures = [self.start_fetch(key) for key in keys]
+
+        for key, future in zip(keys, futures):
+            self.executor.submit(self.run_fetch, key, future)
+
+    def start_fetch(self, key):
+        '''Registers a fetch in progress. Called with the lock held'''
+        future = Future()
+        self.inflight[key] = future
+        return future
+
+    def claim(self, future):
+        '''Marks a fetch as started, False if another thread started it'''
+        with self.lock:
+            if future in self.started or future.done():
+                return False
+            self.started.add(future)
+            return True
+
+    def run_fetch(self, key, future):
+        if not self.claim(future):
+            return
+
+        path, index = key
+        try:
+            block = self.fetch(path, index * self.block_size, self.block_size)
+        except Exception as e:
+            with self.lock:
+                if self.inflight.get(key) is future:
+                    del self.inflight[key]
+            future.set_exception(e)
+        else:
+            with self.lock:
+                if self.inflight.get(key) is future:
+                    del self.inflight[key]
+                    self.insert(key, block)
+            future.set_result(block)
+
+        with self.lock:
+            # done() turns away late claims from now on
+            self.started.discard(future)
+
+    def insert(self, key, block):
+        '''Called with the lock held'''
+        self.drop(key)
+        self.blocks[key] = (block, monotonic() + self.ttl)
+        self.paths[key[0]].add(key[1])
+        self.size += len(block)
+
+        while self.size > self.capacity and self.blocks:
+            self.drop(next(iter(self.blocks)))
+
+    def drop(self, key):
+        '''Called with the lock held'''
+        entry = self.blocks.pop(key, None)
+        if entry is None:
+            return
+
+        self.size -= len(entry[0])
+        indices = self.paths[key[0]]
+        indices.discard(key[1])
+        if not indices:
+            del self.paths[key[0]]
+
+    def invalidate(self, path):
+        with self.lock:
+            self.next_offset.pop(path, None)
+            for index in list(self.paths.get(path, ())):
+                self.drop((path, index))
+            for key in [key for key in self.inflight if key[0] == path]:
+                del self.inflight[key]
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.paths.clear()
+            self.inflight.clear()
+            self.next_offset.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'blocks': len(self.blocks),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': ratio(self.hits, self.misses),
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from utils.stats import ratio
+from utils.striped import Striped
+
+
+class LRUCache():
+    '''Bounded least-recently-used map whose entries expire after ttl seconds
+       (ttl=None never expires)'''
+    def __init__(self, capacity=1024, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        # key -> (value, expires)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if expires is not None and expires <= monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else monotonic() + ttl
+
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def remove_value(self, value):
+        '''Drops every entry mapping to value'''
+        return self.remove_if(lambda v: v == value)
+
+    def remove_if(self, predicate):
+        '''Drops every entry whose value satisfies predicate'''
+        with self.lock:
+            keys = [key for key, (v, _) in self.entries.items() if predicate(v)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': ratio(self.hits, self.misses),
+        }
+
+
+class StripedLRUCache(Striped):
+    '''LRUCache split into stripes, for caches every FUSE thread goes
+       through'''
+    def __init__(self, capacity=1024, ttl=None, stripes=16):
+        super().__init__(lambda: LRUCache(-(-capacity // stripes), ttl), stripes)
+
+    def __contains__(self, key):
+        return key in self.stripe(key)
+
+    def get(self, key, default=None):
+        return self.stripe(key).get(key, default)
+
+    def put(self, key, value, ttl=None):
+        self.stripe(key).put(key, value, ttl)
+
+    def pop(self, key, default=None):
+        return self.stripe(key).pop(key, default)
+
+    def remove_value(self, value):
+        return sum(stripe.remove_value(value) for stripe in self.stripes)
+
+    def remove_if(self, predicate):
+        return sum(stripe.remove_if(predicate) for stripe in self.stripes)
+
+    def clear(self):
+        for stripe in self.stripes:
+            stripe.clear()
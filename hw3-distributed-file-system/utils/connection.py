@@ -0,0 +1,221 @@
+import os
+
+from utils.message import Message, BinaryMessage, PROTOCOLS, DATA
+
+# payloads smaller than this are copied into the header's send buffer
+COALESCE_LIMIT = 64 * 1024
+# file ranges smaller than this are pread and sent with the header, one
+# syscall pair is cheaper than sendfile plus a separate header send
+SENDFILE_MIN = 64 * 1024
+
+
+class FileRange():
+    '''Bulk data that is sent straight from a file (os.sendfile) instead of
+       being read into memory first. count must not run past end of file'''
+    def __init__(self, fd, offset, count, release=None):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+        # called once the range has been sent (or given up on)
+        self.release = release
+
+    def __len__(self):
+        return self.count
+
+    def read(self):
+        return os.pread(self.fd, self.count, self.offset)
+
+    def sendfile(self, sock):
+        offset, remaining = self.offset, self.count
+        while remaining > 0:
+            sent = os.sendfile(sock.fileno(), self.fd, offset, remaining)
+            if not sent:
+                raise EOFError('file shrank while it was being sent')
+            offset += sent
+            remaining -= sent
+
+    def close(self):
+        if self.release:
+            self.release()
+            self.release = None
+
+
+class FramedReader():
+    '''Reads exact sized frames from a socket with recv_into, reusing one
+       preallocated buffer so messages are not built up by concatenation'''
+    def __init__(self, sock, bufsize=64 * 1024, max_bufsize=4 * 1024 * 1024):
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        # frames larger than this get a buffer of their own rather than
+        # growing (and pinning) the shared one
+        self.max_bufsize = max_bufsize
+
+    def fill(self, view):
+        '''Fills view completely, returns False if the peer closed first'''
+        got = 0
+        n = len(view)
+        while got < n:
+            read = self.sock.recv_into(view[got:])
+            if not read:
+                return False
+            got += read
+        return True
+
+    def read_exact(self, n):
+        '''Returns a memoryview of the next n bytes (None on EOF). The view
+           is only valid until the next read'''
+        if n > len(self.buf):
+            if n > self.max_bufsize:
+                view = memoryview(bytearray(n))
+                return view if self.fill(view) else None
+            self.buf = bytearray(n)
+
+        view = memoryview(self.buf)[:n]
+        return view if self.fill(view) else None
+
+    def iter_exact(self, n, chunk_size=None):
+        '''Yields the next n bytes as a series of memoryviews, each only
+           valid until the next one is requested'''
+        chunk_size = min(chunk_size or len(self.buf), len(self.buf))
+        while n > 0:
+            view = self.read_exact(min(n, chunk_size))
+            if view is None:
+                raise ConnectionResetError('connection closed mid payload')
+            n -= len(view)
+            yield view
+
+
+class Connection():
+    '''A socket plus the wire protocol version in use on it. Every
+       connection starts at version 1, HELLO switches it to a newer one'''
+    def __init__(self, sock, version=1):
+        self.sock = sock
+        self.version = version
+        self.reader = FramedReader(sock)
+        # payload bytes of the last header that haven't been read yet
+        self.pending = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, obj):
+        data = obj.get(DATA)
+        if isinstance(data, FileRange):
+            try:
+                self.send_file(obj, data)
+            finally:
+                data.close()
+            return
+
+        if self.version == 1:
+            self.sock.sendall(Message.build(obj))
+            return
+
+        head, data = BinaryMessage.build_parts(obj)
+        if len(data) < COALESCE_LIMIT:
+            self.sock.sendall(head + bytes(data))
+        else:
+            self.sock.sendall(head)
+            self.sock.sendall(data)
+
+    def send_file(self, obj, file_range):
+        if self.version == 1 or len(file_range) < SENDFILE_MIN:
+            obj = dict(obj)
+            obj[DATA] = file_range.read()
+            self.send(obj)
+            return
+
+        head, _ = BinaryMessage.build_parts(obj)
+        self.sock.sendall(head)
+        file_range.sendfile(self.sock)
+
+    def recv_header(self):
+        '''Reads the next message without its bulk payload, which is left
+           in self.pending bytes for recv_payload/iter_payload. Returns None
+           when the peer has closed'''
+        self.skip_payload()
+
+        if self.version == 1:
+            length = self.reader.read_exact(4)
+            if length is None:
+                return None
+            length = bytes(length)
+            data = self.reader.read_exact(Message.parse_length(length))
+            if data is None:
+                return None
+            return Message.parse(length + bytes(data))
+
+        header = self.reader.read_exact(BinaryMessage.header_len)
+        if header is None:
+            return None
+        json_len, payload_len = BinaryMessage.parse_header(bytes(header))
+
+        body = self.reader.read_exact(json_len)
+        if body is None:
+            return None
+
+        self.pending = payload_len
+        return BinaryMessage.parse_body(body, b'')
+
+    def recv_payload(self, copy=True):
+        '''Reads the whole pending payload. With copy=False the result is a
+           view of the read buffer, only valid until the next read'''
+        n, self.pending = self.pending, 0
+        if not n:
+            return b''
+
+        view = self.reader.read_exact(n)
+        if view is None:
+            raise ConnectionResetError('connection closed mid payload')
+        return bytes(view) if copy else view
+
+    def iter_payload(self, chunk_size=None):
+        '''Yields the pending payload in chunks as it arrives. What isn't
+           consumed stays pending, recv_header skips it'''
+        for view in self.reader.iter_exact(self.pending, chunk_size):
+            self.pending -= len(view)
+            yield view
+
+    def skip_payload(self):
+        '''Discards whatever is left of the pending payload'''
+        for _ in self.iter_payload():
+            pass
+
+    def recv(self, copy=True):
+        '''Returns the next message, or None when the peer has closed'''
+        msg = self.recv_header()
+        if msg is not None and self.pending:
+            msg[DATA] = self.recv_payload(copy)
+        return msg
+
+    def hello(self, version):
+        '''Client side of the negotiation, asks the peer to switch to the
+           highest version we both speak'''
+        if version == self.version:
+            return
+
+        self.send({
+            'command': 'HELLO',
+            'versions': sorted(v for v in PROTOCOLS if v <= version),
+        })
+        resp = self.recv()
+        if resp is None:
+            raise ConnectionResetError('connection closed by peer')
+
+        if resp.get('reply') == 'ACK_HELLO':
+            self.version = resp['version']
+
+    def accept_hello(self, msg):
+        '''Server side of the negotiation, replies in the current version
+           and only then switches'''
+        common = set(msg.get('versions', [])) & set(PROTOCOLS)
+        version = max(common, default=self.version)
+
+        self.send({
+            'reply': 'ACK_HELLO',
+            'version': version,
+        })
+        self.version = version
@@ -0,0 +1,80 @@
+import math
+import threading
+from collections import deque
+from time import monotonic
+
+
+class PhiAccrualDetector():
+    '''Phi accrual failure detector (Hayashibara et al.). Keeps the recent
+       heartbeat intervals of every node and turns the time since its last
+       heartbeat into phi, -log10 of the chance that a live node would have
+       been silent that long. phi 8 is a 1 in 10^8 false positive'''
+    def __init__(self, threshold=8.0, interval=1.0, window=100, min_std=None,
+                 acceptable_pause=None):
+        self.threshold = threshold
+        # expected heartbeat interval, seeds the history of new nodes
+        self.interval = interval
+        # intervals kept per node
+        self.window = window
+        # floor on the deviation, keeps phi from exploding on a node whose
+        # heartbeats have been perfectly regular. A quarter interval by
+        # default
+        self.min_std = interval / 4 if min_std is None else min_std
+        # extra silence tolerated (GC pauses, busy disks), an interval by
+        # default. With both defaults a node is suspected after about 3.3
+        # intervals of silence
+        self.acceptable_pause = interval if acceptable_pause is None else acceptable_pause
+
+        self.lock = threading.Lock()
+        # node -> time of its last heartbeat
+        self.last = {}
+        # node -> deque of intervals
+        self.intervals = {}
+
+    def __contains__(self, node):
+        return node in self.last
+
+    def heartbeat(self, node, now=None):
+        now = monotonic() if now is None else now
+
+        with self.lock:
+            last = self.last.get(node)
+            if last is None:
+                # pretend we saw a spread of intervals around the expected one
+                self.intervals[node] = deque([self.interval * 0.75, self.interval * 1.25],
+                                             maxlen=self.window)
+            else:
+                self.intervals[node].append(now - last)
+            self.last[node] = now
+
+    def phi(self, node, now=None):
+        now = monotonic() if now is None else now
+
+        with self.lock:
+            last = self.last.get(node)
+            if last is None:
+                return 0.0
+            intervals = self.intervals[node]
+            mean = sum(intervals) / len(intervals)
+            var = sum((i - mean) ** 2 for i in intervals) / len(intervals)
+
+        std = max(math.sqrt(var), self.min_std)
+        y = (now - last - mean - self.acceptable_pause) / std
+        # logistic approximation of the normal CDF
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            p = e / (1 + e)
+        else:
+            p = 1 - 1 / (1 + e)
+        return -math.log10(max(p, 1e-300))
+
+    def suspects(self, now=None):
+        '''Nodes whose phi is over the threshold'''
+        with self.lock:
+            nodes = list(self.last)
+        return [node for node in nodes if self.phi(node, now) >= self.threshold]
+
+    def remove(self, node):
+        with self.lock:
+            self.last.pop(node, None)
+            self.intervals.pop(node, None)
@@ -0,0 +1,157 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from utils.stats import ratio
+from utils.striped import Striped
+
+
+class FdEntry():
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        # threads currently using fd
+        self.refs = 0
+        # no longer in the cache, close once the last user is done
+        self.evicted = False
+
+
+class FdCache():
+    '''Bounded LRU of open file descriptors keyed by path. Users share a
+       descriptor, so they must use positional I/O (os.pread/os.pwrite)'''
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+
+        self.lock = threading.Lock()
+        # path -> FdEntry
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def open_fd(path):
+        try:
+            return os.open(path, os.O_RDWR)
+        except PermissionError:
+            return os.open(path, os.O_RDONLY)
+
+    @contextmanager
+    def open(self, path):
+        '''Yields a descriptor for path, opening it if it isn't cached'''
+        entry = self.acquire(path)
+        try:
+            yield entry.fd
+        finally:
+            self.release(entry)
+
+    def acquire(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry.refs += 1
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # open outside the lock, another thread may beat us to it
+        fd = self.open_fd(path)
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                os.close(fd)
+            else:
+                entry = self.entries[path] = FdEntry(path, fd)
+                self.evict()
+            entry.refs += 1
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            close = entry.evicted and entry.refs == 0
+        if close:
+            os.close(entry.fd)
+
+    def evict(self):
+        '''Called with the lock held'''
+        while len(self.entries) > self.capacity:
+            _, entry = self.entries.popitem(last=False)
+            self.retire(entry)
+
+    @staticmethod
+    def retire(entry):
+        '''Called with the lock held'''
+        entry.evicted = True
+        if entry.refs == 0:
+            os.close(entry.fd)
+
+    def cached(self, path):
+        '''Returns the cached descriptor for path without opening one'''
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry.refs += 1
+                return entry
+
+    def invalidate(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.retire(entry)
+
+    def invalidate_tree(self, path):
+        '''Invalidates path and, if it is a directory, everything under it'''
+        prefix = os.path.join(path, '')
+        with self.lock:
+            for key in [key for key in self.entries if key == path or key.startswith(prefix)]:
+                self.retire(self.entries.pop(key))
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': ratio(self.hits, self.misses),
+        }
+
+    def close(self):
+        with self.lock:
+            while self.entries:
+                _, entry = self.entries.popitem()
+                self.retire(entry)
+
+
+class StripedFdCache(Striped):
+    '''FdCache split into stripes, so threads using different files don't
+       wait for each other'''
+    def __init__(self, capacity=256, stripes=16):
+        super().__init__(lambda: FdCache(-(-capacity // stripes)), stripes)
+
+    def open(self, path):
+        return self.stripe(path).open(path)
+
+    def acquire(self, path):
+        return self.stripe(path).acquire(path)
+
+    def release(self, entry):
+        self.stripe(entry.path).release(entry)
+
+    def cached(self, path):
+        return self.stripe(path).cached(path)
+
+    def invalidate(self, path):
+        self.stripe(path).invalidate(path)
+
+    def invalidate_tree(self, path):
+        for stripe in self.stripes:
+            stripe.invalidate_tree(path)
+
+    def close(self):
+        for stripe in self.stripes:
+            stripe.close()
@@ -1,22 +1,136 @@
+import logging
 import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
-from utils.message import Message
+from utils.connection import Connection
+from utils.message import DATA
 from utils.node import Node
 
+log = logging.getLogger(__name__)
+
+# runs requests that carry an 'id', shared by every connection
+MUX_WORKERS = 32
+mux_executor = None
+mux_executor_lock = threading.Lock()
+
+
+def get_mux_executor():
+    global mux_executor
+    with mux_executor_lock:
+        if mux_executor is None:
+            mux_executor = ThreadPoolExecutor(MUX_WORKERS)
+        return mux_executor
+
+
 class RequestHandler(socketserver.BaseRequestHandler):
+    # commands whose msg['data'] is handed to process_msg as an iterator of
+    # chunks read straight off the socket instead of one buffer
+    stream_commands = ()
+
     def handle(self):
-        length = self.request.recv(4)
-        data = self.request.recv(Message.parse_length(length))
+        conn = Connection(self.request)
+        # replies to multiplexed requests are sent from worker threads
+        send_lock = threading.Lock()
+
+        # serve requests until the peer closes the (pooled) connection
+        while True:
+            msg = conn.recv_header()
+            if msg is None:
+                break
+
+            if msg.get('command') == 'HELLO':
+                with send_lock:
+                    conn.accept_hello(msg)
+                continue
+
+            host = self.client_address[0]
+            port = msg.get('port')
+            client_node = Node(host, port)
+
+            if 'id' in msg:
+                # multiplexed, answered whenever it is done. The payload
+                # has to be copied as the next request is read right away
+                if conn.pending:
+                    msg[DATA] = conn.recv_payload()
+                if msg.get('command') in self.stream_commands:
+                    msg[DATA] = iter([msg[DATA]] if msg.get(DATA) else [])
+
+                get_mux_executor().submit(self.process_mux, conn, send_lock, msg, client_node)
+                continue
+
+            if msg.get('command') in self.stream_commands:
+                if conn.pending:
+                    msg[DATA] = conn.iter_payload()
+                else:
+                    msg[DATA] = iter([msg[DATA]] if msg.get(DATA) else [])
+            elif conn.pending:
+                # a view of the read buffer, valid until the next message
+                msg[DATA] = conn.recv_payload(copy=False)
+
+            try:
+                response = self.dispatch(msg, client_node)
+            except Exception as e:
+                # the connection stays usable, as for multiplexed requests
+                log.warning('%s failed: %s', msg.get('command'), e)
+                response = {
+                    'reply': 'NO_REPLY',
+                }
+            if not response:
+                # nothing to reply with, close so the peer doesn't wait
+                break
+
+            # any payload process_msg left unread (a streamed one it
+            # stopped reading early too) is skipped by recv_header
+            with send_lock:
+                conn.send(response)
+
+    def process_mux(self, conn, send_lock, msg, client_node):
+        try:
+            response = self.dispatch(msg, client_node)
+        except Exception as e:
+            log.warning('%s failed: %s', msg.get('command'), e)
+            response = None
+
+        if not response:
+            response = {
+                'reply': 'NO_REPLY',
+            }
+
+        response = dict(response)
+        response['id'] = msg['id']
+        try:
+            with send_lock:
+                conn.send(response)
+        except OSError:
+            # the peer is gone, its reader fails the waiting request
+            pass
 
-        msg = Message.parse(length + data)
+    @classmethod
+    def detached(cls, server, client_address):
+        '''Returns a handler for calling process_msg directly, without a
+           socketserver request (used by utils.aio.AsyncServer)'''
+        handler = cls.__new__(cls)
+        handler.server = server
+        handler.client_address = client_address
+        handler.request = None
+        return handler
 
-        host = self.client_address[0]
-        port = msg.get('port')
-        client_node = Node(host, port)
+    def dispatch(self, msg, client_node):
+        '''process_msg, timed per command into server.stats (when the
+           server has one) and counted as in flight meanwhile'''
+        stats = getattr(self.server, 'stats', None)
+        if stats is None:
+            return self.process_msg(msg, client_node)
 
-        response = self.process_msg(msg, client_node)
-        if response:
-            self.request.sendall(Message.build(response))
+        stats.gauge('inflight', 1)
+        start = perf_counter()
+        try:
+            return self.process_msg(msg, client_node)
+        finally:
+            stats.record(f'rpc.{msg.get("command")}', perf_counter() - start)
+            stats.gauge('inflight', -1)
 
     def process_msg(self, msg, client_node):
         pass
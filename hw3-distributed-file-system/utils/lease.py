@@ -0,0 +1,102 @@
+from time import monotonic
+
+from utils.striped import StripedLock
+
+
+class LeaseTable():
+    '''Leases a server granted on paths. A read lease promises the holder
+       a callback before the path changes, so it may cache what it read
+       until the lease runs out. A write lease lets its holder buffer
+       writes until someone else wants to read, who then has them recalled.
+       Leases whose holder couldn't be called back run out after duration
+       seconds, which bounds how stale a cache can get.
+
+       Read leases are shared, a path has one write lease at most'''
+    def __init__(self, duration=10.0, stripes=16):
+        self.duration = duration
+        self.locks = StripedLock(stripes)
+        # path -> {node: expires}
+        self.readers = {}
+        # path -> (node, expires)
+        self.writers = {}
+        # expired leases are swept once this many have been granted
+        self.grants = 0
+        self.sweep_at = 1024
+
+    def __len__(self):
+        return len(self.readers) + len(self.writers)
+
+    def grant(self, path, node):
+        '''Grants node a read lease on path, returns its duration'''
+        with self.locks(path):
+            self.readers.setdefault(path, {})[node] = monotonic() + self.duration
+
+        self.grants += 1
+        if self.grants >= self.sweep_at:
+            self.expire()
+        return self.duration
+
+    def grant_write(self, path, node):
+        '''Grants node the write lease on path. Returns its duration and
+           the node it was taken from, who must flush its writes (or None)'''
+        now = monotonic()
+        with self.locks(path):
+            held = self.writers.get(path)
+            self.writers[path] = (node, now + self.duration)
+
+        self.grants += 1
+        if self.grants >= self.sweep_at:
+            self.expire()
+        if held is not None and held[0] != node and held[1] > now:
+            return self.duration, held[0]
+        return self.duration, None
+
+    def recall(self, path, node):
+        '''Takes back the write lease on path unless node holds it, returns
+           its holder, who must flush its writes before node reads (or None)'''
+        if path not in self.writers:
+            # every read asks, most paths have no writer
+            return None
+        with self.locks(path):
+            held = self.writers.get(path)
+            if held is None or held[0] == node:
+                return None
+            del self.writers[path]
+
+        return held[0] if held[1] > monotonic() else None
+
+    def revoke(self, path, node=None):
+        '''Takes back the read leases on path of everyone but node (who
+           changed it), returns the holders to call back'''
+        if path not in self.readers:
+            return []
+        now = monotonic()
+        with self.locks(path):
+            readers = self.readers.pop(path, None)
+            if not readers:
+                return []
+            if node in readers:
+                self.readers[path] = {node: readers.pop(node)}
+
+        return [holder for holder, expires in readers.items() if expires > now]
+
+    def expire(self):
+        '''Drops the leases that ran out'''
+        now = monotonic()
+        for path in list(self.readers):
+            with self.locks(path):
+                readers = self.readers.get(path)
+                if readers is None:
+                    continue
+                for node in [node for node, expires in readers.items() if expires <= now]:
+                    del readers[node]
+                if not readers:
+                    del self.readers[path]
+
+        for path in list(self.writers):
+            with self.locks(path):
+                held = self.writers.get(path)
+                if held is not None and held[1] <= now:
+                    del self.writers[path]
+
+        self.sweep_at = self.grants + max(1024, len(self))
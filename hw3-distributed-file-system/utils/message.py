@@ -1,17 +1,78 @@
-from construct import Int32ub, PascalString
+from base64 import b64decode, b64encode
+from construct import Int32ub, PascalString, Struct
 import json
 
+# bulk bytes (READ replies, WRITE requests) always travel under this key
+DATA = 'data'
+
 class Message():
+    '''Protocol version 1: length prefixed JSON, bulk data is base64'''
     struct = PascalString(Int32ub, "utf8")
     @classmethod
     def build(cls, obj):
+        data = obj.get(DATA)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            obj = dict(obj)
+            obj[DATA] = b64encode(data).decode()
         return cls.struct.build(json.dumps(obj))
 
     @classmethod
     def parse(cls, msg):
         json_str = cls.struct.parse(msg)
-        return json.loads(json_str)
+        obj = json.loads(json_str)
+        if isinstance(obj.get(DATA), str):
+            obj[DATA] = b64decode(obj[DATA].encode())
+        return obj
 
     @classmethod
     def parse_length(cls, buf):
         return Int32ub.parse(buf)
+
+
+class BinaryMessage():
+    '''Protocol version 2: fixed header, JSON document, then the raw bulk
+       data with no base64 step'''
+    header = Struct(
+        "json_len" / Int32ub,
+        "payload_len" / Int32ub,
+    )
+    header_len = header.sizeof()
+
+    @classmethod
+    def build_parts(cls, obj):
+        '''Returns (header + json, payload) so large payloads can be sent
+           without first being copied into one buffer'''
+        data = obj.get(DATA, b'')
+        if DATA in obj:
+            # keep the key as a marker, the payload follows the json
+            obj = dict(obj)
+            obj[DATA] = None
+
+        body = json.dumps(obj).encode()
+        head = cls.header.build(dict(json_len=len(body), payload_len=len(data)))
+        return head + body, data
+
+    @classmethod
+    def build(cls, obj):
+        head, data = cls.build_parts(obj)
+        return head + bytes(data)
+
+    @classmethod
+    def parse_header(cls, buf):
+        '''Returns (json_len, payload_len)'''
+        header = cls.header.parse(buf)
+        return header.json_len, header.payload_len
+
+    @classmethod
+    def parse_body(cls, body, payload):
+        obj = json.loads(bytes(body))
+        if DATA in obj:
+            obj[DATA] = payload
+        return obj
+
+
+# supported wire protocol versions
+PROTOCOLS = {
+    1: Message,
+    2: BinaryMessage,
+}
@@ -0,0 +1,159 @@
+import itertools
+import threading
+from concurrent.futures import Future
+
+from utils.pool import ConnectionPool, SendError, resendable
+
+
+class MuxConnection():
+    '''One connection with many requests in flight. Every request carries an
+       'id' that the peer echoes in its reply, a reader thread matches
+       replies (in whatever order they come) to the waiting callers'''
+    def __init__(self, conn, timeout=None):
+        self.conn = conn
+        # seconds a caller waits for its reply. The reader itself waits
+        # forever, an idle connection is not a stalled one
+        self.timeout = timeout
+        conn.sock.settimeout(None)
+
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        # id -> Future of the reply
+        self.pending = {}
+        self.ids = itertools.count()
+        self.closed = False
+
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def __len__(self):
+        '''Requests in flight'''
+        return len(self.pending)
+
+    def request(self, obj):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise SendError('connection closed by peer')
+            id = next(self.ids)
+            self.pending[id] = future
+
+        obj = dict(obj)
+        obj['id'] = id
+        try:
+            with self.send_lock:
+                self.conn.send(obj)
+        except Exception as e:
+            with self.lock:
+                self.pending.pop(id, None)
+            self.close()
+            if isinstance(e, OSError):
+                raise SendError(*e.args) from e
+            raise
+
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            with self.lock:
+                self.pending.pop(id, None)
+            raise
+
+    def read_loop(self):
+        try:
+            while True:
+                msg = self.conn.recv()
+                if msg is None:
+                    break
+                with self.lock:
+                    future = self.pending.pop(msg.pop('id', None), None)
+                if future is not None:
+                    future.set_result(msg)
+        except Exception:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        self.conn.close()
+
+        for future in pending.values():
+            future.set_exception(ConnectionResetError('connection closed by peer'))
+
+
+class MuxPool(ConnectionPool):
+    '''Shares a few multiplexed connections per peer between all threads,
+       instead of giving each in-flight request a socket of its own'''
+    def __init__(self, connections=2, **kwargs):
+        super().__init__(**kwargs)
+        # multiplexed connections kept per peer
+        self.connections = connections
+        # node -> [MuxConnection]
+        self.muxes = {}
+        # node -> [Future of a MuxConnection being opened], they count
+        # against the limit
+        self.opening = {}
+
+    def get(self, node):
+        '''Returns the least busy connection to node, opening another one
+           while under the limit and all of them are busy'''
+        with self.locks(node):
+            muxes = [mux for mux in self.muxes.get(node, []) if not mux.closed]
+            self.muxes[node] = muxes
+            opening = self.opening.setdefault(node, [])
+            best = min(muxes, key=len, default=None)
+            if best is not None and (len(best) == 0 or len(muxes) + len(opening) >= self.connections):
+                return best
+
+            if best is None and len(opening) >= self.connections:
+                # every connection is still being opened
+                waiting = opening[0]
+            else:
+                waiting = None
+                future = Future()
+                opening.append(future)
+
+        if waiting is not None:
+            return waiting.result()
+
+        try:
+            mux = MuxConnection(self.connect(node), self.timeout)
+        except Exception as e:
+            with self.locks(node):
+                opening.remove(future)
+            future.set_exception(e)
+            raise
+
+        with self.locks(node):
+            opening.remove(future)
+            self.muxes.setdefault(node, []).append(mux)
+        future.set_result(mux)
+        return mux
+
+    def request(self, node, obj):
+        mux = self.get(node)
+        try:
+            return mux.request(obj)
+        except OSError as e:
+            if not mux.closed or not resendable(obj, e):
+                raise
+
+            # the peer dropped the connection, retry once on a fresh one.
+            # Unless it may have been carried out already
+            return self.get(node).request(obj)
+
+    def discard(self, node):
+        with self.locks(node):
+            muxes = self.muxes.pop(node, [])
+            self.opening.pop(node, None)
+        for mux in muxes:
+            mux.close()
+        super().discard(node)
+
+    def close(self):
+        nodes = list(self.muxes)
+        for node in nodes:
+            self.discard(node)
+        super().close()
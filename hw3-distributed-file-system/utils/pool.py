@@ -0,0 +1,186 @@
+import select
+import socket
+import threading
+from collections import defaultdict, deque
+from time import monotonic
+
+from utils.connection import Connection
+from utils.striped import StripedLock
+
+
+# commands a peer may carry out twice without harm. A request whose reply
+# was lost is only resent if it is one of these
+IDEMPOTENT = frozenset(('READ', 'GET_ATTR', 'GET_ATTRS', 'CHECKSUM', 'PING',
+                        'STATS', 'GET_FILE_LOC', 'PLACE_FILE', 'LIST_DIR',
+                        'LIST_DIR_PLUS', 'NODE_STATS', 'HEARTBEAT',
+                        'MEMBERSHIP', 'INVALIDATE', 'INVALIDATE_LOC',
+                        'LEASE', 'RECALL'))
+
+
+class ConnectError(OSError):
+    '''Raised when a fresh connection to a peer could not be established'''
+    pass
+
+
+class SendError(ConnectionError):
+    '''Raised when a request could not be sent in full. The peer can't
+       have acted on it, it is safe to send again'''
+    pass
+
+
+def resendable(obj, error):
+    '''Whether obj, which failed with error, may be sent again'''
+    return isinstance(error, SendError) or obj.get('command') in IDEMPOTENT
+
+
+class ConnectionPool():
+    '''Keeps idle sockets to each peer open so consecutive requests to the
+       same node (bootstrap or storage) reuse one TCP connection'''
+    def __init__(self, max_idle=4, idle_timeout=30.0, connect_timeout=None,
+                 timeout=None, max_connections=32, version=2, stripes=16):
+        # idle sockets kept per peer, anything above this is closed
+        self.max_idle = max_idle
+        # idle sockets older than this (seconds) are not reused
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        # seconds a reply (or a free connection) is waited for, so a
+        # stalled peer fails like a dead one. None waits forever
+        self.timeout = timeout
+        # connections in use per peer, more requests wait for one of them.
+        # Idle ones are reused before another is opened. None is no limit
+        self.max_connections = max_connections
+        # highest wire protocol version to negotiate on new connections
+        self.version = version
+
+        # guards the connections to a node, by node
+        self.locks = StripedLock(stripes)
+        # node -> deque of (Connection, last_used)
+        self.idle = defaultdict(deque)
+        # node -> semaphore of its connections in use
+        self.slots = {}
+
+    def connect(self, node):
+        try:
+            s = socket.create_connection(node, timeout=self.connect_timeout)
+        except OSError as e:
+            raise ConnectError(*e.args) from e
+
+        s.settimeout(self.timeout)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        conn = Connection(s)
+        try:
+            conn.hello(self.version)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @staticmethod
+    def healthy(conn):
+        '''An idle connection has nothing to read, if it is readable the
+           peer has closed it (or sent something we didn't ask for)'''
+        try:
+            readable, _, _ = select.select([conn], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def slot(self, node):
+        with self.locks(node):
+            slot = self.slots.get(node)
+            if slot is None:
+                slot = self.slots[node] = threading.BoundedSemaphore(self.max_connections)
+        return slot
+
+    def acquire(self, node):
+        '''Returns (Connection, reused), waiting while max_connections are
+           in use. Hand it back with release(), or free() once closed'''
+        if self.max_connections and not self.slot(node).acquire(timeout=self.timeout):
+            raise TimeoutError(f'no free connection to {node}')
+
+        try:
+            return self.reuse(node) or (self.connect(node), False)
+        except Exception:
+            self.free(node)
+            raise
+
+    def reuse(self, node):
+        now = monotonic()
+        while True:
+            with self.locks(node):
+                idle = self.idle[node]
+                if not idle:
+                    break
+                conn, last_used = idle.pop()
+
+            # a system call, made outside the lock
+            if now - last_used <= self.idle_timeout and self.healthy(conn):
+                return conn, True
+            conn.close()
+
+        return None
+
+    def release(self, node, conn):
+        with self.locks(node):
+            idle = self.idle[node]
+            if len(idle) < self.max_idle:
+                idle.append((conn, monotonic()))
+                conn = None
+        if conn is not None:
+            conn.close()
+        self.free(node)
+
+    def free(self, node):
+        '''A connection acquired to node was closed'''
+        if self.max_connections:
+            self.slots[node].release()
+
+    def discard(self, node):
+        '''Closes every idle connection to node (e.g. after it died)'''
+        with self.locks(node):
+            idle = self.idle.pop(node, ())
+        for conn, _ in idle:
+            conn.close()
+
+    def close(self):
+        nodes = list(self.idle)
+        for node in nodes:
+            self.discard(node)
+
+    @staticmethod
+    def exchange(conn, obj):
+        try:
+            conn.send(obj)
+        except OSError as e:
+            raise SendError(*e.args) from e
+
+        resp = conn.recv()
+        if resp is None:
+            raise ConnectionResetError('connection closed by peer')
+        return resp
+
+    def request(self, node, obj):
+        '''Sends obj to node and returns the parsed reply'''
+        conn, reused = self.acquire(node)
+        try:
+            try:
+                resp = self.exchange(conn, obj)
+            except OSError as e:
+                conn.close()
+                if not reused or isinstance(e, TimeoutError) or not resendable(obj, e):
+                    raise
+
+                # the peer dropped an idle keep-alive connection, retry once
+                # on a fresh one. Unless it may have been carried out already
+                conn = self.connect(node)
+                resp = self.exchange(conn, obj)
+
+        except Exception:
+            conn.close()
+            self.free(node)
+            raise
+
+        self.release(node, conn)
+        return resp
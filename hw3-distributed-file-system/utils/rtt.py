@@ -0,0 +1,51 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from time import monotonic
+
+# seconds charged to a node whose request failed, ranks it behind healthy
+# replicas until successful requests smooth it back down
+FAILED_RTT = 1.0
+
+
+class RttTracker():
+    '''Smoothed round trip time and requests in flight per node, used to
+       send reads to the lowest latency, least loaded replica'''
+    def __init__(self, alpha=0.2):
+        # weight of the newest sample in the moving average
+        self.alpha = alpha
+
+        self.lock = threading.Lock()
+        # node -> smoothed rtt in seconds
+        self.rtt = {}
+        # node -> requests in flight
+        self.inflight = defaultdict(int)
+
+    @contextmanager
+    def measure(self, node):
+        with self.lock:
+            self.inflight[node] += 1
+
+        start = monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            sample = monotonic() - start if ok else FAILED_RTT
+            with self.lock:
+                self.inflight[node] -= 1
+                old = self.rtt.get(node)
+                if old is None or not ok:
+                    self.rtt[node] = max(sample, old or 0)
+                else:
+                    self.rtt[node] = (1 - self.alpha) * old + self.alpha * sample
+
+    def score(self, node):
+        # unmeasured nodes score 0 so they get measured
+        return self.rtt.get(node, 0.0) * (1 + self.inflight.get(node, 0))
+
+    def rank(self, nodes):
+        '''Returns nodes best first'''
+        with self.lock:
+            return sorted(nodes, key=self.score)
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+from time import sleep, time
+
+# values below 2 * SUB_BUCKETS microseconds are kept exactly, larger ones
+# in SUB_BUCKETS buckets per power of two (about 3% precision)
+SUB_BUCKETS = 32
+# enough buckets for about 30 minutes
+BUCKETS = SUB_BUCKETS * 38
+
+
+def bucket_of(us):
+    if us < 2 * SUB_BUCKETS:
+        return us
+    shift = us.bit_length() - SUB_BUCKETS.bit_length()
+    return min(SUB_BUCKETS * shift + (us >> shift), BUCKETS - 1)
+
+
+def value_of(bucket):
+    '''Middle of the range of microseconds bucket counts'''
+    if bucket < 2 * SUB_BUCKETS:
+        return bucket
+    shift = bucket // SUB_BUCKETS - 1
+    low = (bucket - SUB_BUCKETS * shift) << shift
+    return low + (1 << shift) // 2
+
+
+def ratio(hits, misses):
+    return hits / (hits + misses) if hits + misses else None
+
+
+class Histogram():
+    '''HDR-style latency histogram: a fixed array of log-linear buckets, so
+       recording is one increment and memory doesn't grow with samples'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        us = int(seconds * 1e6)
+        bucket = bucket_of(us)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += us
+            if us > self.max:
+                self.max = us
+
+    def percentiles(self, ps):
+        '''Microseconds under which ps (ascending) percent of the samples fall'''
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            top = self.max
+
+        values = []
+        seen = 0
+        bucket = 0
+        for p in ps:
+            target = max(1, count * p / 100)
+            while bucket < BUCKETS - 1 and seen + counts[bucket] < target:
+                seen += counts[bucket]
+                bucket += 1
+            # the middle of the last bucket may be past the largest sample
+            values.append(min(value_of(bucket), top))
+        return values
+
+    def snapshot(self):
+        p50, p90, p99, p999 = self.percentiles([50, 90, 99, 99.9])
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count if self.count else 0,
+            'p50_us': p50,
+            'p90_us': p90,
+            'p99_us': p99,
+            'p999_us': p999,
+            'max_us': self.max,
+        }
+
+
+class Stats():
+    '''Latency histograms, counters and gauges of one node (or the
+       bootstrap), plus the stats of the caches registered with it'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        # name -> function returning a dict, called by snapshot()
+        self.sources = {}
+        self.started = time()
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, delta):
+        '''Moves the current value of gauge name (requests in flight) by delta'''
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def register(self, name, source):
+        self.sources[name] = source
+
+    def snapshot(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+
+        snapshot = {
+            'time': time(),
+            'uptime': time() - self.started,
+            'latency': dict((name, h.snapshot()) for name, h in sorted(histograms.items())),
+            'counters': counters,
+            'gauges': gauges,
+        }
+        for name, source in self.sources.items():
+            snapshot[name] = source()
+        return snapshot
+
+    def dump(self, path):
+        '''Atomically replaces path with a snapshot'''
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def dump_loop(self, path, period):
+        while True:
+            sleep(period)
+            self.dump(path)
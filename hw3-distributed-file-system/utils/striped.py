@@ -0,0 +1,42 @@
+import threading
+
+from utils.stats import ratio
+
+
+class StripedLock():
+    '''A fixed set of locks, the one guarding a key picked by its hash.
+       Threads working on different keys rarely wait for each other, and
+       there is no lock per key to create and clean up.
+
+       with self.locks(path):
+           ...
+    '''
+    def __init__(self, stripes=16):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def __call__(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+
+class Striped():
+    '''Splits a cache into stripes, independent instances with a lock of
+       their own, the one holding a key picked by its hash. Capacity and
+       LRU order are per stripe. Subclasses route each method by its key'''
+    def __init__(self, make, stripes=16):
+        self.stripes = [make() for _ in range(stripes)]
+
+    def stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self.stripes)
+
+    def stats(self):
+        '''The stats of the stripes added up'''
+        stats = {}
+        for stripe in self.stripes:
+            for name, value in stripe.stats().items():
+                if name != 'hit_ratio':
+                    stats[name] = stats.get(name, 0) + value
+        stats['hit_ratio'] = ratio(stats['hits'], stats['misses'])
+        return stats
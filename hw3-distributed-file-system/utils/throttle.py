@@ -0,0 +1,32 @@
+import threading
+from time import monotonic, sleep
+
+
+class Throttle():
+    '''Token bucket limiting background transfers to rate bytes per second
+       (rate=0 is unlimited), so they leave bandwidth for foreground
+       requests. Bursts of up to one second's worth are let through'''
+    def __init__(self, rate):
+        self.rate = rate
+
+        self.lock = threading.Lock()
+        self.tokens = rate
+        self.last = monotonic()
+
+    def consume(self, n):
+        '''Blocks until n more bytes may be sent'''
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            # go into debt and sleep it off, so chunks larger than the
+            # bucket still get through
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
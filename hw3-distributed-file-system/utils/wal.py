@@ -0,0 +1,197 @@
+import json
+import os
+import re
+import threading
+from time import sleep
+
+SNAPSHOT = 'snapshot.json'
+SEGMENT = re.compile(r'^wal-(\d+)\.log$')
+
+
+class WriteAheadLog():
+    '''Append-only log of JSON records, one per line, split into numbered
+       segment files so a snapshot can retire the ones it covers.
+
+       write() only buffers a record, so callers can do it while holding
+       the lock that orders their mutations. sync() then waits (outside
+       that lock) until the record is on disk. Whoever syncs first writes
+       and fsyncs everything buffered so far, and concurrent writers
+       arriving meanwhile share the next fsync (group commit).
+
+       With a sync_interval sync() doesn't wait, a background thread
+       fsyncs that often instead. Mutations are then as fast as without a
+       log, but up to sync_interval seconds of them can be lost'''
+    def __init__(self, directory, sync_interval=0):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.sync_interval = sync_interval
+
+        self.cond = threading.Condition()
+        self.buffer = []
+        # sequence numbers of the last record buffered and made durable
+        self.written = 0
+        self.synced = 0
+        self.flushing = False
+        # set once a write failed, the log can't be trusted after that
+        self.error = None
+        # records in the current segment
+        self.records = 0
+
+        self.segment = max(self.segments(), default=0) + 1
+        self.file = self.open_segment(self.segment)
+
+        self.closed = False
+        if sync_interval:
+            threading.Thread(target=self.sync_loop, daemon=True).start()
+
+    def path(self, segment):
+        return os.path.join(self.directory, f'wal-{segment:06d}.log')
+
+    def open_segment(self, segment):
+        return open(self.path(segment), 'ab', buffering=0)
+
+    def segments(self):
+        '''Numbers of the segment files on disk, oldest first'''
+        return sorted(int(m.group(1)) for m in map(SEGMENT.match, os.listdir(self.directory)) if m)
+
+    def write(self, record):
+        '''Buffers record, returns its sequence number for sync()'''
+        line = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+        with self.cond:
+            self.buffer.append(line)
+            self.written += 1
+            self.records += 1
+            return self.written
+
+    def sync(self, seq):
+        '''Returns once record seq (and everything before it) is durable'''
+        if self.sync_interval:
+            if self.error:
+                raise self.error
+            return
+        self.flush(seq)
+
+    def sync_loop(self):
+        while True:
+            sleep(self.sync_interval)
+            with self.cond:
+                if self.closed:
+                    return
+            try:
+                self.flush(self.written)
+            except OSError:
+                # raised from sync() from now on
+                pass
+
+    def flush(self, seq):
+        with self.cond:
+            while self.synced < seq:
+                if self.error:
+                    raise self.error
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+
+                # lead a group commit. Let writers that are about to
+                # append join it first, it costs one GIL handoff and saves
+                # them an fsync each
+                self.flushing = True
+                self.cond.release()
+                sleep(0)
+                self.cond.acquire()
+
+                batch, self.buffer = self.buffer, []
+                upto = self.written
+                file = self.file
+
+                self.cond.release()
+                try:
+                    file.write(b''.join(batch))
+                    os.fsync(file.fileno())
+                except OSError as e:
+                    self.error = e
+                finally:
+                    self.cond.acquire()
+                    self.flushing = False
+                    if not self.error:
+                        self.synced = upto
+                    self.cond.notify_all()
+
+    def rotate(self):
+        '''Starts a new segment, returns the number of the last one. Called
+           with the caller's lock held, so that the old segments hold
+           exactly the mutations made before it'''
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+
+            self.file.write(b''.join(self.buffer))
+            os.fsync(self.file.fileno())
+            self.buffer = []
+            self.synced = self.written
+            self.cond.notify_all()
+
+            self.file.close()
+            old = self.segment
+            self.segment += 1
+            self.file = self.open_segment(self.segment)
+            self.records = 0
+            return old
+
+    def retire(self, upto):
+        '''Deletes the segments up to and including upto'''
+        for segment in self.segments():
+            if segment <= upto:
+                os.unlink(self.path(segment))
+
+    def replay(self, after=0):
+        '''Yields the records of the segments after after, in order. A torn
+           last line (a crash mid write) ends the replay'''
+        for segment in self.segments():
+            if segment <= after or segment >= self.segment:
+                continue
+            with open(self.path(segment), 'rb') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        break
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            while self.flushing:
+                self.cond.wait()
+            if self.buffer:
+                self.file.write(b''.join(self.buffer))
+                os.fsync(self.file.fileno())
+                self.buffer = []
+                self.synced = self.written
+            self.file.close()
+
+
+def write_snapshot(directory, state):
+    '''Atomically replaces the snapshot in directory with state'''
+    path = os.path.join(directory, SNAPSHOT)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        # a single write, json.dump writes in many small pieces
+        f.write(json.dumps(state, separators=(',', ':')))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_snapshot(directory):
+    '''Returns the state last written by write_snapshot, or None'''
+    try:
+        with open(os.path.join(directory, SNAPSHOT)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,167 @@
+import logging
+import threading
+from time import monotonic
+
+from utils.striped import StripedLock
+
+log = logging.getLogger(__name__)
+
+
+class DirtyFile():
+    def __init__(self):
+        # sorted, non overlapping [offset, bytearray] extents
+        self.extents = []
+        self.size = 0
+        # when the oldest unflushed write happened
+        self.since = monotonic()
+
+
+class WriteBuffer():
+    '''Buffers writes per file, merging adjacent and overlapping ones, and
+       hands them to flush(path, offset, data) in large extents once a file
+       passes the size threshold, on a timer or when asked to'''
+    def __init__(self, flush, threshold=4 * 1024 * 1024, interval=1.0, stripes=16):
+        self.flush_extent = flush
+        # dirty bytes per file that trigger a flush
+        self.threshold = threshold
+        # seconds dirty data may sit in the buffer
+        self.interval = interval
+
+        # guards the DirtyFile of a path, by path, so writers to different
+        # files merge at once. self.files itself is only read or changed in
+        # single dict operations
+        self.locks = StripedLock(stripes)
+        # path -> DirtyFile
+        self.files = {}
+        # path -> [Lock, flushes using it]. Serialises the flushes of a
+        # path, whose writes then reach the owner in order, and a flush
+        # only returns once the earlier ones are done. Kept while in use
+        self.flushing = {}
+
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self.flush_old, daemon=True)
+        self.timer.start()
+
+    def write(self, path, data, offset):
+        with self.locks(path):
+            dirty = self.files.get(path)
+            if dirty is None:
+                dirty = self.files[path] = DirtyFile()
+            self.merge(dirty, offset, data)
+            full = dirty.size >= self.threshold
+
+        if full:
+            self.flush(path)
+        return len(data)
+
+    @staticmethod
+    def merge(dirty, offset, data):
+        '''Adds a write to dirty's extents. Called with the lock held'''
+        end = offset + len(data)
+
+        keep = []
+        start, merged = offset, None
+        for extent in dirty.extents:
+            e_offset, e_data = extent
+            e_end = e_offset + len(e_data)
+            if e_end < offset or e_offset > end:
+                keep.append(extent)
+                continue
+
+            # overlapping or touching, fold it in, the new data wins
+            if merged is None:
+                start = min(offset, e_offset)
+                merged = bytearray(max(end, e_end) - start)
+            elif e_end - start > len(merged):
+                merged.extend(bytes(e_end - start - len(merged)))
+            merged[e_offset - start:e_end - start] = e_data
+            dirty.size -= len(e_data)
+
+        if merged is None:
+            merged = bytearray(data)
+        else:
+            merged[offset - start:end - start] = data
+
+        keep.append([start, merged])
+        keep.sort(key=lambda extent: extent[0])
+        dirty.extents = keep
+        dirty.size += len(merged)
+
+    def end(self, path):
+        '''Returns the end offset of buffered data for path, or 0'''
+        with self.locks(path):
+            dirty = self.files.get(path)
+            if dirty is None or not dirty.extents:
+                return 0
+            offset, data = dirty.extents[-1]
+            return offset + len(data)
+
+    def __contains__(self, path):
+        '''Whether path has writes buffered or being flushed'''
+        return path in self.files or path in self.flushing
+
+    def flush(self, path):
+        '''Sends the buffered writes of path, returns once they (and those
+           of any flush of it already running) reached the owner'''
+        with self.locks(path):
+            if path not in self.files and path not in self.flushing:
+                return
+            entry = self.flushing.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                with self.locks(path):
+                    dirty = self.files.pop(path, None)
+                if dirty is None:
+                    # the flush we waited for sent them
+                    return
+
+                extents = dirty.extents
+                for i, (offset, data) in enumerate(extents):
+                    try:
+                        self.flush_extent(path, offset, bytes(data))
+                    except Exception:
+                        self.requeue(path, extents[i:])
+                        raise
+        finally:
+            with self.locks(path):
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.flushing[path]
+
+    def requeue(self, path, extents):
+        '''Puts extents that failed to flush back under newer writes'''
+        with self.locks(path):
+            newer = self.files.get(path)
+            dirty = self.files[path] = DirtyFile()
+            for offset, data in extents:
+                self.merge(dirty, offset, data)
+            if newer is not None:
+                for offset, data in newer.extents:
+                    self.merge(dirty, offset, data)
+
+    def discard(self, path):
+        with self.locks(path):
+            self.files.pop(path, None)
+
+    def flush_all(self):
+        for path in list(self.files) + list(self.flushing):
+            self.flush(path)
+
+    def flush_old(self):
+        while not self.stopped.wait(self.interval / 2):
+            now = monotonic()
+            paths = [path for path, dirty in list(self.files.items())
+                     if now - dirty.since >= self.interval]
+
+            for path in paths:
+                try:
+                    self.flush(path)
+                except Exception as e:
+                    # kept for the next attempt, flush/fsync will report it
+                    log.warning('background flush of %s failed: %s', path, e)
+
+    def shutdown(self):
+        self.stopped.set()
+        self.flush_all()